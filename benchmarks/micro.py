@@ -0,0 +1,306 @@
+"""
+Micro-benchmarks for the Shopcart hot paths
+
+Times Shopcart.serialize, Shopcart.deserialize, marshal_with(shopcart_model),
+the compiled encoder of the read endpoints, the ORM finders, the read-only
+row finders and the finders that attach their rows to the session on tables
+of 1k, 100k and 1M rows, with the cache turned off, then compares the
+results with the baseline kept in benchmarks/baseline.json and exits with
+status 1 when a case got slower than the baseline by more than --threshold.
+
+Run it from the root of the repository:
+    python -m benchmarks.micro
+    python -m benchmarks.micro --sizes 1000,100000 --threshold 0.5
+    python -m benchmarks.micro --update-baseline
+
+Timings depend on the machine, so every run also times a fixed piece of
+pure Python and the cases are compared relative to it. Baselines are kept
+per database dialect; a dialect without a baseline is reported but never
+fails. The default database is a SQLite file in a temporary directory, the
+tables of a database given with --database-uri are dropped.
+
+Rows are laid out so every cart and every product has 10 items, which keeps
+the result size of the finders the same at every table size.
+"""
+import argparse
+import gc
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+DEFAULT_SIZES = (1000, 100000, 1000000)
+ITEMS_PER_CART = 10
+LOOKUPS = 500
+MIN_SECONDS = 0.2
+
+
+######################################################################
+#  T I M I N G
+######################################################################
+def measure(func, repeat=3):
+    """ Returns the best time of one call of func, in seconds """
+    gc.collect()
+    start = time.perf_counter()
+    func()
+    first = time.perf_counter() - start
+    # fast cases are run in a loop long enough to be timed reliably
+    number = max(1, int(math.ceil(MIN_SECONDS / first))) if first > 0 else 1
+    best = first
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - start) / number)
+    return best
+
+
+def calibrate():
+    """ Times a fixed piece of pure Python used to compare machines """
+    data = [{"id": i, "name": "item{}".format(i), "price": i * 0.5} for i in range(1000)]
+
+    def work():
+        for _ in range(20):
+            json.loads(json.dumps(data))
+
+    return measure(work, repeat=5)
+
+
+######################################################################
+#  S E E D I N G
+######################################################################
+def key(i, size):
+    """ Returns the shopcart_id and product_id of row i """
+    products = max(size // ITEMS_PER_CART, ITEMS_PER_CART)
+    return i // ITEMS_PER_CART + 1, (i * 7919) % products + 1
+
+
+def rows(size):
+    """ Yields size rows where every cart and every product has 10 items """
+    now = datetime.now()
+    for i in range(size):
+        shopcart_id, product_id = key(i, size)
+        yield {
+            "shopcart_id": shopcart_id,
+            "product_id": product_id,
+            "quantity": i % 5 + 1,
+            "price": round(1 + (i % 1000) * 0.25, 2),
+            "time_added": now,
+            "checkout": 0,
+        }
+
+
+def seed(db, table, size, chunk=10000):
+    """ Replaces the rows of the table with size generated rows """
+    db.session.execute(table.delete())
+    batch = []
+    for row in rows(size):
+        batch.append(row)
+        if len(batch) == chunk:
+            db.session.execute(table.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
+    db.session.commit()
+
+
+######################################################################
+#  C A S E S
+######################################################################
+def run_cases(size, repeat, rng):
+    """ Returns the seconds per operation of every case at one table size """
+    from service.models import db, Shopcart
+    from service.encoders import dumps
+    from service import app
+    from service.routes import api, encode_shopcart, shopcart_model
+
+    seed(db, Shopcart.__table__, size)
+    carts = size // ITEMS_PER_CART
+    products = max(size // ITEMS_PER_CART, ITEMS_PER_CART)
+    keys = [key(i, size) for i in range(0, size, max(1, size // LOOKUPS))][:LOOKUPS]
+    cart_ids = [rng.randint(1, carts) for _ in range(LOOKUPS)]
+    product_ids = [rng.randint(1, products) for _ in range(LOOKUPS)]
+    results = {}
+
+    def find_from_row():
+        for shopcart_id, product_id in keys:
+            db.session.expunge_all()
+            Shopcart.find(shopcart_id, product_id)
+
+    def find_by_shopcart_id_from_rows():
+        for shopcart_id in cart_ids:
+            db.session.expunge_all()
+            Shopcart.find_by_shopcart_id(shopcart_id)
+
+    def find_for_update():
+        for shopcart_id, product_id in keys:
+            db.session.expunge_all()
+            Shopcart.find_for_update(shopcart_id, product_id)
+        db.session.rollback()
+
+    def find_by_product_id():
+        for product_id in product_ids:
+            db.session.expunge_all()
+            Shopcart.find_by_product_id(product_id)
+
+    def find_all():
+        db.session.expunge_all()
+        Shopcart.all()
+
+    def find_row():
+        for shopcart_id, product_id in keys:
+            Shopcart.find_row(shopcart_id, product_id)
+
+    def find_rows_by_shopcart_id():
+        for shopcart_id in cart_ids:
+            Shopcart.find_rows_by_shopcart_id(shopcart_id)
+
+    def find_rows_by_product_id():
+        for product_id in product_ids:
+            Shopcart.find_rows_by_product_id(product_id)
+
+    # find and find_by_shopcart_id load rows and attach them, find_for_update runs an ORM query
+    results["find_from_row"] = measure(find_from_row, repeat) / len(keys)
+    results["find_by_shopcart_id_from_rows"] = measure(find_by_shopcart_id_from_rows, repeat) / len(cart_ids)
+    results["find_for_update"] = measure(find_for_update, repeat) / len(keys)
+    results["find_by_product_id"] = measure(find_by_product_id, repeat) / len(product_ids)
+    results["all"] = measure(find_all, repeat)
+    results["find_row"] = measure(find_row, repeat) / len(keys)
+    results["find_rows_by_shopcart_id"] = measure(find_rows_by_shopcart_id, repeat) / len(cart_ids)
+    results["find_rows_by_product_id"] = measure(find_rows_by_product_id, repeat) / len(product_ids)
+    results["all_rows"] = measure(Shopcart.all_rows, repeat)
+
+    db.session.expunge_all()
+    items = Shopcart.all()
+
+    def serialize(items=items):
+        for item in items:
+            item.serialize()
+
+    results["serialize"] = measure(serialize, repeat) / size
+
+    def fast_encode(items=items):
+        dumps([encode_shopcart(item) for item in items])
+
+    with app.test_request_context():
+        results["fast_encode"] = measure(fast_encode, repeat) / size
+    data = [item.serialize() for item in items]
+    # the ORM items are freed before the next cases
+    del items, serialize, fast_encode
+    db.session.expunge_all()
+
+    def deserialize():
+        for row in data:
+            Shopcart().deserialize(row)
+
+    results["deserialize"] = measure(deserialize, repeat) / size
+
+    marshalled = api.marshal_with(shopcart_model)(lambda: data)
+    with app.test_request_context():
+        results["marshal_with"] = measure(marshalled, repeat) / size
+    return results
+
+
+######################################################################
+#  B A S E L I N E
+######################################################################
+def compare(results, calibration, baseline, threshold):
+    """ Returns a line for every case and whether any case regressed """
+    lines = []
+    failed = False
+    for size, cases in sorted(results.items(), key=lambda item: int(item[0])):
+        base_size = (baseline or {}).get(size, {})
+        for name, seconds in sorted(cases.items()):
+            base = base_size.get("seconds_per_op", {}).get(name)
+            if base is None:
+                lines.append("{:>8} {:<24} {:>12.3f} us   no baseline".format(size, name, seconds * 1e6))
+                continue
+            # relative to the calibration so a slower machine is not a regression
+            ratio = (seconds / calibration) / (base / base_size["calibration_seconds"])
+            regressed = ratio > 1 + threshold
+            failed = failed or regressed
+            lines.append("{:>8} {:<24} {:>12.3f} us {:>+7.1%}{}".format(
+                size, name, seconds * 1e6, ratio - 1, "   REGRESSION" if regressed else ""))
+    return lines, failed
+
+
+def load_baselines(path):
+    """ Returns the baselines in the file, by database dialect and size """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def main(argv=None):
+    """ Runs the benchmarks and checks them against the baseline """
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for the Shopcart hot paths")
+    parser.add_argument("--database-uri", help="defaults to a SQLite file in a temporary directory")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in DEFAULT_SIZES),
+                        help="comma separated table sizes")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs of each case, the best is kept")
+    parser.add_argument("--threshold", type=float,
+                        default=float(os.getenv("BENCHMARK_THRESHOLD", "0.3")),
+                        help="allowed slowdown against the baseline, 0.3 is 30%%")
+    parser.add_argument("--baseline", default=BASELINE, help="the baseline file")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="save the results as the baseline instead of comparing")
+    parser.add_argument("--seed", type=int, default=42, help="seed of the random lookups")
+    args = parser.parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    workdir = tempfile.mkdtemp(prefix="shopcarts-micro-")
+    # config.py reads the environment when the service is first imported
+    os.environ["DATABASE_URI"] = args.database_uri or "sqlite:///" + os.path.join(workdir, "micro.db")
+    # the finders are timed against the database, not the cache
+    os.environ["CACHE_BACKEND"] = "none"
+    try:
+        from service import app
+        from service.models import db
+        with app.app_context():
+            db.drop_all()
+            db.create_all()
+            dialect = db.engine.dialect.name
+            calibration = calibrate()
+            results = {}
+            rng = random.Random(args.seed)
+            for size in sizes:
+                print("timing {} rows".format(size), file=sys.stderr)
+                results[str(size)] = run_cases(size, args.repeat, rng)
+            db.session.remove()
+            db.drop_all()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    baselines = load_baselines(args.baseline)
+    if args.update_baseline:
+        # a run over fewer sizes keeps the baseline of the other sizes
+        baseline = baselines.setdefault(dialect, {})
+        for size, cases in results.items():
+            baseline[size] = {
+                "calibration_seconds": calibration,
+                "python": platform.python_version(),
+                "seconds_per_op": cases,
+            }
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(baselines, baseline_file, indent=2, sort_keys=True)
+            baseline_file.write("\n")
+        print("baseline for {} saved to {}".format(dialect, args.baseline))
+        return 0
+
+    lines, failed = compare(results, calibration, baselines.get(dialect), args.threshold)
+    print("{} baseline, threshold {:.0%}".format(dialect, args.threshold))
+    print("\n".join(lines))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
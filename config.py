@@ -19,6 +19,93 @@ if 'VCAP_SERVICES' in os.environ:
 SQLALCHEMY_DATABASE_URI = DATABASE_URI
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Connection pool per worker, the sizes and statement timeout apply to Postgres
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
+# milliseconds, 0 turns the timeout off
+DB_STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT", "30000"))
+
+# Retries of transient database errors, seconds, the retries of a request
+# share DB_RETRY_BUDGET
+DB_RETRY_ATTEMPTS = int(os.getenv("DB_RETRY_ATTEMPTS", "3"))
+DB_RETRY_BASE_DELAY = float(os.getenv("DB_RETRY_BASE_DELAY", "0.05"))
+DB_RETRY_MAX_DELAY = float(os.getenv("DB_RETRY_MAX_DELAY", "1"))
+DB_RETRY_BUDGET = float(os.getenv("DB_RETRY_BUDGET", "2"))
+# Circuit breaker: connection failures in a row that open it, seconds it stays open
+DB_BREAKER_THRESHOLD = int(os.getenv("DB_BREAKER_THRESHOLD", "5"))
+DB_BREAKER_RESET_TIMEOUT = float(os.getenv("DB_BREAKER_RESET_TIMEOUT", "30"))
+
+# Read replicas, comma separated URIs, the reads of GET requests go to them.
+# A client reads from the primary for DB_REPLICA_STICKY_SECONDS after a
+# write, a replica that fails or lags by more than DB_REPLICA_MAX_LAG seconds
+# is left out for DB_REPLICA_EJECT_SECONDS
+DB_REPLICA_URIS = [uri.strip() for uri in os.getenv("DATABASE_REPLICA_URIS", "").split(",") if uri.strip()]
+DB_REPLICA_STICKY_SECONDS = float(os.getenv("DB_REPLICA_STICKY_SECONDS", "5"))
+DB_REPLICA_MAX_LAG = float(os.getenv("DB_REPLICA_MAX_LAG", "10"))
+DB_REPLICA_CHECK_INTERVAL = float(os.getenv("DB_REPLICA_CHECK_INTERVAL", "5"))
+DB_REPLICA_EJECT_SECONDS = float(os.getenv("DB_REPLICA_EJECT_SECONDS", "30"))
+
+# Shards, comma separated URIs of the databases added to the primary, each
+# cart lives on the one a consistent hash of its shopcart_id picks. Append a
+# new shard to the end and move the carts with: flask shards rebalance
+DB_SHARD_URIS = [uri.strip() for uri in os.getenv("DATABASE_SHARD_URIS", "").split(",") if uri.strip()]
+DB_SHARD_VNODES = int(os.getenv("DB_SHARD_VNODES", "64"))
+# While the carts are rebalanced, the number of shards before the last ones
+# were added: a cart still on its shard of that ring is moved when used
+DB_SHARD_PREVIOUS_COUNT = int(os.getenv("DB_SHARD_PREVIOUS_COUNT", "0"))
+# Carts listed per query while rebalancing
+SHARD_REBALANCE_BATCH_SIZE = int(os.getenv("SHARD_REBALANCE_BATCH_SIZE", "500"))
+
+# Expiry of abandoned carts: items never checked out and added more than
+# CART_EXPIRY_DAYS ago are removed CART_EXPIRY_BATCH_SIZE at a time, with a
+# pause of CART_EXPIRY_PAUSE seconds between the batches. The workers run it
+# every CART_EXPIRY_INTERVAL seconds, one at a time, 0 leaves it to:
+# flask carts expire
+CART_EXPIRY_DAYS = float(os.getenv("CART_EXPIRY_DAYS", "30"))
+CART_EXPIRY_BATCH_SIZE = int(os.getenv("CART_EXPIRY_BATCH_SIZE", "500"))
+CART_EXPIRY_PAUSE = float(os.getenv("CART_EXPIRY_PAUSE", "0.05"))
+CART_EXPIRY_INTERVAL = float(os.getenv("CART_EXPIRY_INTERVAL", "0"))
+
+# Checked out items are moved to the archive table ARCHIVE_BATCH_SIZE at a
+# time, pausing ARCHIVE_PAUSE seconds between the batches. The workers run
+# the mover every ARCHIVE_INTERVAL seconds, 0 leaves it to: flask carts archive
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "500"))
+ARCHIVE_PAUSE = float(os.getenv("ARCHIVE_PAUSE", "0.05"))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", "0"))
+
+# Keyset pagination for list endpoints
+DEFAULT_PAGE_SIZE = int(os.getenv("DEFAULT_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", "1000"))
+
+# Rows fetched per round trip when streaming the export
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+# Largest number of items accepted by the batch add endpoint
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "100"))
+
+# Largest number of shopcarts added up by one batch summary request
+MAX_SUMMARY_CARTS = int(os.getenv("MAX_SUMMARY_CARTS", "100"))
+
+# Read-through cache for cart reads: none, memory or redis, the memory
+# cache is only kept right with a single worker process
+CACHE_BACKEND = os.getenv("CACHE_BACKEND", "none")
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "10000"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "30"))
+CACHE_NEGATIVE_TTL = float(os.getenv("CACHE_NEGATIVE_TTL", "5"))
+# Seconds a removed key cannot be filled again, longer than any read of the
+# database takes so a read that started before a write cannot cache its result
+CACHE_TOMBSTONE_TTL = float(os.getenv("CACHE_TOMBSTONE_TTL", "5"))
+CACHE_REDIS_URL = os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0")
+
+# JSON writer of the read endpoints: json, or orjson for compact output
+JSON_BACKEND = os.getenv("JSON_BACKEND", "json")
+
+# Requests running more queries than this are logged as a warning
+QUERY_COUNT_WARNING = int(os.getenv("QUERY_COUNT_WARNING", "20"))
+
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "sup3r-s3cr3t")
 LOGGING_LEVEL = logging.INFO
@@ -1,6 +1,69 @@
+"""
+Gunicorn configuration
+
+Every setting can be changed from the environment:
+    WEB_CONCURRENCY - worker processes, defaults to 2 * CPUs + 1
+    GUNICORN_WORKER_CLASS - sync, gthread or gevent, defaults to gthread
+    GUNICORN_THREADS - threads per gthread worker
+    GUNICORN_WORKER_CONNECTIONS - concurrent requests per gevent worker
+    GUNICORN_PRELOAD - make the app once in the master and fork the workers
+        with it, defaults to true except for gevent workers
+    PROMETHEUS_MULTIPROC_DIR - where workers write their metrics, emptied at start
+
+Each worker has its own connection pool, keep DB_POOL_SIZE + DB_MAX_OVERFLOW
+at or above the threads of a worker and the total across all workers below
+the connection limit of the database.
+"""
+import multiprocessing
 import os
+import shutil
+import sys
+import tempfile
 
 PORT = os.getenv("PORT", "5000")
 bind = "0.0.0.0:" + PORT
-workers = 1
-log_level = "info"
\ No newline at end of file
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gthread")
+threads = int(os.getenv("GUNICORN_THREADS", "4"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "100"))
+# gevent patches the standard library in the workers, after a preloaded app
+# would have imported it unpatched
+preload_app = os.getenv(
+    "GUNICORN_PRELOAD", "false" if worker_class == "gevent" else "true"
+).lower() in ("1", "true", "yes")
+log_level = "info"
+
+# set before the app imports prometheus_client so every worker writes its
+# samples to files that /metrics adds up
+metrics_dir = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "shopcarts-metrics")
+)
+# a preloaded app makes its metrics before on_starting runs
+os.makedirs(metrics_dir, exist_ok=True)
+
+
+def on_starting(server):
+    """ Removes the metrics left by the workers of an earlier run """
+    if os.getenv("CACHE_BACKEND") == "memory" and server.cfg.workers > 1:
+        # a worker does not see the writes of the others in its own cache
+        sys.exit("CACHE_BACKEND=memory needs WEB_CONCURRENCY=1, use CACHE_BACKEND=redis with more workers")
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def post_fork(server, worker):
+    """ Drops database connections the worker inherited from a preloaded master """
+    if worker_class == "gevent":
+        # let psycopg2 yield to other greenlets while it waits on the database
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    if "service" in sys.modules:
+        from service import app
+        from service.models import dispose_engine
+        dispose_engine(app)
+
+
+def child_exit(server, worker):
+    """ Stops reporting the live gauges of a worker that exited """
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
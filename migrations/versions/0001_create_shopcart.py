@@ -0,0 +1,36 @@
+"""create the shopcart table
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-17 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # databases made by the old db.create_all() at boot already have the table
+    if not op.get_context().as_sql and 'shopcart' in sa.inspect(op.get_bind()).get_table_names():
+        return
+    op.create_table(
+        'shopcart',
+        sa.Column('shopcart_id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('product_id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('quantity', sa.Integer(), nullable=False),
+        sa.Column('price', sa.Float(), nullable=False),
+        sa.Column('time_added', sa.DateTime(), nullable=False),
+        sa.Column('checkout', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('shopcart_id', 'product_id')
+    )
+
+
+def downgrade():
+    op.drop_table('shopcart')
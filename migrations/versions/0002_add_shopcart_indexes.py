@@ -0,0 +1,34 @@
+"""add indexes for product lookups and stale cart scans
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-17 09:30:00.000000
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_shopcart_product_id_shopcart_id', ['product_id', 'shopcart_id']),
+    ('ix_shopcart_checkout_time_added', ['checkout', 'time_added']),
+]
+
+
+def upgrade():
+    # CONCURRENTLY builds the index without locking out writes on a live
+    # table, but Postgres does not allow it inside a transaction
+    with op.get_context().autocommit_block():
+        for name, columns in INDEXES:
+            op.create_index(name, 'shopcart', columns, postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, _ in INDEXES:
+            op.drop_index(name, table_name='shopcart', postgresql_concurrently=True)
@@ -0,0 +1,30 @@
+"""create the shopcart_revision table
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-17 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # carts without a row are at revision 0, so nothing needs backfilling
+    op.create_table(
+        'shopcart_revision',
+        sa.Column('shopcart_id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('revision', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('shopcart_id')
+    )
+
+
+def downgrade():
+    op.drop_table('shopcart_revision')
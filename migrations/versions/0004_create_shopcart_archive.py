@@ -0,0 +1,41 @@
+"""create the shopcart_archive table for checked out items
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-17 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # an item checked out again after it was archived is archived once more,
+    # so the items are keyed by archive_id and looked up by cart and product
+    op.create_table(
+        'shopcart_archive',
+        sa.Column('archive_id', sa.BigInteger().with_variant(sa.Integer(), 'sqlite'), nullable=False),
+        sa.Column('shopcart_id', sa.Integer(), nullable=False),
+        sa.Column('product_id', sa.Integer(), nullable=False),
+        sa.Column('quantity', sa.Integer(), nullable=False),
+        sa.Column('price', sa.Float(), nullable=False),
+        sa.Column('time_added', sa.DateTime(), nullable=False),
+        sa.Column('checkout', sa.Integer(), nullable=False),
+        sa.Column('archived_at', sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint('archive_id')
+    )
+    op.create_index(
+        'ix_shopcart_archive_shopcart_id_product_id', 'shopcart_archive', ['shopcart_id', 'product_id']
+    )
+
+
+def downgrade():
+    op.drop_index('ix_shopcart_archive_shopcart_id_product_id', table_name='shopcart_archive')
+    op.drop_table('shopcart_archive')
@@ -3,42 +3,66 @@ Package: service
 Package for the application models and service routes
 This module creates and configures the Flask app and sets up the logging
 and SQL database
+
+create_app() makes a configured app. Making one does not touch the
+database: the connection pool connects on the first query, and the tables
+are made by the migrations with: flask db upgrade
+
+app is the app made at import, which gunicorn and flask run serve. Under
+gunicorn with preload_app the master makes it once and the workers fork
+with it ready.
 """
-import os
-import sys
 import logging
 from flask import Flask
 
-# Create Flask application
-app = Flask(__name__)
-app.config.from_object("config")
 
-# Import the rutes After the Flask app is created
-from service import routes, models, error_handlers
+def create_app(config=None):
+    """
+    Creates and configures the Flask app
+
+    Args:
+        config (dict): settings to use over the ones in config.py
+    """
+    flask_app = Flask(__name__)
+    flask_app.config.from_object("config")
+    if config:
+        flask_app.config.update(config)
+
+    # Import the routes After the Flask app is created
+    from service import routes, models, error_handlers, metrics, encoders, resilience
+    from service import commands, expiry, archive
 
-# Set up logging for production
-if __name__ != "__main__":
+    models.init_db(flask_app)
+    routes.init_app(flask_app)
+    error_handlers.init_app(flask_app)
+    metrics.init_app(flask_app)
+    encoders.init_app(flask_app)
+    resilience.init_app(flask_app)
+    commands.init_app(flask_app)
+    expiry.init_app(flask_app)
+    archive.init_app(flask_app)
+    init_logging(flask_app)
+
+    flask_app.logger.info(70 * "*")
+    flask_app.logger.info("  S H O P C A R T   S E R V I C E   R U N N I N G  ".center(70, "*"))
+    flask_app.logger.info(70 * "*")
+    flask_app.logger.info("Service inititalized!")
+    return flask_app
+
+
+def init_logging(flask_app):
+    """ Set up logging for production """
     gunicorn_logger = logging.getLogger("gunicorn.error")
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
-    app.logger.propagate = False
+    flask_app.logger.handlers = gunicorn_logger.handlers
+    flask_app.logger.setLevel(gunicorn_logger.level)
+    flask_app.logger.propagate = False
     # Make all log formats consistent
     formatter = logging.Formatter(
         "[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z"
     )
-    for handler in app.logger.handlers:
+    for handler in flask_app.logger.handlers:
         handler.setFormatter(formatter)
-    app.logger.info("Logging handler established")
-
-app.logger.info(70 * "*")
-app.logger.info("  S H O P C A R T   S E R V I C E   R U N N I N G  ".center(70, "*"))
-app.logger.info(70 * "*")
+    flask_app.logger.info("Logging handler established")
 
-try:
-    routes.init_db()  # make our sqlalchemy tables
-except Exception as error:
-    app.logger.critical("%s: Cannot continue", error)
-    # gunicorn requires exit code 4 to stop spawning workers when they die
-    sys.exit(4)
 
-app.logger.info("Service inititalized!")
+app = create_app()
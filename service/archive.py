@@ -0,0 +1,78 @@
+"""
+Archive of checked out items
+
+The live shopcart table only holds the carts that are still open: checked
+out items are moved to the shopcart_archive table, the oldest first, in
+batches of ARCHIVE_BATCH_SIZE. Each batch is its own short transaction that
+deletes the items, writes them to the archive and moves the revision of
+their carts, on Postgres the items a request has locked are skipped. The
+mover pauses ARCHIVE_PAUSE seconds between the batches and moves every
+shard in turn.
+
+The reads of a cart, an item, the list, the export and the summaries only
+cover archived items when asked with ?include_archived=true, so the
+checked_out totals of a summary drop as its items are archived.
+
+One runner at a time goes through service.jobs.single_runner. With
+ARCHIVE_INTERVAL set the workers run the mover that often, see
+service.jobs. Otherwise run it with: flask carts archive
+"""
+import logging
+import time
+from flask import current_app
+from service import jobs
+from service.metrics import ARCHIVE_RUNS, ARCHIVED_ITEMS
+from service.models import Shopcart, db
+
+logger = logging.getLogger("flask.app")
+
+# the key of the advisory lock, "arch" in ASCII
+ARCHIVE_LOCK_ID = 0x61726368
+
+
+def archive_carts(batch_size=None):
+    """
+    Moves the checked out items of every shard to the archive, in an app context
+
+    Args:
+        batch_size (int): the items moved per transaction, ARCHIVE_BATCH_SIZE by default
+    Returns:
+        the items moved on each shard by shard name, None when another
+        runner holds the lock
+    """
+    config = current_app.config
+    batch_size = batch_size or config["ARCHIVE_BATCH_SIZE"]
+    shards = current_app.extensions["shards"]
+    with jobs.single_runner(shards.engine(shards.names[0]), ARCHIVE_LOCK_ID) as acquired:
+        if not acquired:
+            logger.info("Archiving skipped, another runner holds the lock")
+            ARCHIVE_RUNS.labels("skipped").inc()
+            return None
+        counts = {}
+        try:
+            for name in shards.names:
+                with shards.use(db.session(), name):
+                    counts[name] = move(batch_size, config["ARCHIVE_PAUSE"])
+        except Exception:
+            ARCHIVE_RUNS.labels("failed").inc()
+            raise
+    ARCHIVE_RUNS.labels("completed").inc()
+    logger.info("Archived %d checked out items", sum(counts.values()))
+    return counts
+
+
+def move(batch_size, pause):
+    """ Moves the checked out items batch by batch, returns how many """
+    moved = 0
+    while True:
+        keys = Shopcart.archive_batch(batch_size)
+        moved += len(keys)
+        ARCHIVED_ITEMS.inc(len(keys))
+        if len(keys) < batch_size:
+            return moved
+        time.sleep(pause)
+
+
+def init_app(app):
+    """ Schedules the mover in the workers when ARCHIVE_INTERVAL is set """
+    jobs.schedule(app, "cart-archive", app.config["ARCHIVE_INTERVAL"], archive_carts)
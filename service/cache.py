@@ -0,0 +1,277 @@
+"""
+Cache for Shopcart reads
+
+Shopcart.find_row and Shopcart.find_rows_by_shopcart_id read through the cache,
+Shopcart.find and Shopcart.find_by_shopcart_id build their items from them, and
+every write removes the entries it touches. Cached values are the serialized
+items, with None or [] remembered for a short time when nothing was found.
+
+A read fills the cache with fill(), which never replaces an entry and does
+nothing for CACHE_TOMBSTONE_TTL seconds after the key was removed: a read
+that loaded the items before a write committed would otherwise cache them
+after the write removed the key.
+
+Backends
+--------
+NullCache - caching is turned off
+MemoryCache - bounded LRU cache with a TTL, held in the worker process
+RedisCache - cache shared by every worker, kept in a Redis server
+
+The cache of an app is kept in app.extensions["cache"].
+"""
+import json
+import logging
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from service.metrics import CACHE_EVICTIONS, CACHE_REQUESTS
+
+logger = logging.getLogger("flask.app")
+
+# Returned by get() when the key is not in the cache
+MISS = object()
+
+# Kept in Redis for a removed key, see NullCache.delete
+TOMBSTONE = b"~"
+
+
+class NullCache:
+    """ A cache that never holds anything, used when caching is turned off """
+
+    backend = "none"
+    enabled = False
+
+    def __init__(self, ttl=30, negative_ttl=5, tombstone_ttl=5):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.tombstone_ttl = tombstone_ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Returns the cached value for key, or MISS """
+        value = self._get(key)
+        if value is MISS:
+            self.misses += 1
+            CACHE_REQUESTS.labels(self.backend, "miss").inc()
+        else:
+            self.hits += 1
+            CACHE_REQUESTS.labels(self.backend, "hit").inc()
+        return value
+
+    def set(self, key, value):
+        """ Caches a value, empty values are kept for the shorter negative TTL """
+        self._set(key, value, self.ttl if value else self.negative_ttl)
+
+    def fill(self, key, value):
+        """ Caches a value read from the database unless the key is cached or was just removed """
+        self._add(key, value, self.ttl if value else self.negative_ttl)
+
+    def delete(self, *keys):
+        """ Removes keys from the cache, they are not filled again for the tombstone TTL """
+
+    def clear(self):
+        """ Removes everything from the cache """
+
+    def size(self):
+        """ Returns the number of cached entries """
+        return 0
+
+    def stats(self):
+        """ Returns the cache counters """
+        return {
+            "backend": self.backend,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": self.size(),
+        }
+
+    def _get(self, key):
+        return MISS
+
+    def _set(self, key, value, ttl):
+        pass
+
+    def _add(self, key, value, ttl):
+        pass
+
+
+class MemoryCache(NullCache):
+    """
+    A least recently used cache held in the worker process
+
+    Each worker has its own copy and only removes the entries of its own
+    writes, another worker keeps serving its copy, and the ETag of its
+    cached revision, until the entry expires. Only use it with a single
+    worker, gunicorn.conf.py refuses to start more than one with it.
+    """
+
+    backend = "memory"
+    enabled = True
+
+    def __init__(self, max_size=10000, ttl=30, negative_ttl=5, tombstone_ttl=5):
+        super().__init__(ttl, negative_ttl, tombstone_ttl)
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        # when each removed key may be filled again
+        self._tombstones = {}
+        self._lock = threading.Lock()
+
+    def delete(self, *keys):
+        with self._lock:
+            now = time.monotonic()
+            for key in keys:
+                self._entries.pop(key, None)
+                self._tombstones[key] = now + self.tombstone_ttl
+            if len(self._tombstones) > self.max_size:
+                self._tombstones = {key: until for key, until in self._tombstones.items() if until > now}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tombstones.clear()
+
+    def size(self):
+        return len(self._entries)
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISS
+            expires, value = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return MISS
+            self._entries.move_to_end(key)
+            return value
+
+    def _set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._store(key, value, ttl)
+
+    def _add(self, key, value, ttl):
+        with self._lock:
+            now = time.monotonic()
+            if self._tombstones.get(key, 0) > now:
+                return
+            self._tombstones.pop(key, None)
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                return
+            self._store(key, value, ttl)
+
+    def _store(self, key, value, ttl):
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+            CACHE_EVICTIONS.inc()
+
+
+class RedisCache(NullCache):
+    """
+    A cache shared by every worker, kept in a Redis server
+
+    Size and eviction are left to the server, configure it with maxmemory
+    and maxmemory-policy allkeys-lru. A Redis error is logged and treated
+    as a miss so the database keeps serving requests.
+    """
+
+    backend = "redis"
+    enabled = True
+
+    def __init__(self, client, ttl=30, negative_ttl=5, tombstone_ttl=5, prefix="shopcarts:"):
+        super().__init__(ttl, negative_ttl, tombstone_ttl)
+        self.client = client
+        self.prefix = prefix
+
+    def delete(self, *keys):
+        if not keys:
+            return
+        try:
+            pipeline = self.client.pipeline(transaction=False)
+            for key in keys:
+                pipeline.set(self.prefix + key, TOMBSTONE, px=int(self.tombstone_ttl * 1000))
+            pipeline.execute()
+        except self._errors() as error:
+            logger.error("Cache delete failed: %s", error)
+
+    def clear(self):
+        try:
+            for key in self.client.scan_iter(self.prefix + "*"):
+                self.client.delete(key)
+        except self._errors() as error:
+            logger.error("Cache clear failed: %s", error)
+
+    def size(self):
+        try:
+            return self.client.dbsize()
+        except self._errors() as error:
+            logger.warning("Cache size failed: %s", error)
+            return None
+
+    def stats(self):
+        stats = super().stats()
+        try:
+            stats["evictions"] = self.client.info("stats")["evicted_keys"]
+        except self._errors():
+            stats["evictions"] = None
+        return stats
+
+    def _get(self, key):
+        try:
+            data = self.client.get(self.prefix + key)
+        except self._errors() as error:
+            logger.warning("Cache get failed: %s", error)
+            return MISS
+        return MISS if data is None or data == TOMBSTONE else json.loads(data)
+
+    def _set(self, key, value, ttl):
+        try:
+            self.client.set(self.prefix + key, json.dumps(value), px=int(ttl * 1000))
+        except self._errors() as error:
+            logger.warning("Cache set failed: %s", error)
+
+    def _add(self, key, value, ttl):
+        try:
+            # the tombstone of a removed key is kept
+            self.client.set(self.prefix + key, json.dumps(value), px=int(ttl * 1000), nx=True)
+        except self._errors() as error:
+            logger.warning("Cache fill failed: %s", error)
+
+    @staticmethod
+    def _errors():
+        import redis
+        return redis.RedisError
+
+
+def create_cache(config):
+    """ Creates the cache backend named by CACHE_BACKEND """
+    backend = config.get("CACHE_BACKEND", "none")
+    ttl = config.get("CACHE_TTL", 30)
+    negative_ttl = config.get("CACHE_NEGATIVE_TTL", 5)
+    tombstone_ttl = config.get("CACHE_TOMBSTONE_TTL", 5)
+    logger.info("Using %s cache", backend)
+    if backend == "memory":
+        return MemoryCache(config.get("CACHE_MAX_SIZE", 10000), ttl, negative_ttl, tombstone_ttl)
+    if backend == "redis":
+        import redis
+        client = redis.Redis.from_url(config["CACHE_REDIS_URL"], socket_timeout=0.5)
+        return RedisCache(client, ttl, negative_ttl, tombstone_ttl)
+    return NullCache(ttl, negative_ttl, tombstone_ttl)
+
+
+def init_app(app):
+    """ Makes the cache of the app """
+    app.extensions["cache"] = create_cache(app.config)
+
+
+def get_cache():
+    """ Returns the cache of the current app """
+    return current_app.extensions["cache"]
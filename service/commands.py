@@ -0,0 +1,141 @@
+"""
+Command line tools of the Shopcarts Service
+
+Run them with the app of FLASK_APP, like the migrations:
+
+    flask shards rebalance [--dry-run] [--batch-size N]
+        moves every cart that is not on the shard the hash ring picks for it
+        to that shard, see service.sharding
+
+    flask carts expire [--dry-run] [--days D] [--batch-size N]
+        removes the items that were never checked out and were added more
+        than CART_EXPIRY_DAYS ago, see service.expiry
+
+    flask carts archive [--batch-size N]
+        moves the checked out items to the archive, see service.archive
+"""
+import logging
+from collections import Counter
+import click
+from flask import current_app
+from flask.cli import AppGroup
+from sqlalchemy.exc import IntegrityError
+from service.archive import archive_carts
+from service.expiry import expire_carts
+from service.metrics import SHARD_MOVES
+from service.models import Shopcart, ShopcartArchive, ShopcartRevision, db, move_cart
+
+logger = logging.getLogger("flask.app")
+
+shards_cli = AppGroup("shards", help="Manage the shards of the carts.")
+carts_cli = AppGroup("carts", help="Maintain the carts.")
+
+
+def list_carts(engine, batch_size):
+    """ Yields the shopcart id of every cart with items, archived items or a revision in a database, batch_size per query """
+    columns = [
+        Shopcart.__table__.c.shopcart_id,
+        ShopcartArchive.__table__.c.shopcart_id,
+        ShopcartRevision.__table__.c.shopcart_id,
+    ]
+    after = None
+    while True:
+        selects = [db.select([column]) for column in columns]
+        if after is not None:
+            selects = [select.where(column > after) for select, column in zip(selects, columns)]
+        carts = db.union(*selects).alias("carts")
+        statement = db.select([carts.c.shopcart_id]).order_by(carts.c.shopcart_id).limit(batch_size)
+        with engine.connect() as connection:
+            batch = [row.shopcart_id for row in connection.execute(statement)]
+        yield from batch
+        if len(batch) < batch_size:
+            return
+        after = batch[-1]
+
+
+def rebalance(shards, batch_size, dry_run=False):
+    """
+    Moves every cart to the shard that owns it, one cart per transaction
+
+    Args:
+        shards (ShardSet): the shards of the app
+        batch_size (int): the carts listed per query
+        dry_run (bool): only count the carts that would move
+    Returns:
+        a Counter of the carts moved by (source, target) shard, and the
+        carts left in place because they changed during the move
+    """
+    moves = Counter()
+    skipped = []
+    for source in shards.names:
+        engine = shards.engine(source)
+        for shopcart_id in list_carts(engine, batch_size):
+            target = shards.shard_for(shopcart_id)
+            if target == source:
+                continue
+            if not dry_run:
+                try:
+                    if not move_cart(engine, shards.engine(target), shopcart_id):
+                        # a worker moved it when it was used
+                        continue
+                except IntegrityError as error:
+                    # an item was added on the target while the cart was copied
+                    logger.warning("Shopcart %d not moved, run again: %s", shopcart_id, error.orig)
+                    skipped.append(shopcart_id)
+                    continue
+                SHARD_MOVES.labels("rebalance").inc()
+            moves[source, target] += 1
+    return moves, skipped
+
+
+@shards_cli.command("rebalance")
+@click.option("--dry-run", is_flag=True, help="Only count the carts that would move.")
+@click.option("--batch-size", type=int, default=None, help="Carts listed per query.")
+def rebalance_command(dry_run, batch_size):
+    """Move every cart to the shard that owns it."""
+    shards = current_app.extensions["shards"]
+    batch_size = batch_size or current_app.config["SHARD_REBALANCE_BATCH_SIZE"]
+    moves, skipped = rebalance(shards, batch_size, dry_run=dry_run)
+    verb = "Would move" if dry_run else "Moved"
+    for (source, target), count in sorted(moves.items()):
+        click.echo("{} {} carts from {} to {}".format(verb, count, source, target))
+    click.echo("{} {} carts over {} shards".format(verb, sum(moves.values()), len(shards.names)))
+    if skipped:
+        click.echo("{} carts changed during the move, run again: {}".format(len(skipped), skipped))
+    elif not dry_run and shards.previous is not None:
+        click.echo("Every cart is on its shard, unset DB_SHARD_PREVIOUS_COUNT and restart the workers")
+
+
+@carts_cli.command("expire")
+@click.option("--dry-run", is_flag=True, help="Only count the items that would be removed.")
+@click.option("--days", type=float, default=None, help="Age of the items to remove.")
+@click.option("--batch-size", type=int, default=None, help="Items removed per transaction.")
+def expire_command(dry_run, days, batch_size):
+    """Remove the abandoned items of every cart."""
+    counts = expire_carts(days=days, batch_size=batch_size, dry_run=dry_run)
+    if counts is None:
+        click.echo("Another runner is expiring the carts")
+        return
+    verb = "Would remove" if dry_run else "Removed"
+    for name, count in counts.items():
+        click.echo("{} {} items from {}".format(verb, count, name))
+    click.echo("{} {} items in total".format(verb, sum(counts.values())))
+
+
+@carts_cli.command("archive")
+@click.option("--batch-size", type=int, default=None, help="Items moved per transaction.")
+def archive_command(batch_size):
+    """Move the checked out items to the archive."""
+    counts = archive_carts(batch_size=batch_size)
+    if counts is None:
+        click.echo("Another runner is archiving the carts")
+        return
+    for name, count in counts.items():
+        click.echo("Archived {} items from {}".format(count, name))
+    click.echo("Archived {} items in total".format(sum(counts.values())))
+
+
+def init_app(app):
+    """ Adds the commands to the flask command of the app """
+    app.cli.add_command(shards_cli)
+    app.cli.add_command(carts_cli)
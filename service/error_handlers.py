@@ -14,14 +14,22 @@
 """
 Module: error_handlers
 """
-from flask import jsonify
+from flask import current_app as app, jsonify
 from service.models import DataValidationError, DatabaseConnectionError
-from . import app, status
+from service.resilience import unavailable_response
+from . import status
+
+
+def init_app(flask_app):
+    """ Registers the error handlers on an app """
+    flask_app.register_error_handler(DataValidationError, request_validation_error)
+    flask_app.register_error_handler(status.HTTP_500_INTERNAL_SERVER_ERROR, internal_server_error)
+    flask_app.register_error_handler(DatabaseConnectionError, database_connection_error)
+
 
 ######################################################################
 # Error Handlers
 ######################################################################
-@app.errorhandler(DataValidationError)
 def request_validation_error(error):
     """Handles Value Errors from bad data"""
     return bad_request(error)
@@ -81,7 +89,6 @@ def request_validation_error(error):
 #     )
 
 
-@app.errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
 def internal_server_error(error):
     """Handles unexpected server error with 500_SERVER_ERROR"""
     message = str(error)
@@ -95,13 +102,9 @@ def internal_server_error(error):
         status.HTTP_500_INTERNAL_SERVER_ERROR,
     )
 
-# @app.errorhandler(DatabaseConnectionError)
-# def database_connection_error(error):
-#     """ Handles Database Errors from connection attempts """
-#     message = str(error)
-#     app.logger.critical(message)
-#     return {
-#         'status_code': status.HTTP_503_SERVICE_UNAVAILABLE,
-#         'error': 'Service Unavailable',
-#         'message': message
-#     }, status.HTTP_503_SERVICE_UNAVAILABLE
\ No newline at end of file
+def database_connection_error(error):
+    """ Handles Database Errors from connection attempts """
+    message = str(error)
+    app.logger.critical(message)
+    body, code, headers = unavailable_response(error)
+    return jsonify(body), code, headers
@@ -0,0 +1,89 @@
+"""
+Expiry of abandoned carts
+
+Items that were never checked out and were added more than
+CART_EXPIRY_DAYS ago are removed, the oldest first, through the
+(checkout, time_added) index. Each batch of CART_EXPIRY_BATCH_SIZE items is
+its own short transaction that also moves the revision of the carts it
+touched, on Postgres the items a request has locked are skipped, and the
+job pauses CART_EXPIRY_PAUSE seconds between the batches so the requests
+never wait long on it. Every shard is expired in turn.
+
+One runner: a run goes through service.jobs.single_runner, a run that
+finds another one holding the lock is skipped, so any number of workers or
+cron jobs can start it.
+
+Scheduling: with CART_EXPIRY_INTERVAL set the workers run it that often,
+see service.jobs. Otherwise run it with: flask carts expire
+"""
+import logging
+import time
+from datetime import datetime, timedelta
+from flask import current_app
+from service import jobs
+from service.metrics import EXPIRED_ITEMS, EXPIRY_LAST_SUCCESS, EXPIRY_RUNS
+from service.models import Shopcart, db
+
+logger = logging.getLogger("flask.app")
+
+# the key of the advisory lock, "cart" in ASCII
+EXPIRY_LOCK_ID = 0x63617274
+
+
+def expire_carts(days=None, batch_size=None, dry_run=False):
+    """
+    Removes the abandoned items of every shard, in an app context
+
+    Args:
+        days (float): the age of the items to remove, CART_EXPIRY_DAYS by default
+        batch_size (int): the items removed per transaction, CART_EXPIRY_BATCH_SIZE by default
+        dry_run (bool): only count the items that would be removed
+    Returns:
+        the items removed, or counted, on each shard by shard name, None
+        when another runner holds the lock
+    """
+    config = current_app.config
+    days = config["CART_EXPIRY_DAYS"] if days is None else days
+    batch_size = batch_size or config["CART_EXPIRY_BATCH_SIZE"]
+    # time_added is in the local time of the service
+    cutoff = datetime.now() - timedelta(days=days)
+    shards = current_app.extensions["shards"]
+    with jobs.single_runner(shards.engine(shards.names[0]), EXPIRY_LOCK_ID) as acquired:
+        if not acquired:
+            logger.info("Cart expiry skipped, another runner holds the lock")
+            EXPIRY_RUNS.labels("skipped").inc()
+            return None
+        logger.info("Expiring cart items added before %s%s", cutoff.isoformat(), " (dry run)" if dry_run else "")
+        counts = {}
+        try:
+            for name in shards.names:
+                with shards.use(db.session(), name):
+                    if dry_run:
+                        counts[name] = Shopcart.count_expired(cutoff)
+                    else:
+                        counts[name] = purge(cutoff, batch_size, config["CART_EXPIRY_PAUSE"])
+        except Exception:
+            EXPIRY_RUNS.labels("failed").inc()
+            raise
+    EXPIRY_RUNS.labels("dry_run" if dry_run else "completed").inc()
+    if not dry_run:
+        EXPIRY_LAST_SUCCESS.set_to_current_time()
+    logger.info("%s %d expired cart items", "Found" if dry_run else "Removed", sum(counts.values()))
+    return counts
+
+
+def purge(cutoff, batch_size, pause):
+    """ Removes the items added before cutoff batch by batch, returns how many """
+    removed = 0
+    while True:
+        keys = Shopcart.expire_batch(cutoff, batch_size)
+        removed += len(keys)
+        EXPIRED_ITEMS.inc(len(keys))
+        if len(keys) < batch_size:
+            return removed
+        time.sleep(pause)
+
+
+def init_app(app):
+    """ Schedules the expiry in the workers when CART_EXPIRY_INTERVAL is set """
+    jobs.schedule(app, "cart-expiry", app.config["CART_EXPIRY_INTERVAL"], expire_carts)
@@ -0,0 +1,96 @@
+"""
+Background jobs of the workers
+
+A job is a function run in an app context, like the cart expiry or the
+archive mover. schedule() runs it every interval seconds in a daemon thread
+of each worker, started on the first request the worker handles so a
+worker forked from a preloaded master starts its own.
+
+single_runner() lets one runner of a job through at a time across all the
+workers and cron jobs: a Postgres advisory lock on the primary, held by the
+connection of the run so it goes with it if the process dies. Other
+databases only get a lock within the process.
+"""
+import logging
+import os
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from service.models import db
+
+logger = logging.getLogger("flask.app")
+
+_process_locks = defaultdict(threading.Lock)
+
+
+def process_lock(lock_id):
+    """ Returns the lock of a job within this process """
+    return _process_locks[lock_id]
+
+
+@contextmanager
+def single_runner(engine, lock_id):
+    """ Yields True to the one runner holding the lock of a job and False to the others """
+    if engine.dialect.name != "postgresql":
+        lock = process_lock(lock_id)
+        acquired = lock.acquire(blocking=False)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                lock.release()
+        return
+    with engine.connect() as connection:
+        acquired = connection.execute(db.select([db.func.pg_try_advisory_lock(lock_id)])).scalar()
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                connection.execute(db.select([db.func.pg_advisory_unlock(lock_id)]))
+
+
+class Scheduler:
+    """ Runs a job every interval seconds in a daemon thread of the worker """
+
+    def __init__(self, app, name, interval, job):
+        self.app = app
+        self.name = name
+        self.interval = interval
+        self.job = job
+        self.pid = None
+        self.stopped = threading.Event()
+        self._lock = threading.Lock()
+
+    def start(self):
+        """ Starts the thread once per process, a forked worker starts its own """
+        if self.pid == os.getpid():
+            return
+        with self._lock:
+            if self.pid == os.getpid():
+                return
+            self.pid = os.getpid()
+            self.stopped.clear()
+            thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+            thread.start()
+
+    def stop(self):
+        """ Ends the thread after its current run """
+        self.stopped.set()
+
+    def run(self):
+        """ The loop of the thread """
+        while not self.stopped.wait(self.interval):
+            with self.app.app_context():
+                try:
+                    self.job()
+                except Exception:  # pylint: disable=broad-except
+                    logger.exception("Job %s failed", self.name)
+
+
+def schedule(app, name, interval, job):
+    """ Runs job every interval seconds in the workers of the app, not at all when interval is 0 """
+    if interval <= 0:
+        return
+    scheduler = Scheduler(app, name, interval, job)
+    app.extensions.setdefault("jobs", {})[name] = scheduler
+    app.before_request(scheduler.start)
@@ -0,0 +1,237 @@
+"""
+Prometheus metrics for the Shopcarts Service
+
+Counts requests, database queries, retries and cache lookups and serves them
+on GET /metrics in the Prometheus text format.
+
+The queries of each request are also counted. The count and the database
+time go back to the client in a Server-Timing header and into the log, with
+a warning when a request runs more than QUERY_COUNT_WARNING queries, which
+usually means a query inside a loop.
+
+Under gunicorn every worker writes its samples to files in
+PROMETHEUS_MULTIPROC_DIR and /metrics adds up the files of all the workers,
+so a scrape sees the whole service whichever worker answers it. Without that
+variable the metrics of the single process are served.
+
+Metrics
+-------
+shopcart_http_requests_total - requests by resource, method and status
+shopcart_http_request_duration_seconds - request latency by resource and method
+shopcart_db_queries_total - SQL statements by verb
+shopcart_db_query_duration_seconds - SQL statement latency by verb
+shopcart_retries_total - retries of the model methods after a transient database error
+shopcart_db_circuit_state - the database circuit breaker, 0 closed, 1 half open, 2 open
+shopcart_db_circuit_transitions_total - circuit breaker changes by from and to state
+shopcart_db_circuit_rejections_total - calls failed fast by an open circuit breaker
+shopcart_db_reads_total - read-only model methods by the database they read, primary or a replica
+shopcart_db_replica_ejections_total - read replicas taken out of rotation by replica
+shopcart_db_shard_calls_total - model calls, or the part of a call spanning carts, run on each shard
+shopcart_db_shard_moves_total - carts moved to the shard that owns them, by what moved them
+shopcart_expired_items_total - abandoned cart items removed by the expiry job
+shopcart_expiry_runs_total - runs of the expiry job by outcome
+shopcart_expiry_last_success_timestamp_seconds - when the expiry job last finished
+shopcart_archived_items_total - checked out items moved to the archive
+shopcart_archive_runs_total - runs of the archive mover by outcome
+shopcart_cache_requests_total - cache lookups by backend and result
+shopcart_cache_evictions_total - entries dropped from a full memory cache
+"""
+import os
+import time
+from flask import Response, current_app, g, has_app_context, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    REGISTRY,
+    generate_latest,
+)
+from prometheus_client import multiprocess
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+REQUEST_COUNT = Counter(
+    "shopcart_http_requests_total",
+    "HTTP requests handled",
+    ["resource", "method", "status"],
+)
+REQUEST_LATENCY = Histogram(
+    "shopcart_http_request_duration_seconds",
+    "Time to build the HTTP response",
+    ["resource", "method"],
+)
+DB_QUERIES = Counter(
+    "shopcart_db_queries_total",
+    "SQL statements sent to the database",
+    ["verb"],
+)
+DB_QUERY_LATENCY = Histogram(
+    "shopcart_db_query_duration_seconds",
+    "Time the database took to run a SQL statement",
+    ["verb"],
+    buckets=DB_BUCKETS,
+)
+RETRIES = Counter(
+    "shopcart_retries_total",
+    "Retries of the model methods after a transient database error",
+    ["method"],
+)
+# the worst worker is reported when the files of the workers are added up
+BREAKER_STATE = Gauge(
+    "shopcart_db_circuit_state",
+    "Database circuit breaker state, 0 closed, 1 half open, 2 open",
+    multiprocess_mode="max",
+)
+BREAKER_TRANSITIONS = Counter(
+    "shopcart_db_circuit_transitions_total",
+    "Database circuit breaker state changes",
+    ["from_state", "to_state"],
+)
+BREAKER_REJECTIONS = Counter(
+    "shopcart_db_circuit_rejections_total",
+    "Database calls failed fast by an open circuit breaker",
+)
+REPLICA_READS = Counter(
+    "shopcart_db_reads_total",
+    "Read-only model methods by the database they read",
+    ["target"],
+)
+REPLICA_EJECTIONS = Counter(
+    "shopcart_db_replica_ejections_total",
+    "Read replicas taken out of rotation",
+    ["replica"],
+)
+SHARD_CALLS = Counter(
+    "shopcart_db_shard_calls_total",
+    "Model calls run on each shard",
+    ["shard"],
+)
+SHARD_MOVES = Counter(
+    "shopcart_db_shard_moves_total",
+    "Carts moved to the shard that owns them",
+    ["trigger"],
+)
+EXPIRED_ITEMS = Counter(
+    "shopcart_expired_items_total",
+    "Abandoned cart items removed by the expiry job",
+)
+EXPIRY_RUNS = Counter(
+    "shopcart_expiry_runs_total",
+    "Runs of the expiry job by outcome",
+    ["outcome"],
+)
+EXPIRY_LAST_SUCCESS = Gauge(
+    "shopcart_expiry_last_success_timestamp_seconds",
+    "Unix time the expiry job last finished",
+    multiprocess_mode="max",
+)
+ARCHIVED_ITEMS = Counter(
+    "shopcart_archived_items_total",
+    "Checked out items moved to the archive",
+)
+ARCHIVE_RUNS = Counter(
+    "shopcart_archive_runs_total",
+    "Runs of the archive mover by outcome",
+    ["outcome"],
+)
+CACHE_REQUESTS = Counter(
+    "shopcart_cache_requests_total",
+    "Cache lookups",
+    ["backend", "result"],
+)
+CACHE_EVICTIONS = Counter(
+    "shopcart_cache_evictions_total",
+    "Entries dropped from a full memory cache",
+)
+
+
+def init_app(app):
+    """ Times every request the app handles """
+    app.before_request(_start_timer)
+    app.after_request(_record_request)
+
+
+def render():
+    """ Returns the metrics of every worker in the Prometheus text format """
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def resource_name(app):
+    """ Returns the name of the Resource class serving the request """
+    if request.url_rule is None:
+        return "unmatched"
+    view = app.view_functions.get(request.endpoint)
+    view_class = getattr(view, "view_class", None)
+    return view_class.__name__ if view_class else request.endpoint
+
+
+def _start_timer():
+    g.metrics_start = time.perf_counter()
+    g.query_count = 0
+    g.query_seconds = 0.0
+
+
+def _record_request(response):
+    start = g.pop("metrics_start", None)
+    if start is None:
+        return response
+    elapsed = time.perf_counter() - start
+    resource = resource_name(current_app)
+    REQUEST_COUNT.labels(resource, request.method, response.status_code).inc()
+    REQUEST_LATENCY.labels(resource, request.method).observe(elapsed)
+
+    query_count = g.pop("query_count", 0)
+    query_seconds = g.pop("query_seconds", 0.0)
+    response.headers["Server-Timing"] = server_timing(query_count, query_seconds, elapsed)
+    message = "%s %s: %d queries in %.1f ms, %.1f ms total"
+    args = (request.method, request.path, query_count, query_seconds * 1000, elapsed * 1000)
+    if query_count > current_app.config.get("QUERY_COUNT_WARNING", 20):
+        current_app.logger.warning(message, *args)
+    else:
+        current_app.logger.info(message, *args)
+    return response
+
+
+def server_timing(query_count, query_seconds, elapsed):
+    """ Returns a Server-Timing header value for the queries of a request """
+    return 'db;desc="{} queries";dur={:.2f}, app;dur={:.2f}'.format(
+        query_count, query_seconds * 1000, elapsed * 1000
+    )
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _record_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["metrics_query_start"].pop()
+    verb = statement_verb(statement)
+    DB_QUERIES.labels(verb).inc()
+    DB_QUERY_LATENCY.labels(verb).observe(elapsed)
+    if has_app_context() and "query_count" in g:
+        g.query_count += 1
+        g.query_seconds += elapsed
+
+
+@event.listens_for(Engine, "handle_error")
+def _drop_query(context):
+    starts = context.connection.info.get("metrics_query_start") if context.connection else None
+    if starts:
+        starts.pop()
+
+
+def statement_verb(statement):
+    """ Returns select, insert, update, delete or other for a SQL statement """
+    words = statement.split(None, 1)
+    verb = words[0].lower() if words else "other"
+    return verb if verb in ("select", "insert", "update", "delete") else "other"
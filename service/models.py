@@ -19,43 +19,185 @@ checkout (integer) - checkout status
 """
 import os
 import json
+import itertools
 import logging
-from flask_sqlalchemy import SQLAlchemy
-from retry import retry
-from requests import HTTPError, ConnectionError
+import operator
+from collections import namedtuple
+from flask_migrate import Migrate
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import make_transient_to_detached
+from requests import ConnectionError
 from datetime import datetime
-
-# global variables for retry (must be int)
-RETRY_COUNT = int(os.environ.get("RETRY_COUNT", 10))
-RETRY_DELAY = int(os.environ.get("RETRY_DELAY", 1))
-RETRY_BACKOFF = int(os.environ.get("RETRY_BACKOFF", 2))
+from werkzeug.http import parse_date
+from service.cache import MISS, get_cache
+from service.resilience import DatabaseConnectionError, resilient
+from service import cache, routing, sharding
 
 logger = logging.getLogger("flask.app")
 
 
 
-# Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+# Create the SQLAlchemy object to be initialized later in init_db(), its
+# session sends the reads of GET requests to the read replicas and the
+# statements about one cart to the shard of the cart
+db = routing.RoutingSQLAlchemy(query_class=sharding.ShardQuery)
+
+# Schema changes are versioned scripts in migrations/ applied with: flask db upgrade
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "migrations")
+migrate = Migrate(directory=MIGRATIONS_DIR)
 
 def init_db(app):
     """Initialies the SQLAlchemy app"""
     Shopcart.init_db(app)
 
 
-class DatabaseConnectionError(Exception):
-    """Custom Exception when database connection fails"""
+def dispose_engine(app):
+    """Closes the pooled connections, a forked worker must not share them"""
+    with app.app_context():
+        for bind in [None] + list(app.config.get("SQLALCHEMY_BINDS") or {}):
+            db.get_engine(app, bind=bind).dispose()
+
+
+def parse_time(value):
+    """
+    Returns a datetime for an ISO 8601 or HTTP date string
+
+    Postgres converts both kinds of string itself but SQLite only takes a
+    datetime, so the strings posted by clients are parsed here
+    """
+    if not isinstance(value, str):
+        return value
+    try:
+        parsed = datetime.fromisoformat(value[:-1] if value.endswith("Z") else value)
+    except ValueError:
+        parsed = parse_date(value)
+        if parsed is None:
+            raise ValueError("'{}' is not a date and time".format(value))
+    return parsed.replace(tzinfo=None)
+
+
+def empty_totals():
+    """Returns the totals of a shopcart without items"""
+    return {"item_count": 0, "total_quantity": 0, "total_price": 0.0}
+
+
+def db_call(method, retry=True, read_only=False, by_cart=False):
+    """
+    Retries the transient database errors of a model method behind the
+    circuit breaker, see service.resilience. A read_only method reads from
+    the read replica of a GET request, see service.routing. A by_cart method
+    runs on the shard of its shopcart_id, see service.sharding
+    """
+
+    def decorator(func):
+        if read_only:
+            func = routing.read_only(func, db)
+        if by_cart:
+            func = sharding.routed(func, db)
+        return resilient(method, db.session, retry=retry)(func)
+
+    return decorator
+
+
+def returning_supported():
+    """Returns True when the database can return rows from UPDATE and DELETE"""
+    return db.session.get_bind().dialect.name == "postgresql"
 
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
 
 
+class RevisionMismatchError(Exception):
+    """ Used when a write expects a revision of a Shopcart that is not current """
+
+
+class NegativeQuantityError(Exception):
+    """ Used when a change would take the quantity of an item below zero """
+
+
+class ShopcartRow(namedtuple(
+        "ShopcartRow", ["shopcart_id", "product_id", "quantity", "price", "time_added", "checkout"])):
+    """
+    A read-only Shopcart item loaded with only its columns
+
+    Rows are selected through SQLAlchemy Core, so they skip the identity map
+    and the session bookkeeping of a Shopcart, and cannot be updated or
+    deleted. Use the Shopcart finders to load an item that will be written
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_cache(cls, data):
+        """ Rebuilds a row from the dictionary kept in the cache """
+        return cls(**dict(data, time_added=datetime.fromisoformat(data["time_added"])))
+
+    def serialize(self):
+        """ Serializes a row into the same dictionary as a Shopcart item """
+        return dict(self._asdict(), time_added=self.time_added.isoformat())
+
+
+class ArchivedRow(namedtuple("ArchivedRow", ShopcartRow._fields + ("archive_id",))):
+    """
+    A read-only Shopcart item of a read that also covers the archive, the
+    archive_id of an item that is still open is 0
+    """
+
+    __slots__ = ()
+
+
+# the order of the reads that cover the archive, an open item comes before its archived checkouts
+ARCHIVE_ORDER = operator.attrgetter("shopcart_id", "product_id", "archive_id")
+
+
+class ShopcartRevision(db.Model):
+    """
+    Class that represents the revision of a Shopcart
+
+    The revision goes up by one in the same transaction as every write to
+    the Shopcart's items, a Shopcart with no row is at revision 0
+    """
+
+    shopcart_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    revision = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+class ShopcartArchive(db.Model):
+    """
+    Class that represents a checked out Shopcart item moved out of the live table
+
+    An item checked out again after it was archived is archived once more,
+    so the archive keeps every checkout of an item under its own archive_id
+    """
+
+    __tablename__ = "shopcart_archive"
+    __table_args__ = (
+        db.Index("ix_shopcart_archive_shopcart_id_product_id", "shopcart_id", "product_id"),
+    )
+
+    archive_id = db.Column(db.BigInteger().with_variant(db.Integer, "sqlite"), primary_key=True)
+    shopcart_id = db.Column(db.Integer, nullable=False)
+    product_id = db.Column(db.Integer, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    price = db.Column(db.Float, nullable=False)
+    time_added = db.Column(db.DateTime, nullable=False)
+    checkout = db.Column(db.Integer, nullable=False)
+    archived_at = db.Column(db.DateTime, nullable=False)
+
+
 class Shopcart(db.Model):
     """
     Class that represents a Shopcart
     """
 
-    app = None
+    # Secondary indexes for the product lookups and the stale cart scans,
+    # lookups by shopcart_id are served by the primary key
+    __table_args__ = (
+        db.Index("ix_shopcart_product_id_shopcart_id", "product_id", "shopcart_id"),
+        db.Index("ix_shopcart_checkout_time_added", "checkout", "time_added"),
+    )
 
     # Table Schema
     shopcart_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
@@ -69,50 +211,459 @@ class Shopcart(db.Model):
     def __repr__(self):
         return "Shopcart shopcart_id=[%d]>" % (self.shopcart_id)
 
-    @retry(
-        HTTPError,
-        delay=RETRY_DELAY,
-        backoff=RETRY_BACKOFF,
-        tries=RETRY_COUNT,
-        logger=logger,
-    )
+    @db_call("create", by_cart=True)
     def create(self):
         """
         Creates a Shopcart item in the database
         """
         logger.info("Creating shopcart item %d %d", self.shopcart_id, self.product_id)
+        shopcart_id, product_id = self.shopcart_id, self.product_id
         db.session.add(self)
+        self.bump_revision(shopcart_id)
         db.session.commit()
+        self.invalidate(shopcart_id, [product_id])
 
 
-    @retry(
-        HTTPError,
-        delay=RETRY_DELAY,
-        backoff=RETRY_BACKOFF,
-        tries=RETRY_COUNT,
-        logger=logger,
-    )
-    def update(self):
+    @db_call("upsert", by_cart=True)
+    def upsert(self, merge_quantity=False):
+        """
+        Creates a Shopcart item in the database with one INSERT ... ON CONFLICT
+
+        Args:
+            merge_quantity (bool): when the item is already in the Shopcart add
+                this quantity to it, otherwise the existing item is left unchanged
+        Returns:
+            True if the item was created, False if it was already in the Shopcart
+        """
+        logger.info("Upserting shopcart item %d %d", self.shopcart_id, self.product_id)
+        table = self.__table__
+        values = {column.name: getattr(self, column.name) for column in table.c}
+        if returning_supported():
+            statement = postgresql.insert(table).values(**values)
+            keys = [table.c.shopcart_id, table.c.product_id]
+            if merge_quantity:
+                statement = statement.on_conflict_do_update(
+                    index_elements=keys,
+                    set_={
+                        "quantity": table.c.quantity + statement.excluded.quantity,
+                        "time_added": statement.excluded.time_added,
+                    },
+                )
+            else:
+                statement = statement.on_conflict_do_nothing(index_elements=keys)
+            # xmax is only zero for a row this statement inserted
+            row = db.session.execute(
+                statement.returning(*table.c, db.literal_column("xmax = 0").label("inserted"))
+            ).first()
+            created = row is not None and row.inserted
+        else:
+            key = db.and_(
+                table.c.shopcart_id == self.shopcart_id, table.c.product_id == self.product_id
+            )
+            row = db.session.execute(table.select().where(key)).first()
+            created = row is None
+            if created:
+                db.session.execute(table.insert().values(**values))
+            elif merge_quantity:
+                db.session.execute(
+                    table.update().where(key).values(
+                        quantity=table.c.quantity + self.quantity, time_added=self.time_added
+                    )
+                )
+            if created or merge_quantity:
+                row = db.session.execute(table.select().where(key)).first()
+            else:
+                row = None
+        if row is not None:
+            self.bump_revision(self.shopcart_id)
+        db.session.commit()
+        self.invalidate(self.shopcart_id, [self.product_id])
+        if row is not None:
+            for column in table.c:
+                setattr(self, column.name, row[column.name])
+        return created
+
+    @db_call("update", retry=False, by_cart=True)
+    def update(self, expected_revision=None):
         """
         Updates a Shopcart item in the database
+
+        Args:
+            expected_revision (int): only save if the Shopcart is at this revision
+        Raises:
+            RevisionMismatchError: when the Shopcart is not at expected_revision
         """
         logger.info("Saving %d %d", self.shopcart_id, self.product_id)
+        shopcart_id, product_id = self.shopcart_id, self.product_id
+        self.bump_revision(shopcart_id, expected_revision)
         db.session.commit()
+        self.invalidate(shopcart_id, [product_id])
 
-    @retry(
-        HTTPError,
-        delay=RETRY_DELAY,
-        backoff=RETRY_BACKOFF,
-        tries=RETRY_COUNT,
-        logger=logger,
-    )
-    def delete(self):
-        """ Removes a Shopcart item from the database """
+    @db_call("delete", by_cart=True)
+    def delete(self, expected_revision=None):
+        """
+        Removes a Shopcart item from the database
+
+        Args:
+            expected_revision (int): only remove if the Shopcart is at this revision
+        Raises:
+            RevisionMismatchError: when the Shopcart is not at expected_revision
+        """
         logger.info("Deleting %d %d", self.shopcart_id, self.product_id)
+        shopcart_id, product_id = self.shopcart_id, self.product_id
+        self.bump_revision(shopcart_id, expected_revision)
         db.session.delete(self)
         db.session.commit()
+        self.invalidate(shopcart_id, [product_id])
 
 
+    @classmethod
+    @db_call("adjust_quantity", by_cart=True)
+    def adjust_quantity(cls, shopcart_id, product_id, delta, remove_empty=False):
+        """
+            Adds delta to the quantity of a Shopcart item in the database
+            The new quantity is computed by the UPDATE statement so concurrent
+            adjustments are never lost
+            Args:
+                shopcart_id (int): the shopcart id of the item
+                product_id (int): the product id of the item
+                delta (int): the amount to add, negative to remove
+                remove_empty (bool): delete the item when its quantity drops to zero or below
+            Returns:
+                the adjusted Shopcart item, or None if it is not in the Shopcart
+            Raises:
+                NegativeQuantityError: the quantity would drop below zero and the item is kept
+        """
+        logger.info("Adjusting quantity of %d %d by %d", shopcart_id, product_id, delta)
+        table = cls.__table__
+        key = db.and_(table.c.shopcart_id == shopcart_id, table.c.product_id == product_id)
+        statement = table.update().where(key).values(quantity=table.c.quantity + delta)
+        if not remove_empty:
+            statement = statement.where(table.c.quantity + delta >= 0)
+        if returning_supported():
+            row = db.session.execute(statement.returning(*table.c)).first()
+        elif db.session.execute(statement).rowcount:
+            row = db.session.execute(table.select().where(key)).first()
+        else:
+            row = None
+        if row is None and not remove_empty and db.session.execute(table.select().where(key)).first():
+            db.session.rollback()
+            raise NegativeQuantityError(
+                "Quantity of product {} in shopcart {} cannot drop below zero".format(product_id, shopcart_id)
+            )
+        if row is not None and remove_empty and row.quantity <= 0:
+            logger.info("Deleting %d %d with quantity %d", shopcart_id, product_id, row.quantity)
+            db.session.execute(table.delete().where(db.and_(key, table.c.quantity <= 0)))
+        if row is not None:
+            cls.bump_revision(shopcart_id)
+        db.session.commit()
+        cls.invalidate(shopcart_id, [product_id])
+        return cls(**dict(row)) if row is not None else None
+
+    @classmethod
+    @db_call("checkout_cart", by_cart=True)
+    def checkout_cart(cls, shopcart_id):
+        """
+            Checks out every item in a Shopcart with a single UPDATE statement
+            Args:
+                shopcart_id (int): the shopcart id of the Shopcart to checkout
+            Returns:
+                the updated Shopcart items, empty if the Shopcart has no items
+        """
+        logger.info("Checking out shopcart %d", shopcart_id)
+        table = cls.__table__
+        statement = table.update().where(table.c.shopcart_id == shopcart_id).values(checkout=1)
+        if returning_supported():
+            rows = db.session.execute(statement.returning(*table.c)).fetchall()
+        else:
+            db.session.execute(statement)
+            rows = db.session.execute(
+                table.select().where(table.c.shopcart_id == shopcart_id)
+            ).fetchall()
+        if rows:
+            cls.bump_revision(shopcart_id)
+        db.session.commit()
+        cls.invalidate(shopcart_id, [row.product_id for row in rows])
+        return sorted((cls(**dict(row)) for row in rows), key=lambda item: item.product_id)
+
+    @classmethod
+    @db_call("delete_cart", by_cart=True)
+    def delete_cart(cls, shopcart_id, expected_revision=None):
+        """
+            Removes every item in a Shopcart with a single DELETE statement
+            Args:
+                shopcart_id (int): the shopcart id of the Shopcart to clear
+                expected_revision (int): only clear if the Shopcart is at this revision
+            Returns:
+                the number of items that were removed
+            Raises:
+                RevisionMismatchError: when the Shopcart is not at expected_revision
+        """
+        logger.info("Deleting shopcart %d", shopcart_id)
+        if expected_revision is not None:
+            cls.bump_revision(shopcart_id, expected_revision)
+        table = cls.__table__
+        statement = table.delete().where(table.c.shopcart_id == shopcart_id)
+        if returning_supported():
+            rows = db.session.execute(statement.returning(table.c.product_id)).fetchall()
+        else:
+            rows = db.session.execute(
+                db.select([table.c.product_id]).where(table.c.shopcart_id == shopcart_id)
+            ).fetchall()
+            db.session.execute(statement)
+        if rows and expected_revision is None:
+            cls.bump_revision(shopcart_id)
+        db.session.commit()
+        cls.invalidate(shopcart_id, [row.product_id for row in rows])
+        return len(rows)
+
+    @classmethod
+    @db_call("create_batch", by_cart=True)
+    def create_batch(cls, shopcart_id, items):
+        """
+            Creates many Shopcart items with one multi-row INSERT
+            Items that are already in the Shopcart are left unchanged
+            Args:
+                shopcart_id (int): the shopcart id of the Shopcart to add to
+                items (list): the Shopcart items to create, one per product_id
+            Returns:
+                the set of product ids that were created
+        """
+        logger.info("Creating %d items in shopcart %d", len(items), shopcart_id)
+        if not items:
+            return set()
+        table = cls.__table__
+        rows = [{column.name: getattr(item, column.name) for column in table.c} for item in items]
+        if returning_supported():
+            statement = (
+                postgresql.insert(table)
+                .values(rows)
+                .on_conflict_do_nothing(index_elements=[table.c.shopcart_id, table.c.product_id])
+                .returning(table.c.product_id)
+            )
+            created = {row.product_id for row in db.session.execute(statement)}
+        else:
+            existing = db.session.execute(
+                db.select([table.c.product_id]).where(
+                    db.and_(
+                        table.c.shopcart_id == shopcart_id,
+                        table.c.product_id.in_([row["product_id"] for row in rows]),
+                    )
+                )
+            )
+            existing = {row.product_id for row in existing}
+            rows = [row for row in rows if row["product_id"] not in existing]
+            if rows:
+                db.session.execute(table.insert(), rows)
+            created = {row["product_id"] for row in rows}
+        if created:
+            cls.bump_revision(shopcart_id)
+        db.session.commit()
+        cls.invalidate(shopcart_id, created)
+        return created
+
+    @classmethod
+    @db_call("expire_batch")
+    def expire_batch(cls, cutoff, batch_size):
+        """
+            Removes the oldest items that were never checked out and were
+            added before cutoff, at most batch_size of them in one short
+            transaction, found through the (checkout, time_added) index
+            Args:
+                cutoff (datetime): remove the items added before this time
+                batch_size (int): the most items to remove
+            Returns:
+                the (shopcart_id, product_id) keys of the removed items
+        """
+        table = cls.__table__
+        rows = cls.remove_oldest(db.and_(table.c.checkout == 0, table.c.time_added < cutoff), batch_size)
+        db.session.commit()
+        cls.invalidate_rows(rows)
+        return [(row.shopcart_id, row.product_id) for row in rows]
+
+    @classmethod
+    @db_call("archive_batch")
+    def archive_batch(cls, batch_size):
+        """
+            Moves the oldest checked out items to the archive, at most
+            batch_size of them in one short transaction
+            Args:
+                batch_size (int): the most items to move
+            Returns:
+                the (shopcart_id, product_id) keys of the moved items
+        """
+        rows = cls.remove_oldest(cls.__table__.c.checkout == 1, batch_size)
+        if rows:
+            archived_at = datetime.now()
+            db.session.execute(
+                ShopcartArchive.__table__.insert(),
+                [dict(row._asdict(), archived_at=archived_at) for row in rows],
+            )
+        db.session.commit()
+        cls.invalidate_rows(rows)
+        return [(row.shopcart_id, row.product_id) for row in rows]
+
+    @classmethod
+    def remove_oldest(cls, condition, batch_size):
+        """
+        Deletes the oldest items matching condition, at most batch_size of
+        them, and moves the revision of their Shopcarts inside the current
+        transaction
+
+        Returns:
+            the ShopcartRows of the deleted items
+        """
+        table = cls.__table__
+        oldest = (
+            db.select([table.c.shopcart_id, table.c.product_id])
+            .where(condition)
+            .order_by(table.c.time_added)
+            .limit(batch_size)
+        )
+        columns = [table.c[name] for name in ShopcartRow._fields]
+        if returning_supported():
+            # items a request has locked are left for the next batch
+            statement = table.delete().where(
+                db.tuple_(table.c.shopcart_id, table.c.product_id).in_(
+                    oldest.with_for_update(skip_locked=True)
+                )
+            ).returning(*columns)
+            rows = [ShopcartRow._make(row) for row in db.session.execute(statement)]
+        else:
+            rows = cls.load_rows(cls.select_rows().where(condition).order_by(table.c.time_added).limit(batch_size))
+        carts = {}
+        for row in rows:
+            carts.setdefault(row.shopcart_id, []).append(row.product_id)
+        for shopcart_id, product_ids in sorted(carts.items()):
+            if not returning_supported():
+                db.session.execute(table.delete().where(db.and_(
+                    condition, table.c.shopcart_id == shopcart_id, table.c.product_id.in_(product_ids)
+                )))
+            cls.bump_revision(shopcart_id)
+        return rows
+
+    @classmethod
+    @db_call("count_expired", read_only=True)
+    def count_expired(cls, cutoff):
+        """
+            Returns the number of items expire_batch would remove for cutoff
+            Args:
+                cutoff (datetime): count the items added before this time
+        """
+        table = cls.__table__
+        return db.session.execute(
+            db.select([db.func.count()]).where(
+                db.and_(table.c.checkout == 0, table.c.time_added < cutoff)
+            )
+        ).scalar()
+
+    @classmethod
+    def invalidate(cls, shopcart_id, product_ids):
+        """ Removes a Shopcart and the given items in it from the cache """
+        keys = ["item:{}:{}".format(shopcart_id, product_id) for product_id in product_ids]
+        get_cache().delete("cart:{}".format(shopcart_id), "revision:{}".format(shopcart_id), *keys)
+
+    @classmethod
+    def invalidate_rows(cls, rows):
+        """ Removes the Shopcarts of rows and their items from the cache """
+        carts = {}
+        for row in rows:
+            carts.setdefault(row.shopcart_id, []).append(row.product_id)
+        for shopcart_id, product_ids in carts.items():
+            cls.invalidate(shopcart_id, product_ids)
+
+    @classmethod
+    def bump_revision(cls, shopcart_id, expected=None):
+        """
+        Moves a Shopcart to its next revision inside the current transaction
+
+        Args:
+            shopcart_id (int): the shopcart id of the Shopcart that changed
+            expected (int): only move on if the Shopcart is at this revision
+        Raises:
+            RevisionMismatchError: when the Shopcart is not at the expected
+                revision, the transaction is rolled back
+        """
+        table = ShopcartRevision.__table__
+        key = table.c.shopcart_id == shopcart_id
+        if expected is not None:
+            result = db.session.execute(
+                table.update()
+                .where(db.and_(key, table.c.revision == expected))
+                .values(revision=table.c.revision + 1)
+            )
+            if result.rowcount == 0:
+                # a Shopcart at revision 0 has no revision row yet, the insert
+                # fails when it has one or another first write made it first
+                if expected == 0:
+                    try:
+                        db.session.execute(table.insert().values(shopcart_id=shopcart_id, revision=1))
+                        return
+                    except IntegrityError:
+                        pass
+                db.session.rollback()
+                raise RevisionMismatchError(
+                    "Shopcart {} is not at revision {}".format(shopcart_id, expected)
+                )
+        elif returning_supported():
+            statement = postgresql.insert(table).values(shopcart_id=shopcart_id, revision=1)
+            db.session.execute(
+                statement.on_conflict_do_update(
+                    index_elements=[table.c.shopcart_id],
+                    set_={"revision": table.c.revision + 1},
+                )
+            )
+        else:
+            result = db.session.execute(
+                table.update().where(key).values(revision=table.c.revision + 1)
+            )
+            if result.rowcount == 0:
+                db.session.execute(table.insert().values(shopcart_id=shopcart_id, revision=1))
+
+    @classmethod
+    @db_call("get_revision", read_only=True, by_cart=True)
+    def get_revision(cls, shopcart_id):
+        """
+            Returns the current revision of a Shopcart without loading its items
+            Args:
+                shopcart_id (int): the shopcart id of the Shopcart
+        """
+        key = "revision:{}".format(shopcart_id)
+        revision = get_cache().get(key)
+        if revision is MISS:
+            table = ShopcartRevision.__table__
+            revision = db.session.execute(
+                db.select([table.c.revision]).where(table.c.shopcart_id == shopcart_id)
+            ).scalar() or 0
+            if cls.fill_cache():
+                get_cache().fill(key, revision)
+        return revision
+
+    @classmethod
+    def fill_cache(cls):
+        """
+        Returns True when a read may be kept in the cache, reads from a
+        replica are not kept as it may not have the write that emptied it yet
+        """
+        return get_cache().enabled and "read_bind" not in db.session().info
+
+    @classmethod
+    def from_row(cls, row):
+        """
+        Turns a ShopcartRow into a Shopcart item attached to the session
+        without a query, so it can be updated or deleted like a loaded item
+
+        An item the session already holds is returned as it is, the row may
+        be an older copy from the cache
+        """
+        key = db.session.identity_key(cls, (row.shopcart_id, row.product_id))
+        item = db.session.identity_map.get(key)
+        if item is None:
+            item = cls(**row._asdict())
+            make_transient_to_detached(item)
+            db.session.add(item)
+        return item
+
     def serialize(self):
         """ Serializes a Shopcart item into a dictionary """
         return {
@@ -125,19 +676,20 @@ class Shopcart(db.Model):
             }
 
 
-    def deserialize(self, data):
+    def deserialize(self, data, strict=False):
         """
         Deserializes a Shopcart item from a dictionary
 
         Args:
             data (dict): A dictionary containing the resource data
+            strict (bool): also reject numbers sent as any other JSON type
         """
         try:
             self.shopcart_id = data["shopcart_id"]
             self.product_id = data["product_id"]
             self.quantity = data["quantity"]
             self.price = data["price"]
-            self.time_added = data["time_added"]
+            self.time_added = parse_time(data["time_added"])
             self.checkout = data["checkout"]
         except KeyError as error:
             raise DataValidationError(
@@ -147,87 +699,160 @@ class Shopcart(db.Model):
             raise DataValidationError(
                 "Invalid Shopcart item: body of request contained bad or no data"
             )
+        except ValueError as error:
+            raise DataValidationError(
+                "Invalid Shopcart item: bad time_added " + str(error)
+            )
+        if strict:
+            # a value of the wrong type would only fail in the INSERT
+            for name in ("shopcart_id", "product_id", "quantity", "checkout", "price"):
+                value = getattr(self, name)
+                numbers = (int, float) if name == "price" else int
+                if not isinstance(value, numbers) or isinstance(value, bool):
+                    raise DataValidationError(
+                        "Invalid Shopcart item: {} must be a number".format(name)
+                    )
         return self
 
     @classmethod
     def init_db(cls, app):
         """ Initializes the database session """
         logger.info("Initializing database")
-        cls.app = app
+        cache.init_app(app)
+        sharding.init_app(app, db, move_cart)
+        routing.init_app(app, db)
         try:
             # This is where we initialize SQLAlchemy from the Flask app
             db.init_app(app)
+            migrate.init_app(app, db)
             app.config['ERROR_404_HELP'] = False
-            app.app_context().push()
-            db.create_all()  # make our sqlalchemy tables
+            # no app context is pushed here: every request gets its own and
+            # the scoped session is removed when the request ends
+            # the tables are made by the migrations with: flask db upgrade
         except ConnectionError:
             raise DatabaseConnectionError("Database service could not be reached")
             
 
     @classmethod
-    @retry(
-        HTTPError,
-        delay=RETRY_DELAY,
-        backoff=RETRY_BACKOFF,
-        tries=RETRY_COUNT,
-        logger=logger,
-    )
+    @db_call("all", read_only=True)
     def all(cls):
         """ Returns all of the Shopcarts in the database """
         logger.info("Processing all Shopcarts")
-        return cls.query.all()
+        query = cls.query.order_by(cls.shopcart_id, cls.product_id)
+        return list(sharding.gather(db, query.all))
+
+    @classmethod
+    @db_call("export_all", read_only=True)
+    def export_all(cls, batch_size, include_archived=False):
+        """
+            Returns an iterator over read-only rows of all of the Shopcarts
+            Rows are fetched batch_size at a time through a server side cursor
+            so the whole table is never held in memory
+            Args:
+                batch_size (int): the number of rows to fetch per round trip
+                include_archived (bool): also return the archived items, as
+                    ArchivedRows after the open item of the same key
+        """
+        logger.info("Processing export of all Shopcarts")
+        if include_archived:
+            statement = cls.select_with_archive().execution_options(stream_results=True)
+            return sharding.gather(db, cls.stream_rows, statement, batch_size, ArchivedRow, key=ARCHIVE_ORDER)
+        table = cls.__table__
+        statement = (
+            cls.select_rows()
+            .order_by(table.c.shopcart_id, table.c.product_id)
+            .execution_options(stream_results=True)
+        )
+        return sharding.gather(db, cls.stream_rows, statement, batch_size)
+
+    @classmethod
+    @db_call("all_rows", read_only=True)
+    def all_rows(cls):
+        """ Returns read-only rows of all of the Shopcarts in the database """
+        logger.info("Processing rows of all Shopcarts")
+        table = cls.__table__
+        statement = cls.select_rows().order_by(table.c.shopcart_id, table.c.product_id)
+        return list(sharding.gather(db, cls.load_rows, statement))
+
+    @classmethod
+    def select_rows(cls):
+        """ Returns a SELECT of only the columns of a ShopcartRow """
+        return db.select([cls.__table__.c[name] for name in ShopcartRow._fields])
+
+    @classmethod
+    def select_with_archive(cls, shopcart_id=None, product_id=None, after=None):
+        """
+            Returns a SELECT of the open and the archived items as ArchivedRows, in
+            (shopcart_id, product_id, archive_id) order
+            Args:
+                shopcart_id (int): only select items in this shopcart
+                product_id (int): only select items with this product id
+                after (tuple): the (shopcart_id, product_id, archive_id) key to resume after
+        """
+        selects = []
+        archive = ShopcartArchive.__table__
+        for table, archive_id in ((cls.__table__, db.literal_column("0")), (archive, archive.c.archive_id)):
+            statement = db.select([table.c[name] for name in ShopcartRow._fields] + [archive_id.label("archive_id")])
+            if shopcart_id is not None:
+                statement = statement.where(table.c.shopcart_id == shopcart_id)
+            if product_id is not None:
+                statement = statement.where(table.c.product_id == product_id)
+            if after is not None:
+                statement = statement.where(
+                    db.tuple_(table.c.shopcart_id, table.c.product_id, archive_id) > db.tuple_(*after)
+                )
+            selects.append(statement)
+        items = db.union_all(*selects).alias("items")
+        return db.select([items]).order_by(items.c.shopcart_id, items.c.product_id, items.c.archive_id)
+
+    @classmethod
+    def load_rows(cls, statement, row_class=ShopcartRow):
+        """ Runs a select_rows() statement and returns its ShopcartRows """
+        return [row_class._make(row) for row in db.session.execute(statement)]
+
+    @classmethod
+    def stream_rows(cls, statement, batch_size, row_class=ShopcartRow):
+        """ Runs a select_rows() statement and returns an iterator fetching its ShopcartRows in batches """
+        result = db.session.execute(statement)
+        batches = iter(lambda: result.fetchmany(batch_size), [])
+        return (row_class._make(row) for batch in batches for row in batch)
 
     @classmethod
-    @retry(
-        HTTPError,
-        delay=RETRY_DELAY,
-        backoff=RETRY_BACKOFF,
-        tries=RETRY_COUNT,
-        logger=logger,
-    )
     def find(cls, shopcart_id, product_id):
-        """ Finds a Shopcart item by it's shopcart_id and product_id """
-        logger.info("Processing lookup for shopcart_id %d and product_id %d ...", shopcart_id, product_id)
-        return cls.query.get((shopcart_id, product_id))
+        """ Finds a Shopcart item by it's shopcart_id and product_id, read through find_row """
+        row = cls.find_row(shopcart_id, product_id)
+        return cls.from_row(row) if row else None
 
     @classmethod
-    @retry(
-        HTTPError,
-        delay=RETRY_DELAY,
-        backoff=RETRY_BACKOFF,
-        tries=RETRY_COUNT,
-        logger=logger,
-    )
+    @db_call("find_for_update", by_cart=True)
+    def find_for_update(cls, shopcart_id, product_id):
+        """
+            Finds a Shopcart item that is about to be written, on the primary and past the cache
+            The row is locked until the write commits, so a change made by
+            another request in between is not overwritten with a stale copy
+        """
+        logger.info("Processing lookup for update of shopcart_id %d and product_id %d ...", shopcart_id, product_id)
+        # populate_existing replaces a copy the session already holds, it may be from the cache
+        return cls.query.populate_existing().with_for_update().get((shopcart_id, product_id))
+
+    @classmethod
+    @db_call("find_or_404", read_only=True, by_cart=True)
     def find_or_404(cls, shopcart_id, product_id):
         """ Find a Shopcart item by it's shopcart_id and product_id """
         logger.info("Processing lookup or 404 for shopcart_id %d and product_id %d ...", shopcart_id, product_id)
         return cls.query.get_or_404((shopcart_id, product_id))
 
     @classmethod
-    @retry(
-        HTTPError,
-        delay=RETRY_DELAY,
-        backoff=RETRY_BACKOFF,
-        tries=RETRY_COUNT,
-        logger=logger,
-    )
     def find_by_shopcart_id(cls, shopcart_id):
         """ 
-            Returns all Shopcart items with the given shopcart_id 
+            Returns all Shopcart items with the given shopcart_id, read through find_rows_by_shopcart_id
             Args:
                 shopcart_id (int): the shopcart id of the Shopcart you want to match
         """
-        logger.info("Processing lookup for shopcart_id %d ...", shopcart_id)
-        return cls.query.filter(cls.shopcart_id == shopcart_id).all()
+        return [cls.from_row(row) for row in cls.find_rows_by_shopcart_id(shopcart_id)]
 
     @classmethod
-    @retry(
-        HTTPError,
-        delay=RETRY_DELAY,
-        backoff=RETRY_BACKOFF,
-        tries=RETRY_COUNT,
-        logger=logger,
-    )
+    @db_call("find_by_product_id", read_only=True)
     def find_by_product_id(cls, product_id):
         """ 
             Returns all shopcarts that contain item by product_id 
@@ -235,6 +860,238 @@ class Shopcart(db.Model):
                 product_id (int): the product id of the item you want to match
         """
         logger.info("Processing lookup for product_id %d ...", product_id)
-        return cls.query.filter(cls.product_id == product_id)
+        # loaded here, a query run by the caller would miss the read replica
+        # and the shards
+        query = cls.query.filter(cls.product_id == product_id).order_by(cls.shopcart_id)
+        return list(sharding.gather(db, query.all))
+
+    @classmethod
+    @db_call("find_row", read_only=True, by_cart=True)
+    def find_row(cls, shopcart_id, product_id):
+        """ Finds a read-only row of a Shopcart item by it's shopcart_id and product_id """
+        logger.info("Processing row lookup for shopcart_id %d and product_id %d ...", shopcart_id, product_id)
+        key = "item:{}:{}".format(shopcart_id, product_id)
+        data = get_cache().get(key)
+        if data is not MISS:
+            return ShopcartRow.from_cache(data) if data else None
+        table = cls.__table__
+        rows = cls.load_rows(cls.select_rows().where(db.and_(
+            table.c.shopcart_id == shopcart_id, table.c.product_id == product_id
+        )))
+        row = rows[0] if rows else None
+        if cls.fill_cache():
+            get_cache().fill(key, row.serialize() if row else None)
+        return row
+
+    @classmethod
+    @db_call("find_rows_by_shopcart_id", read_only=True, by_cart=True)
+    def find_rows_by_shopcart_id(cls, shopcart_id):
+        """
+            Returns read-only rows of all Shopcart items with the given shopcart_id
+            Args:
+                shopcart_id (int): the shopcart id of the Shopcart you want to match
+        """
+        logger.info("Processing row lookup for shopcart_id %d ...", shopcart_id)
+        key = "cart:{}".format(shopcart_id)
+        data = get_cache().get(key)
+        if data is not MISS:
+            return [ShopcartRow.from_cache(item) for item in data]
+        table = cls.__table__
+        rows = cls.load_rows(cls.select_rows().where(table.c.shopcart_id == shopcart_id))
+        if cls.fill_cache():
+            get_cache().fill(key, [row.serialize() for row in rows])
+        return rows
 
+    @classmethod
+    @db_call("find_archived_rows", read_only=True, by_cart=True)
+    def find_archived_rows(cls, shopcart_id, product_id=None):
+        """
+            Returns read-only rows of the archived items of a Shopcart, in the order they were archived
+            The archive is not cached, it is only read on request
+            Args:
+                shopcart_id (int): the shopcart id of the Shopcart you want to match
+                product_id (int): only return the archived checkouts of this product
+        """
+        logger.info("Processing archive lookup for shopcart_id %d ...", shopcart_id)
+        archive = ShopcartArchive.__table__
+        statement = db.select([archive.c[name] for name in ShopcartRow._fields]).where(
+            archive.c.shopcart_id == shopcart_id
+        )
+        if product_id is not None:
+            statement = statement.where(archive.c.product_id == product_id)
+        return cls.load_rows(statement.order_by(archive.c.archive_id))
+
+    @classmethod
+    @db_call("find_rows_by_product_id", read_only=True)
+    def find_rows_by_product_id(cls, product_id):
+        """
+            Returns read-only rows of all shopcarts that contain item by product_id
+            Args:
+                product_id (int): the product id of the item you want to match
+        """
+        logger.info("Processing row lookup for product_id %d ...", product_id)
+        table = cls.__table__
+        statement = cls.select_rows().where(table.c.product_id == product_id).order_by(table.c.shopcart_id)
+        return list(sharding.gather(db, cls.load_rows, statement))
+
+    @classmethod
+    @db_call("find_page", read_only=True, by_cart=True)
+    def find_page(cls, limit, after=None, shopcart_id=None, product_id=None, include_archived=False):
+        """
+            Returns one page of read-only Shopcart rows ordered by (shopcart_id, product_id)
+            Args:
+                limit (int): the maximum number of items to return
+                after (tuple): the (shopcart_id, product_id) key to resume after,
+                    (shopcart_id, product_id, archive_id) with include_archived
+                shopcart_id (int): only return items in this shopcart
+                product_id (int): only return items with this product id
+                include_archived (bool): also return the archived items, as
+                    ArchivedRows after the open item of the same key
+            Returns:
+                a tuple of the items and the key of the last item, or None
+                when there are no more pages
+        """
+        logger.info("Processing page of %d items after %s ...", limit, after)
+        if include_archived:
+            statement = cls.select_with_archive(shopcart_id, product_id, after)
+            row_class, order = ArchivedRow, ARCHIVE_ORDER
+        else:
+            table = cls.__table__
+            statement = cls.select_rows()
+            if shopcart_id is not None:
+                statement = statement.where(table.c.shopcart_id == shopcart_id)
+            if product_id is not None:
+                statement = statement.where(table.c.product_id == product_id)
+            if after is not None:
+                statement = statement.where(
+                    db.tuple_(table.c.shopcart_id, table.c.product_id) > db.tuple_(*after)
+                )
+            statement = statement.order_by(table.c.shopcart_id, table.c.product_id)
+            row_class, order = ShopcartRow, sharding.CART_ORDER
+        # fetch one extra row to find out if there is another page
+        statement = statement.limit(limit + 1)
+        if shopcart_id is None:
+            # the page of every shard, merged and cut down to one page
+            items = list(itertools.islice(sharding.gather(db, cls.load_rows, statement, row_class, key=order), limit + 1))
+        else:
+            items = cls.load_rows(statement, row_class)
+        if len(items) <= limit:
+            return items, None
+        items = items[:limit]
+        return items, order(items[-1])
 
+    @classmethod
+    @db_call("summarize", read_only=True)
+    def summarize(cls, shopcart_ids, include_archived=False):
+        """
+            Returns the totals of shopcarts without loading their items
+            Args:
+                shopcart_ids (list): the shopcart ids to add up
+                include_archived (bool): also add up the checked out items
+                    moved to the archive, they are left out by default like
+                    in the reads of a shopcart
+            Returns:
+                a dict of the totals of each shopcart by shopcart_id, with the
+                totals of each checkout status under "by_checkout". A shopcart
+                without items has totals of zero
+        """
+        logger.info("Processing summary of shopcarts %s ...", shopcart_ids)
+        summaries = {
+            shopcart_id: dict(empty_totals(), shopcart_id=shopcart_id, by_checkout={})
+            for shopcart_id in shopcart_ids
+        }
+        tables = [cls.__table__]
+        if include_archived:
+            tables.append(ShopcartArchive.__table__)
+        # one aggregate query per table and shard, the overall totals are added up from the groups
+        rows = []
+        for ids in sharding.scatter_carts(db, list(summaries)):
+            for table in tables:
+                rows.extend(db.session.execute(db.select([
+                    table.c.shopcart_id,
+                    table.c.checkout,
+                    db.func.count(),
+                    db.func.sum(table.c.quantity),
+                    db.func.sum(table.c.quantity * table.c.price),
+                ]).where(
+                    table.c.shopcart_id.in_(ids)
+                ).group_by(table.c.shopcart_id, table.c.checkout)).fetchall())
+        for shopcart_id, checkout, item_count, total_quantity, total_price in rows:
+            summary = summaries[shopcart_id]
+            totals = summary["by_checkout"].setdefault(checkout, empty_totals())
+            for target in (totals, summary):
+                target["item_count"] += item_count
+                target["total_quantity"] += int(total_quantity or 0)
+                target["total_price"] += float(total_price or 0)
+        for summary in summaries.values():
+            for totals in [summary] + list(summary["by_checkout"].values()):
+                totals["total_price"] = round(totals["total_price"], 2)
+        return summaries
+
+
+def move_cart(source, target, shopcart_id):
+    """
+    Copies a cart to the target database, then removes it from the source
+
+    The revision row of the cart is locked on the source for the move, so a
+    worker still writing there waits for it. Items the cart already has on
+    the target are kept over the copies. When the target has a newer
+    revision the cart was written there since, the items on the source are
+    stale and dropped instead of copied, so an item deleted or checked out
+    on the target does not come back. The archived items go along in the
+    order they were archived, and the revision moves past the one of both
+    databases so an ETag from before the move does not match. The target
+    commits first: a failure in between leaves the cart on both, the reads
+    across carts keep the copy of the target, see sharding.gather, and the
+    next move removes it from the source
+
+    Returns:
+        True when the cart had anything on the source to move
+    """
+    items = Shopcart.__table__
+    archive = ShopcartArchive.__table__
+    revisions = ShopcartRevision.__table__
+    item_key = items.c.shopcart_id == shopcart_id
+    archive_key = archive.c.shopcart_id == shopcart_id
+    revision_key = revisions.c.shopcart_id == shopcart_id
+    with source.begin() as source_connection:
+        source_revision = source_connection.execute(
+            db.select([revisions.c.revision]).where(revision_key).with_for_update()
+        ).scalar()
+        rows = source_connection.execute(items.select().where(item_key)).fetchall()
+        # the target numbers the archived items itself
+        archived = source_connection.execute(
+            db.select([column for column in archive.c if column.key != "archive_id"])
+            .where(archive_key)
+            .order_by(archive.c.archive_id)
+        ).fetchall()
+        if source_revision is None and not rows and not archived:
+            # moved by another worker or the rebalance
+            return False
+        with target.begin() as target_connection:
+            target_revision = target_connection.execute(
+                db.select([revisions.c.revision]).where(revision_key).with_for_update()
+            ).scalar()
+            if (target_revision or 0) > (source_revision or 0):
+                logger.warning("Shopcart %d is newer on the target, %d stale items dropped", shopcart_id, len(rows))
+                copies = []
+            else:
+                existing = {
+                    row.product_id
+                    for row in target_connection.execute(db.select([items.c.product_id]).where(item_key))
+                }
+                copies = [dict(row) for row in rows if row.product_id not in existing]
+            if copies:
+                target_connection.execute(items.insert(), copies)
+            if archived:
+                target_connection.execute(archive.insert(), [dict(row) for row in archived])
+            revision = max(source_revision or 0, target_revision or 0) + 1
+            if target_revision is None:
+                target_connection.execute(revisions.insert().values(shopcart_id=shopcart_id, revision=revision))
+            else:
+                target_connection.execute(revisions.update().where(revision_key).values(revision=revision))
+        source_connection.execute(items.delete().where(item_key))
+        source_connection.execute(archive.delete().where(archive_key))
+        source_connection.execute(revisions.delete().where(revision_key))
+    Shopcart.invalidate(shopcart_id, [row.product_id for row in rows])
+    return True
@@ -0,0 +1,131 @@
+"""
+Database connection pool
+
+Builds the SQLAlchemy engine options from the configuration and counts what
+the pools in the worker process do, so the pool can be sized against the
+database connection limit: every worker holds up to DB_POOL_SIZE plus
+DB_MAX_OVERFLOW connections.
+
+Counters
+--------
+connects - new database connections opened
+closes - database connections closed
+invalidations - connections thrown away after an error or a failed ping
+checkouts - connections handed to a session
+timeouts - checkouts that gave up after DB_POOL_TIMEOUT seconds
+wait_seconds_total, wait_seconds_max - time spent waiting for a connection
+"""
+import threading
+import time
+from sqlalchemy import event, exc
+from sqlalchemy.pool import Pool, QueuePool
+
+
+class PoolStats:
+    """ Counters shared by every connection pool in the process """
+
+    COUNTERS = ("connects", "closes", "invalidations", "checkouts", "timeouts")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Sets every counter back to zero """
+        with self._lock:
+            for name in self.COUNTERS:
+                setattr(self, name, 0)
+            self.wait_seconds_total = 0.0
+            self.wait_seconds_max = 0.0
+
+    def increment(self, name):
+        """ Adds one to the named counter """
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def record_wait(self, seconds, timed_out=False):
+        """ Records the time one checkout waited for a connection """
+        with self._lock:
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def stats(self, pool=None):
+        """ Returns the counters, with the current state of pool if given """
+        with self._lock:
+            stats = {name: getattr(self, name) for name in self.COUNTERS}
+            stats["wait_seconds_total"] = round(self.wait_seconds_total, 6)
+            stats["wait_seconds_max"] = round(self.wait_seconds_max, 6)
+        stats["pool"] = type(pool).__name__ if pool is not None else None
+        for name in ("size", "checkedin", "checkedout", "overflow"):
+            method = getattr(pool, name, None)
+            stats[name] = method() if callable(method) else None
+        return stats
+
+
+pool_stats = PoolStats()
+
+
+class MeteredQueuePool(QueuePool):
+    """ A QueuePool that records how long each checkout waited """
+
+    def _do_get(self):
+        start = time.monotonic()
+        timed_out = False
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            timed_out = True
+            raise
+        finally:
+            pool_stats.record_wait(time.monotonic() - start, timed_out)
+
+
+@event.listens_for(Pool, "connect")
+def _on_connect(dbapi_connection, connection_record):
+    pool_stats.increment("connects")
+
+
+@event.listens_for(Pool, "close")
+def _on_close(dbapi_connection, connection_record):
+    pool_stats.increment("closes")
+
+
+@event.listens_for(Pool, "invalidate")
+def _on_invalidate(dbapi_connection, connection_record, exception):
+    pool_stats.increment("invalidations")
+
+
+@event.listens_for(Pool, "checkout")
+def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool_stats.increment("checkouts")
+
+
+def engine_options(config, uri=None):
+    """
+    Returns the engine options for the configured database, or the database
+    at uri when given
+
+    SQLite keeps the pool SQLAlchemy picks for it, the sizing options and
+    the statement timeout only apply to Postgres.
+    """
+    options = {
+        "pool_pre_ping": config.get("DB_POOL_PRE_PING", True),
+        "pool_recycle": config.get("DB_POOL_RECYCLE", 1800),
+    }
+    if not (uri or config["SQLALCHEMY_DATABASE_URI"]).startswith("postgres"):
+        return options
+    options.update(
+        poolclass=MeteredQueuePool,
+        pool_size=config.get("DB_POOL_SIZE", 5),
+        max_overflow=config.get("DB_MAX_OVERFLOW", 10),
+        pool_timeout=config.get("DB_POOL_TIMEOUT", 10),
+    )
+    statement_timeout = config.get("DB_STATEMENT_TIMEOUT", 0)
+    if statement_timeout:
+        # sent once per connection, PgBouncer in transaction mode drops it
+        options["connect_args"] = {
+            "options": "-c statement_timeout={}".format(statement_timeout)
+        }
+    return options
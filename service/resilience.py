@@ -0,0 +1,238 @@
+"""
+Retries and a circuit breaker for the database calls of the models
+
+A model method wrapped with resilient() is retried when the database fails
+in a way that may succeed on the next try: a lost or refused connection
+(OperationalError) or a Postgres serialization failure or deadlock. Each
+retry waits a random time up to a delay that doubles per attempt, so the
+workers of a restarted database do not all come back at once. The retries
+of one request share DB_RETRY_BUDGET seconds, a retry that would end after
+the budget is not made.
+
+Connection failures also count against the circuit breaker of the app in
+each worker, kept in app.extensions["breaker"].
+After DB_BREAKER_THRESHOLD of them in a row the breaker opens and the
+calls fail at once with DatabaseConnectionError, which the service returns
+as 503 with a Retry-After header, instead of every request waiting on the
+database. After DB_BREAKER_RESET_TIMEOUT seconds one call is let through
+to probe it: a success closes the breaker and a failure opens it again.
+
+Any other error, like an IntegrityError, means the database answered and is
+raised to the caller without a retry.
+"""
+import functools
+import logging
+import random
+import sqlite3
+import threading
+import time
+import psycopg2
+from flask import current_app, g, has_request_context
+from sqlalchemy.exc import DBAPIError, OperationalError
+from service.metrics import BREAKER_REJECTIONS, BREAKER_STATE, BREAKER_TRANSITIONS, RETRIES
+
+logger = logging.getLogger("flask.app")
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+STATES = (CLOSED, HALF_OPEN, OPEN)
+
+# Postgres error codes of a transaction that lost a race and can be run again
+RETRY_PGCODES = ("40001", "40P01")
+
+
+class DatabaseConnectionError(Exception):
+    """Custom Exception when database connection fails"""
+
+
+class CircuitBreaker:
+    """ Counts consecutive connection failures and fails fast while open """
+
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.reset()
+
+    def configure(self, threshold, reset_timeout):
+        """ Sets the failures that open the breaker and how long it stays open """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+
+    def reset(self):
+        """ Closes the breaker and forgets the failures """
+        with self._lock:
+            self.state = CLOSED
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+            BREAKER_STATE.set(STATES.index(CLOSED))
+
+    def retry_after(self):
+        """ Returns the seconds until the breaker lets a probe through """
+        if self.opened_at is None:
+            return 0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def before_call(self):
+        """
+        Lets a call through or raises DatabaseConnectionError
+
+        An open breaker lets the first call after reset_timeout through as
+        the probe, the others fail until the probe has an outcome
+        """
+        with self._lock:
+            if self.state == OPEN and self.retry_after() <= 0:
+                self._move(HALF_OPEN)
+            if self.state == CLOSED:
+                return
+            if self.state == HALF_OPEN and not self.probing:
+                self.probing = True
+                return
+        BREAKER_REJECTIONS.inc()
+        raise DatabaseConnectionError("Database is unavailable, the circuit breaker is open")
+
+    def record_success(self):
+        """ Closes the breaker, the database answered """
+        with self._lock:
+            self.failures = 0
+            self.probing = False
+            if self.state != CLOSED:
+                self._move(CLOSED)
+
+    def record_failure(self):
+        """ Counts a connection failure and opens the breaker at the threshold """
+        with self._lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.threshold):
+                self._move(OPEN)
+
+    def release(self):
+        """ Ends a call that says nothing about the database """
+        with self._lock:
+            self.probing = False
+
+    def stats(self):
+        """ Returns the state of the breaker """
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "retry_after": round(self.retry_after(), 3),
+        }
+
+    def _move(self, state):
+        logger.warning("Database circuit breaker %s -> %s", self.state, state)
+        BREAKER_TRANSITIONS.labels(self.state, state).inc()
+        BREAKER_STATE.set(STATES.index(state))
+        self.opened_at = time.monotonic() if state == OPEN else None
+        self.state = state
+
+
+def is_connection_failure(error):
+    """ Returns True for errors that mean the database could not be reached """
+    if not isinstance(error, OperationalError):
+        return False
+    if error.connection_invalidated:
+        return True
+    # the nearest SQLite has to a failed connect, a locked database answered
+    if isinstance(error.orig, sqlite3.OperationalError):
+        return str(error.orig).startswith("unable to open database file")
+    if not isinstance(error.orig, psycopg2.OperationalError):
+        return False
+    # a failed connect has no error code, 08 is a broken connection and
+    # 57P0 a server shutting down or starting up
+    pgcode = error.orig.pgcode
+    return pgcode is None or pgcode.startswith(("08", "57P0"))
+
+
+def is_retryable(error):
+    """ Returns True for database errors that may succeed when run again """
+    pgcode = getattr(getattr(error, "orig", None), "pgcode", None)
+    return pgcode in RETRY_PGCODES or is_connection_failure(error)
+
+
+def backoff(attempt):
+    """ Returns a random delay up to the doubling delay of the attempt """
+    config = current_app.config
+    ceiling = min(config["DB_RETRY_MAX_DELAY"], config["DB_RETRY_BASE_DELAY"] * 2 ** attempt)
+    return random.uniform(0, ceiling)
+
+
+def deadline():
+    """ Returns the time the retries of this request have to end by """
+    if has_request_context() and "db_retry_deadline" in g:
+        return g.db_retry_deadline
+    return time.monotonic() + current_app.config["DB_RETRY_BUDGET"]
+
+
+def resilient(method, session, retry=True):
+    """
+    Wraps a model method in the circuit breaker and retries it
+
+    Args:
+        method (str): the name of the method in the logs and the metrics
+        session: the session rolled back after a failed attempt
+        retry (bool): False for methods that cannot be run again once their
+            changes are rolled back, they still go through the breaker
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            attempts = current_app.config["DB_RETRY_ATTEMPTS"] if retry else 1
+            breaker = current_app.extensions["breaker"]
+            end = deadline()
+            attempt = 0
+            while True:
+                breaker.before_call()
+                try:
+                    result = func(*args, **kwargs)
+                except DBAPIError as error:
+                    session.rollback()
+                    if is_connection_failure(error):
+                        breaker.record_failure()
+                    else:
+                        breaker.record_success()
+                    if breaker.state == OPEN:
+                        raise DatabaseConnectionError(
+                            "Database is unavailable: {}".format(error.orig)
+                        ) from error
+                    attempt += 1
+                    delay = backoff(attempt - 1)
+                    if not is_retryable(error) or attempt >= attempts or time.monotonic() + delay > end:
+                        raise
+                    RETRIES.labels(method).inc()
+                    logger.warning("%s failed with %s, retry %d in %.3f seconds",
+                                   method, type(error.orig).__name__, attempt, delay)
+                    time.sleep(delay)
+                except BaseException:
+                    breaker.release()
+                    raise
+                else:
+                    breaker.record_success()
+                    return result
+
+        return wrapper
+
+    return decorator
+
+
+def init_app(app):
+    """ Makes the breaker of the app and starts the retry budget of every request """
+    app.extensions["breaker"] = CircuitBreaker(app.config["DB_BREAKER_THRESHOLD"], app.config["DB_BREAKER_RESET_TIMEOUT"])
+
+    @app.before_request
+    def start_retry_budget():  # pylint: disable=unused-variable
+        g.db_retry_deadline = time.monotonic() + app.config["DB_RETRY_BUDGET"]
+
+
+def unavailable_response(error):
+    """ Returns the body, status and headers of a 503 for the error """
+    retry_after = max(1, int(round(current_app.extensions["breaker"].retry_after())))
+    return (
+        {"status": 503, "error": "Service Unavailable", "message": str(error)},
+        503,
+        {"Retry-After": str(retry_after)},
+    )
@@ -3,38 +3,52 @@ Shopcarts Service
 
 Paths:
 ------
-GET /shopcarts - Returns a list all of all Shopcarts
+GET /shopcarts - Returns a page of all Shopcarts, ?limit= and ?cursor= select the page
+GET /shopcarts/export - Streams all Shopcart items as newline delimited JSON
 GET /shopcarts/{id} - Returns the Shopcart with a given shopcart_id and product_id
 GET /shopcarts/{id}/ - Return 
+POST /shopcarts/{id} - creates a new Shopcart record, ?merge=true adds to an existing record's quantity
 POST /shopcarts/{id}/items/{id} - creates a new Shopcart record in the database
+POST /shopcarts/{id}/items:batch - creates many Shopcart records in one transaction
 PUT /shopcarts/{id}/items/{id} - updates a Shopcart record in the database
+PATCH /shopcarts/{id}/items/{id} - adds a delta to the quantity of a Shopcart record
 DELETE /shopcarts/{id}/items/{id} - deletes a Shopcart record in the database
 PUT /shopcarts/{id}/checkout - updates all shopcart record in the database
+GET /shopcarts/{id}/summary - Returns the item count, quantity and price totals of a Shopcart
+GET /shopcarts/summary?shopcart_ids=1,2 - Returns the totals of many Shopcarts
+GET /stats - Returns the service counters of the worker that answers
+GET /metrics - Returns the Prometheus metrics of every worker
 PUT /shopcarts/{shopcart_id}/items/{product_id}/checkout - updates a shopcart record in the database
 """
 
 from datetime import datetime
 import os
+import base64
 import sys
 import logging
-from flask import Flask, json, jsonify, request, url_for, make_response, abort
-from flask_restx import Api, Resource, fields, reqparse, inputs
+from flask import Flask, Response, json, jsonify, request, url_for, make_response, abort, stream_with_context
+from flask_restx import Api, Resource, fields, reqparse, inputs, marshal
 from . import status # HTTP Status Codes
 from werkzeug.exceptions import NotFound
+from werkzeug.http import quote_etag
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
 from flask_sqlalchemy import SQLAlchemy
-from service.models import Shopcart, DataValidationError, DatabaseConnectionError
+from service.models import db, Shopcart, DataValidationError, DatabaseConnectionError, RevisionMismatchError, NegativeQuantityError, empty_totals
+from service.pool import pool_stats
+from service.resilience import unavailable_response
+from service import metrics
+from service.encoders import compile_encoder, dumps, json_response
 
-# Import Flask application
-from . import app
+# The routes are added to every app made by service.create_app(), app is
+# the app serving the request
+from flask import current_app as app
 
 
 ######################################################################
 # GET INDEX
 ######################################################################
-@app.route("/")
 def index():
     """ Root URL response """
     app.logger.info("Request for root URL")
@@ -42,11 +56,18 @@ def index():
     return app.send_static_file("index.html")
 
 
+######################################################################
+# GET METRICS
+######################################################################
+def get_metrics():
+    """ Returns the service metrics in the Prometheus text format """
+    return metrics.render()
+
+
 ######################################################################
 # Configure Swagger before initializing it
 ######################################################################
-api = Api(app,
-          version='1.0.0',
+api = Api(version='1.0.0',
           title='Shopcarts Demo REST API Service',
           description='This is a sample shopcarts service.',
           default='shopcarts',
@@ -55,6 +76,14 @@ api = Api(app,
           prefix='/api'
          )
 
+
+@api.errorhandler(DatabaseConnectionError)
+def database_unavailable(error):
+    """ Returns 503 while the database cannot be reached """
+    app.logger.error(str(error))
+    return unavailable_response(error)
+
+
 shopcart_model = api.model('Shopcart', {
     'shopcart_id': fields.Integer(require=True,
                                 description='The customer record id'),
@@ -70,11 +99,46 @@ shopcart_model = api.model('Shopcart', {
                                 description='if one item checked out, if zero item is not checked out')
 })
 
+batch_result_model = api.model('BatchResult', {
+    'shopcart_id': fields.Integer(description='The customer record id'),
+    'product_id': fields.Integer(description='The product id of the item'),
+    'status': fields.String(description='created, or conflict if the item was already in the shopcart')
+})
+
+quantity_delta_model = api.model('QuantityDelta', {
+    'delta': fields.Integer(required=True,
+                                description='The amount to add to the quantity, negative to remove'),
+    'remove_if_empty': fields.Boolean(required=False, default=True,
+                                description='Remove the item when its quantity drops to zero or below')
+})
+
+totals_model = api.model('CartTotals', {
+    'item_count': fields.Integer(description='The number of items in the shopcart'),
+    'total_quantity': fields.Integer(description='The sum of the quantities of the items'),
+    'total_price': fields.Float(description='The sum of quantity times price of the items')
+})
+
+summary_model = api.inherit('CartSummary', totals_model, {
+    'shopcart_id': fields.Integer(description='The customer record id'),
+    'open': fields.Nested(totals_model, allow_null=True,
+                                description='The totals of the items not checked out, with ?by_checkout=true'),
+    'checked_out': fields.Nested(totals_model, allow_null=True,
+                                description='The totals of the items checked out, with ?by_checkout=true')
+})
+
+# the read endpoints write these straight to JSON instead of marshalling
+encode_shopcart = compile_encoder(shopcart_model)
+# the export keeps the sorted keys it had when it used flask.json
+encode_shopcart_sorted = compile_encoder(shopcart_model, sort_keys=True)
+
 
 # query string arguments
 shopcart_args = reqparse.RequestParser()
 shopcart_args.add_argument('shopcart_id', type=str, required=True, help='List all Shopcarts')
 shopcart_args.add_argument('product_id', type=str, required=True, help='List all Shopcarts with this product_id')
+shopcart_args.add_argument('limit', type=int, required=False, help='The maximum number of items to return')
+shopcart_args.add_argument('cursor', type=str, required=False, help='The cursor from the Link header of the previous page')
+shopcart_args.add_argument('include_archived', type=inputs.boolean, required=False, help='Also return the checked out items moved to the archive')
 
 ######################################################################
 #  PATH: /shopcarts
@@ -92,43 +156,94 @@ class ShopcartCollection(Resource):
     #------------------------------------------------------------------
     @api.doc('list_shopcarts')
     @api.expect(shopcart_args, validate=True)
-    @api.marshal_list_with(shopcart_model)
+    @api.response(200, 'Success', [shopcart_model])
     def get(self):
-        print('list')
-        """ Return all of the Shopcarts """
+        """
+        Return a page of Shopcart items
+        Items are ordered by shopcart_id and product_id. When there are more items
+        a Link header with rel="next" points at the next page. With ?include_archived=true
+        the archived checkouts of an item follow it, in the order they were archived
+        """
         app.logger.info("Request for Shopcarts list")
-        shopcarts = []
-        results = []
         parser = reqparse.RequestParser()
         parser.add_argument('shopcart_id', type=int)
         parser.add_argument('product_id', type=int)
+        parser.add_argument('limit', type=int)
+        parser.add_argument('cursor', type=str)
+        parser.add_argument('include_archived', type=inputs.boolean, default=False)
         args = parser.parse_args()
         shopcart_id = args['shopcart_id'] if args['shopcart_id'] else None
         product_id = args['product_id'] if args['product_id'] else None
+        include_archived = args['include_archived']
+        limit = get_page_size(args['limit'])
+        after = decode_cursor(args['cursor']) if args['cursor'] else None
+        if after is not None:
+            # a cursor of the list with or without the archive resumes after the same item
+            after = (after + (0,))[:3] if include_archived else after[:2]
         if shopcart_id and product_id:
             app.logger.info('Returning item with shopcart id %s and product id %s', args['shopcart_id'], args['product_id'])
-            shopcarts = Shopcart.find(shopcart_id, product_id)
         elif not shopcart_id and product_id:
             app.logger.info('Returning all shopcarts with product id: %s', args['product_id'])
-            shopcarts = Shopcart.find_by_product_id(product_id)
         elif shopcart_id and not product_id:
             app.logger.info('Returning all items with shopcart id: %s', args['shopcart_id'])
-            shopcarts = Shopcart.find_by_shopcart_id(shopcart_id)
         else:
             app.logger.info('Returning unfiltered list of all shopcarts')
-            shopcarts = Shopcart.all()
-
-        if not shopcarts:
-            app.logger.info("Returning 0 items")
-            message = []
-            return message, status.HTTP_200_OK
-                
-        if shopcart_id and product_id:
-            results = [shopcarts.serialize()]
-        else:
-            results = [shopcart.serialize() for shopcart in shopcarts]
+        shopcarts, last_key = Shopcart.find_page(
+            limit, after=after, shopcart_id=shopcart_id, product_id=product_id, include_archived=include_archived
+        )
+
+        headers = {}
+        if last_key:
+            next_url = api.url_for(
+                ShopcartCollection,
+                shopcart_id=shopcart_id,
+                product_id=product_id,
+                limit=limit,
+                include_archived="true" if include_archived else None,
+                cursor=encode_cursor(*last_key),
+                _external=True
+            )
+            headers["Link"] = '<{}>; rel="next"'.format(next_url)
+
+        results = [encode_shopcart(shopcart) for shopcart in shopcarts]
         app.logger.info("Returning %d items", len(results))
-        return results, status.HTTP_200_OK        
+        return json_response(results, status.HTTP_200_OK, headers)
+
+
+######################################################################
+#  PATH: /shopcarts/export
+######################################################################
+@api.route('/shopcarts/export')
+class ShopcartExport(Resource):
+    """
+    ShopcartExport class
+    Allows a full dump of every customer's shopcart
+    GET /shopcarts/export - Streams all items in the db as newline delimited JSON
+    """
+
+    #------------------------------------------------------------------
+    # EXPORT ALL ITEMS
+    #------------------------------------------------------------------
+    @api.doc('export_shopcarts', params={'include_archived': 'Also export the checked out items moved to the archive'})
+    @api.produces(['application/x-ndjson'])
+    def get(self):
+        """
+        Export all of the Shopcart items
+        This endpoint streams one JSON document per line, reading the table in batches
+        With ?include_archived=true the archived checkouts of an item follow it
+        """
+        app.logger.info("Request to export all Shopcarts")
+        include_archived = request.args.get("include_archived", False, type=inputs.boolean)
+        shopcarts = Shopcart.export_all(app.config["EXPORT_BATCH_SIZE"], include_archived=include_archived)
+
+        def generate():
+            count = 0
+            for shopcart in shopcarts:
+                count += 1
+                yield dumps(encode_shopcart_sorted(shopcart)) + b"\n"
+            app.logger.info("Exported %d items", count)
+
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
 
 
 ######################################################################
@@ -148,58 +263,79 @@ class ShopcartResource(Resource):
     #------------------------------------------------------------------
     # ADD A NEW SHOPCART ITEM
     #------------------------------------------------------------------
-    @api.doc('create_shopcarts')
+    @api.doc('create_shopcarts', params={'merge': 'Add the quantity to an item already in the shopcart'})
     @api.response(400, 'The posted data was not vaild')
     @api.expect(shopcart_model)
     @api.marshal_with(shopcart_model, code=201)
     def post(self, shopcart_id):
         """
         Creates a new Shopcart item
-        This endpoint will create a Shopcart item based on the data in the body that is posted
+        This endpoint will create a Shopcart item based on the data in the body that is posted.
+        With ?merge=true an item already in the shopcart has the posted quantity added to it
         """
         app.logger.info("Request to create a Shopcart item")
         check_content_type("application/json")
+        merge = request.args.get("merge", False, type=inputs.boolean)
         shopcart = Shopcart()
         app.logger.debug('Payload = %s', api.payload)
         app.logger.info(api.payload)
         api.payload["shopcart_id"] = int(shopcart_id)
         # api.payload["time_added"] = datetime.strptime(api.payload["time_added"], "%a, %d %b %Y %H:%M:%S")
         shopcart.deserialize(api.payload)
-        item = Shopcart.find(api.payload["shopcart_id"], api.payload["product_id"])
-        if not item:
-            shopcart.create()
+        created = shopcart.upsert(merge_quantity=merge)
+        location_url = api.url_for(ShopcartResource, shopcart_id=shopcart.shopcart_id, product_id=shopcart.product_id, _external=True)
+        if created:
             app.logger.info("Shopcart with shopcart_id [%d] and product_id [%d created", shopcart.shopcart_id, shopcart.product_id)
-            location_url = api.url_for(ShopcartResource, shopcart_id=shopcart.shopcart_id, product_id=shopcart.product_id, _external=True)
             return shopcart.serialize(), status.HTTP_201_CREATED, {"Location": location_url}
+        elif merge:
+            app.logger.info("Shopcart item with shopcart_id: %d and product_id: %d quantity merged", shopcart.shopcart_id, shopcart.product_id)
+            return shopcart.serialize(), status.HTTP_200_OK, {"Location": location_url}
         else:
             app.logger.info("Shopcart item with shopcart_id: %d and product_id: %d already created", shopcart.shopcart_id, shopcart.product_id)
-            location_url = api.url_for(ShopcartResource, shopcart_id=shopcart.shopcart_id, product_id=shopcart.product_id, _external=True)
             return "item already exists", status.HTTP_409_CONFLICT, {"Location": location_url}
-                
+
 
     #------------------------------------------------------------------
     # READ ITEMS FROM A CUSTOMER'S SHOPCART
     #------------------------------------------------------------------
-    @api.doc('get_shopcarts')
+    @api.doc('get_shopcarts', params={'include_archived': 'Also return the checked out items moved to the archive'})
     @api.response(404, 'Shopcart not found')
-    @api.marshal_with(shopcart_model)
+    @api.response(304, 'Shopcart not modified since the If-None-Match ETag')
+    @api.response(200, 'Success', [shopcart_model])
     def get(self, shopcart_id):
-        """ Read items from a customer's Shopcart """
+        """
+        Read items from a customer's Shopcart
+        The ETag names the revision of the Shopcart, when it matches If-None-Match
+        the items are not loaded and 304 is returned. With ?include_archived=true
+        the archived items follow the open ones
+        """
         app.logger.info("Request an item from the Shopcart")
-        shopcarts = Shopcart.find_by_shopcart_id(int(shopcart_id))
+        shopcart_id = int(shopcart_id)
+        include_archived = request.args.get("include_archived", False, type=inputs.boolean)
+        # read the revision before the items so the ETag is never newer than them
+        etag = cart_etag(shopcart_id, Shopcart.get_revision(shopcart_id), include_archived)
+        headers = {"ETag": quote_etag(etag)}
+        if request.if_none_match.contains_weak(etag):
+            app.logger.info("Shopcart %d not modified", shopcart_id)
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        shopcarts = Shopcart.find_rows_by_shopcart_id(shopcart_id)
+        if include_archived:
+            shopcarts = shopcarts + Shopcart.find_archived_rows(shopcart_id)
         if not shopcarts:
             app.logger.info("Returning 0 items")
-            return [], status.HTTP_404_NOT_FOUND
+            return json_response([], status.HTTP_404_NOT_FOUND)
 
-        results = [items.serialize() for items in shopcarts]
+        results = [encode_shopcart(items) for items in shopcarts]
         app.logger.info("Returning %d items", len(results))
-        return results, status.HTTP_200_OK
+        return json_response(results, status.HTTP_200_OK, headers)
 
     #------------------------------------------------------------------
     # CLEAR SHOPCART
     #------------------------------------------------------------------
     @api.doc('clear_shopcart')
     @api.response(204, 'Shopcart deleted')
+    @api.response(412, 'Shopcart changed since the If-Match ETag')
     @api.marshal_with(shopcart_model)
     def delete(self, shopcart_id):
         """
@@ -207,15 +343,13 @@ class ShopcartResource(Resource):
         This endpoint will delete a Item based the id specified in the path
         """
         app.logger.info("Request to delete items in shopcart: %s ", shopcart_id)
-
-        shopcart = Shopcart.find_by_shopcart_id(int(shopcart_id))
-
-        results = [item.serialize() for item in shopcart]
-
-        if results:
-            for i in results:
-                shopcart = Shopcart.find(int(shopcart_id), i['product_id'])
-                shopcart.delete()
+        shopcart_id = int(shopcart_id)
+        expected_revision = get_expected_revision(shopcart_id)
+        try:
+            count = Shopcart.delete_cart(shopcart_id, expected_revision=expected_revision)
+        except RevisionMismatchError as error:
+            abort(status.HTTP_412_PRECONDITION_FAILED, str(error))
+        app.logger.info("Deleted %d items from shopcart: %s", count, shopcart_id)
         return '', status.HTTP_204_NO_CONTENT
 
 ######################################################################
@@ -231,6 +365,7 @@ class ShopcartItems(Resource):
     DELETE /shopcarts/{shopcart_id}/items/{product_id} - Removes one item from a customer's shopcart
     GET /shopcarts/{shopcart_id}/items/{product_id} - Retrieves one item from a customer's shopcart
     PUT /shopcarts/{shopcart_id}/items/{product_id} - Updates one item from a customer's shopcart
+    PATCH /shopcarts/{shopcart_id}/items/{product_id} - Changes the quantity of one item in a customer's shopcart
     """
 
     #------------------------------------------------------------------
@@ -238,6 +373,7 @@ class ShopcartItems(Resource):
     #------------------------------------------------------------------
     @api.doc('delete_shopcart_item')
     @api.response(204, 'Item deleted')
+    @api.response(412, 'Shopcart changed since the If-Match ETag')
     def delete(self, shopcart_id, product_id):
         """
         Delete a Item
@@ -245,30 +381,46 @@ class ShopcartItems(Resource):
         This endpoint will delete a Item based the id specified in the path
         """
         app.logger.info("Request to delete item in shopcart: %s with id: %s", shopcart_id,product_id)
+        expected_revision = get_expected_revision(shopcart_id)
 
-        shopcart = Shopcart.find(shopcart_id, product_id)
+        shopcart = Shopcart.find_for_update(shopcart_id, product_id)
 
         if shopcart:
-            shopcart.delete()
+            try:
+                shopcart.delete(expected_revision=expected_revision)
+            except RevisionMismatchError as error:
+                abort(status.HTTP_412_PRECONDITION_FAILED, str(error))
             app.logger.info('Shopcart with id [%s] and product id [%s] was deleted', shopcart_id, product_id)
         return '', status.HTTP_204_NO_CONTENT
     #------------------------------------------------------------------
     # RETRIEVE ITEM
     #------------------------------------------------------------------
-    @api.doc('get_shopcart_item')
+    @api.doc('get_shopcart_item', params={'include_archived': 'Return the last archived checkout of the item when it is not open'})
     @api.response(404, 'Item not found')
-    @api.marshal_with(shopcart_model)
+    @api.response(304, 'Shopcart not modified since the If-None-Match ETag')
+    @api.response(200, 'Success', shopcart_model)
     def get(self ,shopcart_id, product_id):
         """
         Retrieve a item in specific shopcart
 
         This endpoint will return a item based on shopcart_id and product id
+        With ?include_archived=true an item that is not in the Shopcart any more
+        is returned as it was last checked out
         """
         app.logger.info("Request to Retrieve a item with id %s in shopcart %s",product_id, shopcart_id)
-        shopcart = Shopcart.find(shopcart_id, product_id)
+        include_archived = request.args.get("include_archived", False, type=inputs.boolean)
+        etag = cart_etag(shopcart_id, Shopcart.get_revision(shopcart_id), include_archived)
+        headers = {"ETag": quote_etag(etag)}
+        if request.if_none_match.contains_weak(etag):
+            app.logger.info("Shopcart %d not modified", shopcart_id)
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        shopcart = Shopcart.find_row(shopcart_id, product_id)
+        if not shopcart and include_archived:
+            archived = Shopcart.find_archived_rows(shopcart_id, product_id)
+            shopcart = archived[-1] if archived else None
         if not shopcart:
             abort(status.HTTP_404_NOT_FOUND, "item with id '{}' in shopcart '{}'was not found.".format(product_id, shopcart_id))
-        return shopcart.serialize(), status.HTTP_200_OK
+        return json_response(encode_shopcart(shopcart), status.HTTP_200_OK, headers)
 
 
     #------------------------------------------------------------------
@@ -276,6 +428,7 @@ class ShopcartItems(Resource):
     #------------------------------------------------------------------
     @api.doc('update_shopcart_item')
     @api.response(404, 'Item not found')
+    @api.response(412, 'Shopcart changed since the If-Match ETag')
     @api.response(400, 'The posted data was not vaild')
     @api.expect(shopcart_model)
     @api.marshal_with(shopcart_model)
@@ -286,7 +439,8 @@ class ShopcartItems(Resource):
         """
         shopcart_id = int(shopcart_id)
         product_id = int(product_id)
-        shopcart = Shopcart.find(shopcart_id, product_id)
+        expected_revision = get_expected_revision(shopcart_id)
+        shopcart = Shopcart.find_for_update(shopcart_id, product_id)
 
         app.logger.info("Request to update item in shopcart: %s with id: %s", shopcart_id, product_id)
         check_content_type("application/json")        
@@ -299,9 +453,111 @@ class ShopcartItems(Resource):
             shopcartParams = {"shopcart_id": shopcart_id, "product_id": product_id, "quantity": shopcart.quantity + 1}
             api.payload.update(shopcartParams)
             shopcart.deserialize(api.payload)
-            shopcart.update()
+            try:
+                shopcart.update(expected_revision=expected_revision)
+            except RevisionMismatchError as error:
+                abort(status.HTTP_412_PRECONDITION_FAILED, str(error))
             location_url = api.url_for(ShopcartItems, shopcart_id=shopcart.shopcart_id, product_id=shopcart.product_id, _external=True)
-            return shopcart.serialize(), status.HTTP_200_OK, {"Location": location_url}
+            etag = cart_etag(shopcart_id, Shopcart.get_revision(shopcart_id))
+            return shopcart.serialize(), status.HTTP_200_OK, {"Location": location_url, "ETag": quote_etag(etag)}
+
+    #------------------------------------------------------------------
+    # CHANGE THE QUANTITY OF AN ITEM
+    #------------------------------------------------------------------
+    @api.doc('adjust_shopcart_item_quantity')
+    @api.response(404, 'Item not found')
+    @api.response(400, 'The posted data was not vaild')
+    @api.response(409, 'The quantity would drop below zero')
+    @api.response(204, 'Item removed because its quantity dropped to zero')
+    @api.response(200, 'Success', shopcart_model)
+    @api.expect(quantity_delta_model)
+    def patch(self, shopcart_id, product_id):
+        """
+        Changes the quantity of a Shopcart item
+        This endpoint adds the posted delta to the quantity in a single UPDATE without reading the item first
+        """
+        app.logger.info("Request to change quantity of item in shopcart: %s with id: %s", shopcart_id, product_id)
+        check_content_type("application/json")
+        payload = api.payload if isinstance(api.payload, dict) else {}
+        delta = payload.get("delta")
+        remove_empty = payload.get("remove_if_empty", True)
+        if not isinstance(delta, int) or isinstance(delta, bool):
+            abort(status.HTTP_400_BAD_REQUEST, "delta must be an integer")
+        if not isinstance(remove_empty, bool):
+            abort(status.HTTP_400_BAD_REQUEST, "remove_if_empty must be a boolean")
+
+        try:
+            shopcart = Shopcart.adjust_quantity(shopcart_id, product_id, delta, remove_empty=remove_empty)
+        except NegativeQuantityError as error:
+            abort(status.HTTP_409_CONFLICT, str(error))
+        if not shopcart:
+            abort(status.HTTP_404_NOT_FOUND, "item with id '{}' in shopcart '{}'was not found.".format(product_id, shopcart_id))
+        if remove_empty and shopcart.quantity <= 0:
+            app.logger.info('Shopcart with id [%s] and product id [%s] was removed', shopcart_id, product_id)
+            return '', status.HTTP_204_NO_CONTENT
+        app.logger.info("Changed quantity of item to %d", shopcart.quantity)
+        # marshalled here, the 204 above has no body
+        return marshal(shopcart.serialize(), shopcart_model), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /shopcarts/{shopcart_id}/items:batch
+######################################################################
+@api.route('/shopcarts/<int:shopcart_id>/items:batch')
+@api.param('shopcart_id', 'The Shopcart identifier')
+class ShopcartItemsBatch(Resource):
+    """
+    ShopcartItemsBatch class
+    Allows adding many items to a customer's shopcart at once
+    POST /shopcarts/{shopcart_id}/items:batch - Adds a list of items to a customer's shopcart
+    """
+
+    #------------------------------------------------------------------
+    # ADD MANY SHOPCART ITEMS
+    #------------------------------------------------------------------
+    @api.doc('create_shopcart_items_batch')
+    @api.response(400, 'The posted data was not vaild')
+    @api.expect([shopcart_model])
+    @api.marshal_list_with(batch_result_model)
+    def post(self, shopcart_id):
+        """
+        Creates many Shopcart items
+        Every item is validated before any is saved, then they are all inserted in one transaction.
+        Items already in the shopcart are reported as a conflict and left unchanged
+        """
+        app.logger.info("Request to create a batch of items in shopcart: %s", shopcart_id)
+        check_content_type("application/json")
+        payload = api.payload
+        if not isinstance(payload, list):
+            abort(status.HTTP_400_BAD_REQUEST, "body of request must be a list of items")
+        if len(payload) > app.config["MAX_BATCH_SIZE"]:
+            abort(status.HTTP_400_BAD_REQUEST, "at most {} items can be added at once".format(app.config["MAX_BATCH_SIZE"]))
+
+        items = []
+        for data in payload:
+            if isinstance(data, dict):
+                data = dict(data, shopcart_id=shopcart_id)
+            try:
+                items.append(Shopcart().deserialize(data, strict=True))
+            except DataValidationError as error:
+                abort(status.HTTP_400_BAD_REQUEST, str(error))
+
+        # only the first item for each product can be created
+        unique = {}
+        for item in items:
+            unique.setdefault(item.product_id, item)
+        created = Shopcart.create_batch(shopcart_id, list(unique.values()))
+
+        results = []
+        for item in items:
+            is_created = item.product_id in created and unique[item.product_id] is item
+            results.append({
+                "shopcart_id": shopcart_id,
+                "product_id": item.product_id,
+                "status": "created" if is_created else "conflict"
+            })
+        app.logger.info("Created %d of %d items in shopcart: %s", len(created), len(items), shopcart_id)
+        return results, status.HTTP_200_OK
 
 
 ######################################################################
@@ -328,22 +584,14 @@ class ShopcartCheckoutAllItems(Resource):
         This endpoint will update a item based the body that is posted
         """
         app.logger.info("Request to checkout all items in shopcart: %s",shopcart_id)
-        shopcarts = Shopcart.find_by_shopcart_id(shopcart_id)
+        shopcarts = Shopcart.checkout_cart(shopcart_id)
 
         if not shopcarts:
             raise NotFound("item with shopcart id '{}' was not found.".format(shopcart_id))
 
-        else:
-            results = [shopcart.serialize() for shopcart in shopcarts]
-            for product in results:
-                product_id = product['product_id']
-                product['checkout'] = str(1)
-                shopcart = Shopcart.find(shopcart_id, product_id)
-                shopcart.deserialize(product)
-                shopcart.update()
-            shopcarts = Shopcart.find_by_shopcart_id(shopcart_id)
-            results = [shopcart.serialize() for shopcart in shopcarts]
-            return results, status.HTTP_200_OK
+        results = [shopcart.serialize() for shopcart in shopcarts]
+        app.logger.info("Checked out %d items", len(results))
+        return results, status.HTTP_200_OK
 
 ######################################################################
 #  PATH: /shopcarts/{shopcart_id}/items/{product_id}/checkout
@@ -371,7 +619,7 @@ class ShopcartCheckoutItems(Resource):
         """
         app.logger.info("Request to checkout item in shopcart: %s with id: %s", shopcart_id, product_id)
 
-        shopcart = Shopcart.find(shopcart_id, product_id)
+        shopcart = Shopcart.find_for_update(shopcart_id, product_id)
 
         if not shopcart:
             raise NotFound("item with shopcart id '{}' and item id '{}' was not found.".format(shopcart_id, product_id))
@@ -384,15 +632,181 @@ class ShopcartCheckoutItems(Resource):
             shopcart.update()
             return shopcart.serialize(), status.HTTP_200_OK
 
+######################################################################
+#  PATH: /shopcarts/{shopcart_id}/summary
+######################################################################
+@api.route('/shopcarts/<int:shopcart_id>/summary')
+@api.param('shopcart_id', 'The Shopcart identifier')
+class ShopcartSummary(Resource):
+    """
+    ShopcartSummary class
+    Allows the totals of a customer's shopcart to be read without its items
+    GET /shopcarts/{shopcart_id}/summary - Returns the item count, quantity and price totals
+    """
+
+    #------------------------------------------------------------------
+    # READ THE TOTALS OF A SHOPCART
+    #------------------------------------------------------------------
+    @api.doc('summarize_shopcart', params={
+        'by_checkout': 'Also return the totals of each checkout status',
+        'include_archived': 'Also add up the checked out items moved to the archive'
+    })
+    @api.marshal_with(summary_model, skip_none=True)
+    def get(self, shopcart_id):
+        """
+        Returns the totals of a Shopcart
+        The totals are added up by the database, a shopcart without items has totals of zero
+        The archived items are only added with ?include_archived=true
+        """
+        app.logger.info("Request for the summary of shopcart: %s", shopcart_id)
+        by_checkout = request.args.get("by_checkout", False, type=inputs.boolean)
+        include_archived = request.args.get("include_archived", False, type=inputs.boolean)
+        summary = Shopcart.summarize([shopcart_id], include_archived)[shopcart_id]
+        return format_summary(summary, by_checkout), status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /shopcarts/summary
+######################################################################
+@api.route('/shopcarts/summary')
+class ShopcartSummaryBatch(Resource):
+    """
+    ShopcartSummaryBatch class
+    Allows the totals of many customers' shopcarts to be read in one request
+    GET /shopcarts/summary?shopcart_ids=1,2,3 - Returns the totals of each shopcart
+    """
+
+    #------------------------------------------------------------------
+    # READ THE TOTALS OF MANY SHOPCARTS
+    #------------------------------------------------------------------
+    @api.doc('summarize_shopcarts', params={
+        'shopcart_ids': 'Comma separated Shopcart identifiers',
+        'by_checkout': 'Also return the totals of each checkout status',
+        'include_archived': 'Also add up the checked out items moved to the archive'
+    })
+    @api.response(400, 'The shopcart ids were missing or not valid')
+    @api.marshal_list_with(summary_model, skip_none=True)
+    def get(self):
+        """
+        Returns the totals of many Shopcarts
+        The summaries are returned in the order of the shopcart ids, all of them from one query
+        The archived items are only added with ?include_archived=true
+        """
+        app.logger.info("Request for the summary of many shopcarts")
+        by_checkout = request.args.get("by_checkout", False, type=inputs.boolean)
+        include_archived = request.args.get("include_archived", False, type=inputs.boolean)
+        shopcart_ids = parse_shopcart_ids(request.args.get("shopcart_ids", ""))
+        summaries = Shopcart.summarize(shopcart_ids, include_archived)
+        app.logger.info("Returning the summary of %d shopcarts", len(shopcart_ids))
+        return [format_summary(summaries[shopcart_id], by_checkout) for shopcart_id in shopcart_ids], status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /stats
+######################################################################
+@api.route('/stats')
+class ServiceStats(Resource):
+    """
+    ServiceStats class
+    Allows the introspection of the service
+    GET /stats - Returns the service counters of the worker that answers
+    """
+
+    #------------------------------------------------------------------
+    # READ THE COUNTERS
+    #------------------------------------------------------------------
+    @api.doc('get_stats')
+    def get(self):
+        """
+        Returns the cache, connection pool, circuit breaker and read replica counters
+        The counters are those of the one worker process that answers, named by its pid.
+        Use GET /metrics for the counters of every worker
+        """
+        app.logger.info("Request for service stats")
+        return {
+            "pid": os.getpid(),
+            "cache": app.extensions["cache"].stats(),
+            "pool": pool_stats.stats(db.engine.pool),
+            "breaker": app.extensions["breaker"].stats(),
+            "replicas": app.extensions["replicas"].stats(),
+        }, status.HTTP_200_OK
+
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
 
 
-def init_db():
-    """ Initialies the SQLAlchemy app """
-    global app
-    Shopcart.init_db(app)
+def init_app(flask_app):
+    """ Adds the routes and the Swagger docs to an app """
+    flask_app.add_url_rule("/", "index", index)
+    flask_app.add_url_rule("/metrics", "get_metrics", get_metrics)
+    api.init_app(flask_app)
+
+def get_page_size(limit):
+    """Returns the page size to use, capped at the server maximum"""
+    if limit is None:
+        return app.config["DEFAULT_PAGE_SIZE"]
+    if limit < 1:
+        abort(status.HTTP_400_BAD_REQUEST, "limit must be a positive integer")
+    return min(limit, app.config["MAX_PAGE_SIZE"])
+
+def parse_shopcart_ids(text):
+    """Returns the distinct shopcart ids in a comma separated list, in order"""
+    try:
+        shopcart_ids = [int(part) for part in text.split(",") if part.strip()]
+    except ValueError:
+        abort(status.HTTP_400_BAD_REQUEST, "shopcart_ids must be a comma separated list of integers")
+    shopcart_ids = list(dict.fromkeys(shopcart_ids))
+    if not shopcart_ids:
+        abort(status.HTTP_400_BAD_REQUEST, "shopcart_ids is required")
+    if len(shopcart_ids) > app.config["MAX_SUMMARY_CARTS"]:
+        abort(status.HTTP_400_BAD_REQUEST, "at most {} shopcarts can be summarized at once".format(app.config["MAX_SUMMARY_CARTS"]))
+    return shopcart_ids
+
+def format_summary(summary, by_checkout):
+    """Returns the totals of a shopcart, split by checkout status if asked"""
+    result = {key: summary[key] for key in ("shopcart_id", "item_count", "total_quantity", "total_price")}
+    if by_checkout:
+        result["open"] = summary["by_checkout"].get(0, empty_totals())
+        result["checked_out"] = summary["by_checkout"].get(1, empty_totals())
+    return result
+
+def encode_cursor(*key):
+    """Encodes the key of the last item on a page as an opaque cursor"""
+    key = ":".join(str(part) for part in key).encode("utf-8")
+    return base64.urlsafe_b64encode(key).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor):
+    """Decodes a cursor back into a (shopcart_id, product_id) key, with the archive_id of an archived item"""
+    try:
+        key = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        parts = tuple(int(part) for part in key.decode("utf-8").split(":"))
+        if len(parts) not in (2, 3):
+            raise ValueError("a cursor has 2 or 3 parts")
+        return parts
+    except ValueError:
+        app.logger.error("Invalid cursor: %s", cursor)
+        abort(status.HTTP_400_BAD_REQUEST, "cursor is not valid")
+
+def cart_etag(shopcart_id, revision, archived=False):
+    """Returns the ETag for a revision of a Shopcart, with or without its archived items"""
+    etag = "{}-{}".format(shopcart_id, revision)
+    return etag + "-archived" if archived else etag
+
+def get_expected_revision(shopcart_id):
+    """Returns the revision named by the If-Match header, or None when there is nothing to check"""
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    prefix = cart_etag(shopcart_id, "")
+    for etag in request.if_match.as_set():
+        revision = etag[len(prefix):]
+        if etag.startswith(prefix) and revision.isdigit():
+            return int(revision)
+    app.logger.info("If-Match does not name a revision of shopcart %s", shopcart_id)
+    abort(
+        status.HTTP_412_PRECONDITION_FAILED,
+        "If-Match does not name a revision of shopcart {}".format(shopcart_id)
+    )
 
 def check_content_type(media_type):
     """Check that the media type is correct"""
@@ -0,0 +1,249 @@
+"""
+Read replica routing
+
+The session of the service picks the database of each statement. Writes
+and everything outside a GET request go to the primary. The read-only model
+methods of a GET request read from one of the replicas in DB_REPLICA_URIS,
+the same one for the whole request so the ETag and the items it names come
+from the same copy of the data.
+
+Read your writes: a response to a write sets a cookie for
+DB_REPLICA_STICKY_SECONDS, the reads of a client that sends it back go to
+the primary until the replicas have caught up with its write.
+
+Health: a replica that cannot be reached, or on Postgres lags the primary
+by more than DB_REPLICA_MAX_LAG seconds, is ejected for
+DB_REPLICA_EJECT_SECONDS. A read that fails on a replica is run again on
+the primary, and the primary serves every read while no replica is healthy.
+
+Shards: the statements of a model method of one cart go to the shard of the
+cart, see service.sharding. The replicas are replicas of the primary and are
+not used when the carts are sharded.
+"""
+import functools
+import itertools
+import logging
+import threading
+import time
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import orm, text
+from sqlalchemy.exc import DBAPIError
+from service.metrics import REPLICA_EJECTIONS, REPLICA_READS
+from service.pool import engine_options
+from service.resilience import is_connection_failure
+
+logger = logging.getLogger("flask.app")
+
+STICKY_COOKIE = "shopcart_read_primary_until"
+READ_METHODS = ("GET", "HEAD")
+
+# seconds the replica is behind, 0 when it has replayed all it received
+LAG_QUERY = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+
+class RoutingSession(SignallingSession):
+    """
+    A session that sends its statements to the bind chosen for them: the
+    read replica, then the shard of the cart, then the primary
+    """
+
+    def get_bind(self, mapper=None, clause=None):
+        bind = self.info.get("read_bind")
+        if bind is None:
+            bind = self.info.get("shard_bind")
+        if bind is not None:
+            return bind
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy with a RoutingSession, and the pool options of each
+    database picked for its own URI as the replicas may be of another kind
+    """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def create_engine(self, sa_url, engine_opts):
+        engine_opts.update(engine_options(self.get_app().config, str(sa_url)))
+        return super().create_engine(sa_url, engine_opts)
+
+
+class Replica:
+    """ One read replica and its health """
+
+    def __init__(self, name):
+        self.name = name
+        self.ejected_until = 0.0
+        self.checked_at = 0.0
+        self.ejections = 0
+        self.last_error = None
+
+    def healthy(self, now):
+        """ Returns True when the replica is not ejected """
+        return self.ejected_until <= now
+
+
+class ReplicaSet:
+    """ The replicas of an app, handed out in turn while they are healthy """
+
+    def __init__(self, db, app):
+        self.db = db
+        self.app = app
+        config = app.config
+        self.replicas = [Replica(name) for name in replica_binds(config)]
+        self.eject_seconds = config["DB_REPLICA_EJECT_SECONDS"]
+        self.max_lag = config["DB_REPLICA_MAX_LAG"]
+        self.check_interval = config["DB_REPLICA_CHECK_INTERVAL"]
+        self._turns = itertools.cycle(range(len(self.replicas))) if self.replicas else None
+        self._lock = threading.Lock()
+
+    def engine(self, replica):
+        """ Returns the engine of a replica """
+        return self.db.get_engine(self.app, bind=replica.name)
+
+    def choose(self):
+        """ Returns the next healthy replica, or None to read from the primary """
+        for _ in self.replicas:
+            with self._lock:
+                replica = self.replicas[next(self._turns)]
+            now = time.monotonic()
+            if replica.healthy(now) and self.check_lag(replica, now):
+                return replica
+        return None
+
+    def check_lag(self, replica, now):
+        """ Ejects a Postgres replica behind by more than max_lag, checked every check_interval """
+        engine = self.engine(replica)
+        if not self.max_lag or engine.dialect.name != "postgresql":
+            return True
+        if now - replica.checked_at < self.check_interval:
+            return True
+        replica.checked_at = now
+        try:
+            with engine.connect() as connection:
+                lag = float(connection.execute(LAG_QUERY).scalar() or 0)
+        except DBAPIError as error:
+            self.eject(replica, error)
+            return False
+        if lag > self.max_lag:
+            self.eject(replica, "{:.1f} seconds behind".format(lag))
+            return False
+        return True
+
+    def eject(self, replica, reason):
+        """ Stops reading from a replica for eject_seconds """
+        logger.warning("Ejecting read replica %s for %s seconds: %s", replica.name, self.eject_seconds, reason)
+        REPLICA_EJECTIONS.labels(replica.name).inc()
+        with self._lock:
+            replica.ejected_until = time.monotonic() + self.eject_seconds
+            replica.ejections += 1
+            replica.last_error = str(reason)
+
+    def stats(self):
+        """ Returns the health of every replica """
+        now = time.monotonic()
+        return {
+            replica.name: {
+                "healthy": replica.healthy(now),
+                "ejected_for": round(max(0.0, replica.ejected_until - now), 3),
+                "ejections": replica.ejections,
+                "last_error": replica.last_error,
+            }
+            for replica in self.replicas
+        }
+
+
+def replica_binds(config):
+    """ Returns the SQLALCHEMY_BINDS of the replicas in DB_REPLICA_URIS, none when sharded """
+    if config.get("DB_SHARD_URIS"):
+        return {}
+    return {"replica_{}".format(index): uri for index, uri in enumerate(config.get("DB_REPLICA_URIS") or [])}
+
+
+def init_app(app, db):
+    """ Adds the replicas of DB_REPLICA_URIS to the binds of the app """
+    binds = replica_binds(app.config)
+    if app.config.get("DB_REPLICA_URIS") and not binds:
+        logger.warning("The read replicas are not used, the carts are sharded")
+    if binds:
+        app.config["SQLALCHEMY_BINDS"] = dict(app.config.get("SQLALCHEMY_BINDS") or {}, **binds)
+        app.before_request(_forget_replica)
+        app.after_request(_stick_to_primary)
+    app.extensions["replicas"] = ReplicaSet(db, app)
+
+
+def read_replica():
+    """ Returns the replica the reads of this request go to, or None for the primary """
+    replicas = current_app.extensions.get("replicas")
+    if not replicas or not replicas.replicas or not has_request_context():
+        return None
+    if "db_replica" not in g:
+        g.db_replica = None
+        if request.method in READ_METHODS and not sticky():
+            g.db_replica = replicas.choose()
+    return g.db_replica
+
+
+def sticky():
+    """ Returns True while the client is reading its own writes """
+    try:
+        until = float(request.cookies.get(STICKY_COOKIE, 0))
+    except ValueError:
+        return False
+    return until > time.time()
+
+
+def _forget_replica():
+    # the app context, and g, outlives the request when one was pushed before it
+    g.pop("db_replica", None)
+
+
+def _stick_to_primary(response):
+    if request.method not in READ_METHODS and response.status_code < 400:
+        until = time.time() + current_app.config["DB_REPLICA_STICKY_SECONDS"]
+        response.set_cookie(
+            STICKY_COOKIE, "{:.3f}".format(until),
+            max_age=int(current_app.config["DB_REPLICA_STICKY_SECONDS"]) + 1, httponly=True,
+        )
+    return response
+
+
+def read_only(func, db):
+    """
+    Runs a read-only model method on the read replica of the request
+
+    A read that fails on the replica runs again on the primary, the replica
+    is ejected when it could not be reached
+    """
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        replica = read_replica()
+        if replica is None:
+            REPLICA_READS.labels("primary").inc()
+            return func(*args, **kwargs)
+        replicas = current_app.extensions["replicas"]
+        session = db.session()
+        session.info["read_bind"] = replicas.engine(replica)
+        try:
+            result = func(*args, **kwargs)
+            REPLICA_READS.labels(replica.name).inc()
+            return result
+        except DBAPIError as error:
+            session.info.pop("read_bind", None)
+            session.rollback()
+            if is_connection_failure(error):
+                replicas.eject(replica, error.orig)
+                g.db_replica = None
+            REPLICA_READS.labels("primary").inc()
+            return func(*args, **kwargs)
+        finally:
+            session.info.pop("read_bind", None)
+
+    return wrapper
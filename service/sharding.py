@@ -0,0 +1,278 @@
+"""
+Sharding of the carts by shopcart_id
+
+The primary database is the first shard and every URI in DB_SHARD_URIS
+adds one. Each shard holds the whole schema, and a cart, its items and its
+revision live together on the shard a consistent hash ring picks for its
+shopcart_id. Every shard owns DB_SHARD_VNODES points of the ring, so a
+shard added at the end of the list takes about 1/N of the carts from the
+others and no cart moves between the shards that were already there.
+
+A model method of one cart runs on the shard of the cart, see routed(),
+and an item expired by a commit is loaded again from the shard of its cart,
+see ShardQuery. The methods that span carts run on every shard in turn, see scatter(), and
+merge the rows of the shards in (shopcart_id, product_id) order as they
+are read, see gather().
+
+flask db upgrade migrates every shard with the primary, see
+migrations/env.py. Adding a shard: add it to DB_SHARD_URIS, set
+DB_SHARD_PREVIOUS_COUNT to the number of shards before it and restart the
+service, which migrates it first, then move the carts that now belong to it with
+flask shards rebalance, see service.commands. It moves one cart per short
+transaction while the service runs. Until it is done the workers keep the
+previous ring too: a cart still on its shard of that ring is moved by the
+first call about it, see ShardSet.settle, and a row found on two shards
+by a read across carts is kept from the shard of its cart, see gather().
+Once every cart is moved unset DB_SHARD_PREVIOUS_COUNT and restart.
+
+The read replicas are replicas of the primary, with more than one shard
+every read goes to the shard of the cart.
+"""
+import bisect
+import functools
+import hashlib
+import heapq
+import inspect
+import itertools
+import logging
+import operator
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from flask import current_app
+from flask_sqlalchemy import BaseQuery
+from service.metrics import SHARD_CALLS, SHARD_MOVES
+
+logger = logging.getLogger("flask.app")
+
+CART_ORDER = operator.attrgetter("shopcart_id", "product_id")
+
+
+def ring_hash(key):
+    """ Returns a 64 bit hash of a string that is the same in every process """
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class ShardMap:
+    """ A consistent hash ring of shopcart ids over the shard names """
+
+    def __init__(self, names, vnodes=64):
+        self.names = list(names)
+        points = sorted(
+            (ring_hash("{}#{}".format(name, vnode)), name)
+            for name in self.names for vnode in range(vnodes)
+        )
+        self._points = [point for point, _ in points]
+        self._owners = [name for _, name in points]
+
+    def shard_for(self, shopcart_id):
+        """ Returns the name of the shard that holds a cart """
+        if len(self.names) == 1:
+            return self.names[0]
+        index = bisect.bisect(self._points, ring_hash(str(shopcart_id)))
+        return self._owners[index % len(self._owners)]
+
+
+class ShardSet:
+    """ The shards of an app and the engines of their binds """
+
+    # carts remembered as settled, the least recently used is forgotten
+    SETTLED_SIZE = 100000
+    # locks of the carts being settled, a cart takes the lock of its id modulo this
+    SETTLE_STRIPES = 64
+
+    def __init__(self, db, app, mover=None):
+        self.db = db
+        self.app = app
+        # the first shard is the primary, its bind is None
+        self.binds = dict({"shard_0": None}, **{name: name for name in shard_binds(app.config)})
+        self.names = list(self.binds)
+        self.map = ShardMap(self.names, app.config["DB_SHARD_VNODES"])
+        # the ring before the last shards were added, while the carts are rebalanced
+        count = app.config.get("DB_SHARD_PREVIOUS_COUNT") or 0
+        self.previous = ShardMap(self.names[:count], app.config["DB_SHARD_VNODES"]) if 0 < count < len(self.names) else None
+        self.mover = mover
+        self.settled = OrderedDict()
+        self._settled_lock = threading.Lock()
+        self._stripes = [threading.Lock() for _ in range(self.SETTLE_STRIPES)]
+
+    @property
+    def enabled(self):
+        """ True when the carts are spread over more than one database """
+        return len(self.names) > 1
+
+    def engine(self, name):
+        """ Returns the engine of a shard """
+        return self.db.get_engine(self.app, bind=self.binds[name])
+
+    def shard_for(self, shopcart_id):
+        """ Returns the name of the shard that holds a cart """
+        return self.map.shard_for(shopcart_id)
+
+    def settle(self, shopcart_id):
+        """
+        Moves a cart still on its shard of the previous ring to its shard
+
+        Runs once per cart in a worker while the carts are rebalanced, the
+        mover is a no-op for a cart that was moved already. Only the calls
+        about carts of the same lock stripe wait for a move
+        """
+        if self.previous is None or self.is_settled(shopcart_id):
+            return
+        with self._stripes[shopcart_id % len(self._stripes)]:
+            if self.is_settled(shopcart_id):
+                return
+            source = self.previous.shard_for(shopcart_id)
+            target = self.shard_for(shopcart_id)
+            if source != target and self.mover(self.engine(source), self.engine(target), shopcart_id):
+                logger.info("Shopcart %d moved from %s to %s", shopcart_id, source, target)
+                SHARD_MOVES.labels("access").inc()
+            with self._settled_lock:
+                self.settled[shopcart_id] = True
+                if len(self.settled) > self.SETTLED_SIZE:
+                    self.settled.popitem(last=False)
+
+    def is_settled(self, shopcart_id):
+        """ Returns True when a cart was settled lately in this worker """
+        with self._settled_lock:
+            if shopcart_id not in self.settled:
+                return False
+            self.settled.move_to_end(shopcart_id)
+            return True
+
+    def group(self, shopcart_ids):
+        """ Returns the shopcart ids of each shard that holds any of them """
+        groups = {}
+        for shopcart_id in shopcart_ids:
+            groups.setdefault(self.shard_for(shopcart_id), []).append(shopcart_id)
+        return groups
+
+    @contextmanager
+    def use(self, session, name):
+        """ Sends the statements of the session to a shard inside the block """
+        previous = session.info.get("shard_bind")
+        session.info["shard_bind"] = self.engine(name)
+        SHARD_CALLS.labels(name).inc()
+        try:
+            yield
+        finally:
+            if previous is None:
+                session.info.pop("shard_bind", None)
+            else:
+                session.info["shard_bind"] = previous
+
+
+class ShardQuery(BaseQuery):
+    """ A query that loads the expired attributes of an item from the shard of its cart """
+
+    def _execute_and_instances(self, querycontext):
+        state = self._refresh_state
+        shards = current_app.extensions.get("shards")
+        if state is None or shards is None or not shards.enabled:
+            return super()._execute_and_instances(querycontext)
+        identity = dict(zip((column.key for column in state.mapper.primary_key), state.identity))
+        if "shopcart_id" not in identity:
+            return super()._execute_and_instances(querycontext)
+        with shards.use(self.session, shards.shard_for(identity["shopcart_id"])):
+            return super()._execute_and_instances(querycontext)
+
+
+def shard_binds(config):
+    """ Returns the SQLALCHEMY_BINDS of the shards in DB_SHARD_URIS """
+    return {"shard_{}".format(index): uri for index, uri in enumerate(config.get("DB_SHARD_URIS") or [], 1)}
+
+
+def init_app(app, db, mover):
+    """
+    Adds the shards of DB_SHARD_URIS to the binds of the app, mover(source,
+    target, shopcart_id) moves a cart between the engines of two shards
+    """
+    binds = shard_binds(app.config)
+    if binds:
+        app.config["SQLALCHEMY_BINDS"] = dict(app.config.get("SQLALCHEMY_BINDS") or {}, **binds)
+        logger.info("Carts are sharded over %d databases", len(binds) + 1)
+    shards = app.extensions["shards"] = ShardSet(db, app, mover)
+    if shards.previous is not None:
+        logger.warning("Carts are rebalanced from %d to %d shards", len(shards.previous.names), len(shards.names))
+
+
+def routed(func, db):
+    """
+    Runs a model method of one cart on the shard of the cart
+
+    The cart is the shopcart_id argument of the method, or the shopcart_id
+    of the item for an instance method. A method called with a shopcart_id
+    of None runs on the shard already in use, it scatters by itself
+    """
+    parameters = list(inspect.signature(func).parameters)
+    position = parameters.index("shopcart_id") if "shopcart_id" in parameters else None
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        shards = current_app.extensions["shards"]
+        if not shards.enabled:
+            return func(*args, **kwargs)
+        if position is None:
+            shopcart_id = args[0].shopcart_id
+        elif position < len(args):
+            shopcart_id = args[position]
+        else:
+            shopcart_id = kwargs.get("shopcart_id")
+        if shopcart_id is None:
+            return func(*args, **kwargs)
+        shards.settle(shopcart_id)
+        with shards.use(db.session(), shards.shard_for(shopcart_id)):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+def scatter(db, load, *args):
+    """ Yields load(*args) run on each shard in turn """
+    shards = current_app.extensions["shards"]
+    session = db.session()
+    for name in shards.names:
+        with shards.use(session, name):
+            result = load(*args)
+        yield result
+
+
+def scatter_carts(db, shopcart_ids):
+    """ Yields the shopcart ids held by each shard while the session uses that shard """
+    shards = current_app.extensions["shards"]
+    session = db.session()
+    for shopcart_id in shopcart_ids:
+        shards.settle(shopcart_id)
+    for name, ids in shards.group(shopcart_ids).items():
+        with shards.use(session, name):
+            yield ids
+
+
+def gather(db, load, *args, key=CART_ORDER):
+    """
+    Runs load(*args) on every shard and merges what they return
+
+    The rows of each shard must come in the order of key, (shopcart_id,
+    product_id) by default, the merge keeps that order and pulls the next row of a shard only when it is
+    needed, so streamed results stay streamed. While the carts are
+    rebalanced a cart being moved is on two shards for a moment, of the rows
+    of one key found on both the one on the shard of its cart is kept. Returns an
+    iterator, or what load returned when there is a single shard
+    """
+    shards = current_app.extensions["shards"]
+    results = list(scatter(db, load, *args))
+    if len(results) == 1:
+        return results[0]
+    if shards.previous is None:
+        return heapq.merge(*results, key=key)
+    return owned_rows(shards, results, key)
+
+
+def owned_rows(shards, results, key=CART_ORDER):
+    """ Merges the rows of every shard, keeping one row of each key """
+    tagged = [zip(rows, itertools.repeat(name)) for name, rows in zip(shards.names, results)]
+    merged = heapq.merge(*tagged, key=lambda pair: key(pair[0]))
+    for _, copies in itertools.groupby(merged, key=lambda pair: key(pair[0])):
+        copies = list(copies)
+        owner = shards.shard_for(copies[0][0].shopcart_id)
+        yield next((row for row, name in copies if name == owner), copies[0][0])
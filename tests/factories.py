@@ -0,0 +1,32 @@
+"""
+Test Factory to make fake objects for testing
+"""
+import random
+from datetime import datetime, timedelta
+import factory
+from factory.fuzzy import FuzzyInteger
+from service.models import Shopcart
+
+
+class ShopcartFactory(factory.Factory):
+    """ Creates fake Shopcart items """
+
+    class Meta:
+        model = Shopcart
+
+    shopcart_id = factory.Sequence(lambda n: n + 1)
+    product_id = factory.Sequence(lambda n: n + 1)
+    quantity = FuzzyInteger(1, 10)
+    price = factory.LazyFunction(lambda: round(random.uniform(0.5, 500), 2))
+    time_added = factory.LazyFunction(datetime.now)
+    checkout = 0
+
+
+def shopcart_row(**kwargs):
+    """ Returns the columns of a fake Shopcart item, to insert with SQLAlchemy Core or post as JSON """
+    return factory.build(dict, FACTORY_CLASS=ShopcartFactory, **kwargs)
+
+
+def days_ago(days):
+    """ Returns the time a number of days before now, for time_added """
+    return datetime.now() - timedelta(days=days)
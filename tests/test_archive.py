@@ -0,0 +1,140 @@
+"""
+Test cases for the archive of checked out items
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import json
+from service import status
+from service.archive import ARCHIVE_LOCK_ID, archive_carts
+from service.jobs import process_lock
+from service.models import Shopcart, ShopcartArchive, db
+from tests.base import BASE_URL, AppTestCase, sample
+from tests.factories import ShopcartFactory, days_ago
+
+
+######################################################################
+#  A R C H I V E   T E S T   C A S E S
+######################################################################
+class TestArchive(AppTestCase):
+    """ Test Cases for the archive mover and the archived reads """
+
+    config = {
+        "ARCHIVE_BATCH_SIZE": 2,
+        "ARCHIVE_PAUSE": 0,
+    }
+
+    def fill(self):
+        """ Checks out three items of cart 1 and leaves one open, cart 2 is open """
+        for product_id in (1, 2, 3):
+            ShopcartFactory(shopcart_id=1, product_id=product_id, quantity=1, price=1.5,
+                            time_added=days_ago(product_id), checkout=1).create()
+        ShopcartFactory(shopcart_id=1, product_id=4).create()
+        ShopcartFactory(shopcart_id=2, product_id=1).create()
+
+    def test_archive_batch(self):
+        """Test a batch moves the oldest checked out items and moves the revision"""
+        self.fill()
+        revision = Shopcart.get_revision(1)
+        self.assertEqual(sorted(Shopcart.archive_batch(2)), [(1, 2), (1, 3)])
+        self.assertEqual(Shopcart.get_revision(1), revision + 1)
+        self.assertEqual(sorted(item.product_id for item in Shopcart.find_by_shopcart_id(1)), [1, 4])
+        archived = Shopcart.find_archived_rows(1)
+        self.assertEqual(sorted(row.product_id for row in archived), [2, 3])
+        self.assertEqual({row.checkout for row in archived}, {1})
+        self.assertEqual(db.session.query(ShopcartArchive).count(), 2)
+
+    def test_archive_carts(self):
+        """Test a run moves every checked out item and keeps each checkout"""
+        self.fill()
+        moved = sample("shopcart_archived_items_total")
+        self.assertEqual(archive_carts(), {"shard_0": 3})
+        self.assertEqual(sample("shopcart_archived_items_total"), moved + 3)
+        self.assertEqual([item.product_id for item in Shopcart.find_by_shopcart_id(1)], [4])
+        # the same item checked out again is archived again
+        ShopcartFactory(shopcart_id=1, product_id=1, quantity=5, checkout=1).create()
+        result = self.app.test_cli_runner().invoke(args=["carts", "archive"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Archived 1 items in total", result.output)
+        self.assertEqual([row.quantity for row in Shopcart.find_archived_rows(1, 1)], [1, 5])
+
+    def test_single_runner(self):
+        """Test a run is skipped while another one holds the lock"""
+        self.fill()
+        with process_lock(ARCHIVE_LOCK_ID):
+            self.assertIsNone(archive_carts())
+        self.assertEqual(Shopcart.find_archived_rows(1), [])
+
+    def test_read_cart_include_archived(self):
+        """Test the cart only returns archived items when asked"""
+        self.fill()
+        archive_carts()
+        resp = self.client.get(BASE_URL + "/1")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([row["product_id"] for row in resp.get_json()], [4])
+        etag = resp.headers["ETag"]
+        resp = self.client.get(BASE_URL + "/1", query_string={"include_archived": "true"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(row["product_id"] for row in resp.get_json()), [1, 2, 3, 4])
+        self.assertNotEqual(resp.headers["ETag"], etag)
+        resp = self.client.get(BASE_URL + "/1", query_string={"include_archived": "true"},
+                               headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_read_item_include_archived(self):
+        """Test an archived item is only found when asked"""
+        self.fill()
+        archive_carts()
+        resp = self.client.get(BASE_URL + "/1/items/2")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.client.get(BASE_URL + "/1/items/2", query_string={"include_archived": "true"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["checkout"], 1)
+        resp = self.client.get(BASE_URL + "/1/items/4", query_string={"include_archived": "true"})
+        self.assertEqual(resp.get_json()["checkout"], 0)
+
+    def test_summary_include_archived(self):
+        """Test the summaries only add up archived items when asked"""
+        self.fill()
+        before = self.client.get(BASE_URL + "/1/summary", query_string={"by_checkout": "true"}).get_json()
+        self.assertEqual(before["checked_out"]["item_count"], 3)
+        archive_carts()
+        resp = self.client.get(BASE_URL + "/1/summary", query_string={"by_checkout": "true"})
+        self.assertEqual(resp.get_json()["item_count"], 1)
+        self.assertEqual(resp.get_json()["checked_out"]["item_count"], 0)
+        resp = self.client.get(BASE_URL + "/1/summary", query_string={"by_checkout": "true", "include_archived": "true"})
+        self.assertEqual(resp.get_json(), before)
+        resp = self.client.get(BASE_URL + "/summary", query_string={"shopcart_ids": "2,1", "include_archived": "true"})
+        self.assertEqual([summary["item_count"] for summary in resp.get_json()], [1, 4])
+
+    def test_list_include_archived(self):
+        """Test the pages of the list only return archived items when asked"""
+        self.fill()
+        archive_carts()
+        ShopcartFactory(shopcart_id=1, product_id=1, checkout=0).create()
+        resp = self.client.get(BASE_URL)
+        self.assertEqual([(row["shopcart_id"], row["product_id"]) for row in resp.get_json()], [(1, 1), (1, 4), (2, 1)])
+        keys = []
+        url = BASE_URL + "?include_archived=true&limit=2"
+        while url:
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            keys += [(row["shopcart_id"], row["product_id"], row["checkout"]) for row in resp.get_json()]
+            link = resp.headers.get("Link")
+            url = link[link.index("<") + 1:link.index(">")] if link else None
+        # the archived checkouts of an item follow it
+        self.assertEqual(keys, [(1, 1, 0), (1, 1, 1), (1, 2, 1), (1, 3, 1), (1, 4, 0), (2, 1, 0)])
+        resp = self.client.get(BASE_URL, query_string={"shopcart_id": 1, "product_id": 1, "include_archived": "true"})
+        self.assertEqual([row["checkout"] for row in resp.get_json()], [0, 1])
+
+    def test_export_include_archived(self):
+        """Test the export only streams archived items when asked"""
+        self.fill()
+        archive_carts()
+        resp = self.client.get(BASE_URL + "/export")
+        self.assertEqual(len(resp.get_data(as_text=True).splitlines()), 2)
+        resp = self.client.get(BASE_URL + "/export", query_string={"include_archived": "true"})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual([(line["shopcart_id"], line["product_id"]) for line in lines], [(1, 1), (1, 2), (1, 3), (1, 4), (2, 1)])
@@ -0,0 +1,166 @@
+"""
+Test cases for the Shopcart read cache
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import time
+import unittest
+import fakeredis
+from service.cache import MISS, NullCache, MemoryCache, RedisCache, create_cache
+
+
+######################################################################
+#  C A C H E   T E S T   C A S E S
+######################################################################
+class TestMemoryCache(unittest.TestCase):
+    """ Test Cases for the in process cache """
+
+    def test_get_and_set(self):
+        """Test read back a cached value"""
+        cache = MemoryCache()
+        self.assertIs(cache.get("cart:1"), MISS)
+        cache.set("cart:1", [{"product_id": 100}])
+        self.assertEqual(cache.get("cart:1"), [{"product_id": 100}])
+        stats = cache.stats()
+        self.assertEqual(stats["backend"], "memory")
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["size"], 1)
+
+    def test_negative_entries(self):
+        """Test missing items are cached for the negative TTL"""
+        cache = MemoryCache(ttl=30, negative_ttl=0.05)
+        cache.set("item:1:100", None)
+        cache.set("cart:1", [])
+        self.assertIsNone(cache.get("item:1:100"))
+        self.assertEqual(cache.get("cart:1"), [])
+        time.sleep(0.06)
+        self.assertIs(cache.get("item:1:100"), MISS)
+        self.assertIs(cache.get("cart:1"), MISS)
+
+    def test_ttl(self):
+        """Test entries expire"""
+        cache = MemoryCache(ttl=0.05)
+        cache.set("cart:1", [{"product_id": 100}])
+        time.sleep(0.06)
+        self.assertIs(cache.get("cart:1"), MISS)
+        self.assertEqual(cache.size(), 0)
+
+    def test_lru_eviction(self):
+        """Test the least recently used entry is evicted"""
+        cache = MemoryCache(max_size=2)
+        cache.set("cart:1", [1])
+        cache.set("cart:2", [2])
+        cache.get("cart:1")
+        cache.set("cart:3", [3])
+        self.assertIs(cache.get("cart:2"), MISS)
+        self.assertEqual(cache.get("cart:1"), [1])
+        self.assertEqual(cache.get("cart:3"), [3])
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_delete_and_clear(self):
+        """Test entries are removed"""
+        cache = MemoryCache()
+        cache.set("cart:1", [1])
+        cache.set("item:1:1", {"product_id": 1})
+        cache.set("cart:2", [2])
+        cache.delete("cart:1", "item:1:1", "item:1:2")
+        self.assertIs(cache.get("cart:1"), MISS)
+        self.assertIs(cache.get("item:1:1"), MISS)
+        self.assertEqual(cache.get("cart:2"), [2])
+        cache.clear()
+        self.assertEqual(cache.size(), 0)
+
+    def test_fill(self):
+        """Test a fill never replaces an entry or a key that was just removed"""
+        cache = MemoryCache(tombstone_ttl=0.05)
+        cache.fill("cart:1", [1])
+        cache.fill("cart:1", [2])
+        self.assertEqual(cache.get("cart:1"), [1])
+        cache.delete("cart:1")
+        cache.fill("cart:1", [3])
+        self.assertIs(cache.get("cart:1"), MISS)
+        self.assertEqual(cache.size(), 0)
+        time.sleep(0.06)
+        cache.fill("cart:1", [4])
+        self.assertEqual(cache.get("cart:1"), [4])
+
+
+class TestRedisCache(unittest.TestCase):
+    """ Test Cases for the shared cache """
+
+    def setUp(self):
+        self.server = fakeredis.FakeServer()
+        self.client = fakeredis.FakeRedis(server=self.server)
+        self.cache = RedisCache(self.client, ttl=30, negative_ttl=5)
+
+    def test_get_and_set(self):
+        """Test read back a cached value"""
+        self.assertIs(self.cache.get("cart:1"), MISS)
+        self.cache.set("cart:1", [{"product_id": 100, "time_added": "2021-07-07T07:10:26"}])
+        self.assertEqual(self.cache.get("cart:1"), [{"product_id": 100, "time_added": "2021-07-07T07:10:26"}])
+        self.cache.set("item:1:100", None)
+        self.assertIsNone(self.cache.get("item:1:100"))
+        self.assertLessEqual(self.client.pttl("shopcarts:item:1:100"), 5000)
+        self.assertGreater(self.client.pttl("shopcarts:cart:1"), 5000)
+        stats = self.cache.stats()
+        self.assertEqual(stats["backend"], "redis")
+        self.assertEqual(stats["hits"], 2)
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["size"], 2)
+
+    def test_delete_and_clear(self):
+        """Test entries are removed"""
+        self.cache.set("cart:1", [1])
+        self.cache.set("cart:2", [2])
+        self.client.set("other", "1")
+        self.cache.delete("cart:1")
+        self.assertIs(self.cache.get("cart:1"), MISS)
+        self.assertEqual(self.cache.get("cart:2"), [2])
+        self.cache.clear()
+        self.assertIs(self.cache.get("cart:2"), MISS)
+        self.assertEqual(self.client.get("other"), b"1")
+
+    def test_fill(self):
+        """Test a fill never replaces an entry or a key that was just removed"""
+        self.cache.fill("cart:1", [1])
+        self.cache.fill("cart:1", [2])
+        self.assertEqual(self.cache.get("cart:1"), [1])
+        self.cache.delete("cart:1")
+        self.cache.fill("cart:1", [3])
+        self.assertIs(self.cache.get("cart:1"), MISS)
+        self.assertLessEqual(self.client.pttl("shopcarts:cart:1"), 5000)
+        self.client.delete("shopcarts:cart:1")
+        self.cache.fill("cart:1", [4])
+        self.assertEqual(self.cache.get("cart:1"), [4])
+
+    def test_server_down(self):
+        """Test Redis errors are treated as a miss"""
+        self.server.connected = False
+        self.cache.set("cart:1", [1])
+        self.assertIs(self.cache.get("cart:1"), MISS)
+        self.cache.delete("cart:1")
+        self.assertIsNone(self.cache.stats()["size"])
+
+
+class TestCreateCache(unittest.TestCase):
+    """ Test Cases for choosing the backend """
+
+    def test_create_cache(self):
+        """Test the backend comes from the config"""
+        self.assertIsInstance(create_cache({}), NullCache)
+        cache = create_cache({"CACHE_BACKEND": "memory", "CACHE_MAX_SIZE": 5, "CACHE_TTL": 10})
+        self.assertIsInstance(cache, MemoryCache)
+        self.assertEqual(cache.max_size, 5)
+        self.assertEqual(cache.ttl, 10)
+        cache = create_cache({"CACHE_BACKEND": "redis", "CACHE_REDIS_URL": "redis://localhost:6379/0"})
+        self.assertIsInstance(cache, RedisCache)
+
+    def test_null_cache(self):
+        """Test nothing is cached when caching is off"""
+        cache = NullCache()
+        cache.set("cart:1", [1])
+        self.assertIs(cache.get("cart:1"), MISS)
+        self.assertEqual(cache.stats()["misses"], 1)
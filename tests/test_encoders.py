@@ -0,0 +1,91 @@
+"""
+Test cases for the fast JSON encoders
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import json
+import unittest
+from datetime import datetime
+from types import SimpleNamespace
+from flask_restx import fields, marshal
+from service import app
+from service.encoders import compile_encoder, dumps, json_response
+from service.models import Shopcart, ShopcartRow
+from service.routes import api, shopcart_model
+
+ITEMS = [
+    Shopcart(shopcart_id=1, product_id=2, quantity=3, price=0.1,
+             time_added=datetime(2021, 1, 2, 3, 4, 5, 678), checkout=0),
+    Shopcart(shopcart_id=1, product_id=3, quantity=1, price=1e-05,
+             time_added=datetime(2021, 1, 2, 3, 4, 5), checkout=1),
+    Shopcart(shopcart_id=2, product_id=4, quantity=10, price=12345.678,
+             time_added=datetime(2021, 6, 30, 23, 59, 59, 999999), checkout=0),
+]
+
+
+######################################################################
+#  E N C O D E R   T E S T   C A S E S
+######################################################################
+class TestEncoders(unittest.TestCase):
+    """ Test Cases for the compiled encoders """
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        self.addCleanup(self.context.pop)
+        self.addCleanup(app.config.__setitem__, "JSON_BACKEND", app.config["JSON_BACKEND"])
+        app.config["JSON_BACKEND"] = "json"
+
+    def test_same_as_marshal(self):
+        """Test the encoder makes the dicts marshal_with makes"""
+        encode = compile_encoder(shopcart_model)
+        for item in ITEMS:
+            self.assertEqual(list(encode(item).items()),
+                             list(marshal(item.serialize(), shopcart_model).items()))
+
+    def test_rows_same_as_items(self):
+        """Test a read-only row encodes like the item it was loaded from"""
+        encode = compile_encoder(shopcart_model)
+        for item in ITEMS:
+            row = ShopcartRow(**{name: getattr(item, name) for name in ShopcartRow._fields})
+            self.assertEqual(encode(row), encode(item))
+            self.assertEqual(row.serialize(), item.serialize())
+
+    def test_same_bytes_as_marshal(self):
+        """Test the response has the bytes flask-restx writes"""
+        encode = compile_encoder(shopcart_model)
+        expected = json.dumps(marshal([item.serialize() for item in ITEMS], shopcart_model)) + "\n"
+        with app.test_request_context():
+            resp = json_response([encode(item) for item in ITEMS])
+        self.assertEqual(resp.get_data(), expected.encode("utf-8"))
+        self.assertEqual(resp.content_type, "application/json")
+
+    def test_sorted_keys(self):
+        """Test the sorted encoder matches json.dumps with sort_keys"""
+        encode = compile_encoder(shopcart_model, sort_keys=True)
+        for item in ITEMS:
+            self.assertEqual(dumps(encode(item)),
+                             json.dumps(item.serialize(), sort_keys=True).encode("utf-8"))
+
+    def test_missing_values_and_defaults(self):
+        """Test None is encoded like marshal_with encodes it"""
+        model = api.model("EncoderTest", {
+            "count": fields.Integer(),
+            "label": fields.String(default="none"),
+            "when": fields.DateTime(),
+            "renamed": fields.Integer(attribute="other"),
+            "flag": fields.Boolean(),
+        })
+        encode = compile_encoder(model)
+        for obj in (SimpleNamespace(count=None, label=None, when=None, other=None, flag=None),
+                    SimpleNamespace(count="7", label=5, when=datetime(2021, 1, 1), other=3, flag=1)):
+            self.assertEqual(encode(obj), dict(marshal(vars(obj), model)))
+
+    def test_orjson_backend(self):
+        """Test orjson writes the same documents"""
+        app.config["JSON_BACKEND"] = "orjson"
+        encode = compile_encoder(shopcart_model)
+        data = [encode(item) for item in ITEMS]
+        self.assertEqual(json.loads(dumps(data)), json.loads(json.dumps(data)))
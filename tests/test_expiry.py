@@ -0,0 +1,96 @@
+"""
+Test cases for the expiry of abandoned carts
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import logging
+import os
+import time
+from service import create_app, status
+from service.expiry import EXPIRY_LOCK_ID, expire_carts
+from service.jobs import process_lock
+from service.models import Shopcart, db
+from tests.base import DATABASE_URI, AppTestCase, sample
+from tests.factories import ShopcartFactory, days_ago
+
+
+######################################################################
+#  C A R T   E X P I R Y   T E S T   C A S E S
+######################################################################
+class TestCartExpiry(AppTestCase):
+    """ Test Cases for the expiry job """
+
+    config = {
+        "CART_EXPIRY_DAYS": 30,
+        "CART_EXPIRY_BATCH_SIZE": 2,
+        "CART_EXPIRY_PAUSE": 0,
+    }
+
+    def fill(self):
+        """ Adds 5 abandoned items, an old checked out one and a recent one """
+        for product_id in range(5):
+            ShopcartFactory(shopcart_id=1, product_id=product_id, time_added=days_ago(40 + product_id)).create()
+        ShopcartFactory(shopcart_id=2, product_id=1, time_added=days_ago(60), checkout=1).create()
+        ShopcartFactory(shopcart_id=2, product_id=2, time_added=days_ago(1)).create()
+
+    def test_expire_batch(self):
+        """Test a batch removes the oldest abandoned items and moves the revisions"""
+        self.fill()
+        revision = Shopcart.get_revision(1)
+        keys = Shopcart.expire_batch(days_ago(30), 2)
+        self.assertEqual(sorted(keys), [(1, 3), (1, 4)])
+        self.assertEqual(Shopcart.get_revision(1), revision + 1)
+        self.assertEqual(len(Shopcart.find_by_shopcart_id(1)), 3)
+        self.assertEqual(Shopcart.count_expired(days_ago(30)), 3)
+
+    def test_expire_carts(self):
+        """Test a run removes every abandoned item in batches"""
+        self.fill()
+        purged = sample("shopcart_expired_items_total")
+        completed = sample("shopcart_expiry_runs_total", {"outcome": "completed"})
+        self.assertEqual(expire_carts(), {"shard_0": 5})
+        self.assertEqual(Shopcart.find_by_shopcart_id(1), [])
+        self.assertEqual(sorted(item.product_id for item in Shopcart.find_by_shopcart_id(2)), [1, 2])
+        self.assertEqual(sample("shopcart_expired_items_total"), purged + 5)
+        self.assertEqual(sample("shopcart_expiry_runs_total", {"outcome": "completed"}), completed + 1)
+        self.assertGreater(sample("shopcart_expiry_last_success_timestamp_seconds"), 0)
+        self.assertEqual(expire_carts(days=0.5), {"shard_0": 1})
+
+    def test_dry_run(self):
+        """Test a dry run counts the items and removes nothing"""
+        self.fill()
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=["carts", "expire", "--dry-run", "--days", "42"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Would remove 3 items in total", result.output)
+        self.assertEqual(len(Shopcart.all()), 7)
+        result = runner.invoke(args=["carts", "expire"])
+        self.assertIn("Removed 5 items in total", result.output)
+
+    def test_single_runner(self):
+        """Test a run is skipped while another one holds the lock"""
+        self.fill()
+        skipped = sample("shopcart_expiry_runs_total", {"outcome": "skipped"})
+        with process_lock(EXPIRY_LOCK_ID):
+            self.assertIsNone(expire_carts())
+        self.assertEqual(sample("shopcart_expiry_runs_total", {"outcome": "skipped"}), skipped + 1)
+        self.assertEqual(len(Shopcart.all()), 7)
+
+    def test_scheduled(self):
+        """Test the workers run the expiry on their own when an interval is set"""
+        app = create_app({"TESTING": True, "SQLALCHEMY_DATABASE_URI": DATABASE_URI, "CART_EXPIRY_INTERVAL": 0.05})
+        app.logger.setLevel(logging.CRITICAL)
+        scheduler = app.extensions["jobs"]["cart-expiry"]
+        self.addCleanup(scheduler.stop)
+        self.fill()
+        db.session.remove()
+        resp = app.test_client().get("/")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(scheduler.pid, os.getpid())
+        for _ in range(100):
+            if Shopcart.count_expired(days_ago(30)) == 0:
+                break
+            time.sleep(0.02)
+        self.assertEqual(Shopcart.count_expired(days_ago(30)), 0)
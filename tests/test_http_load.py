@@ -0,0 +1,59 @@
+"""
+Test cases for the HTTP load test report
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import random
+import unittest
+from benchmarks.http_load import DEFAULT_MIX, Operations, Recorder, parse_mix, percentile, report
+
+
+######################################################################
+#  L O A D   T E S T   C A S E S
+######################################################################
+class TestHttpLoad(unittest.TestCase):
+    """ Test Cases for the load test helpers """
+
+    def test_parse_mix(self):
+        """Test a mix is read from the command line"""
+        self.assertEqual(parse_mix("get_cart=50,get_item=25.5,list"),
+                         {"get_cart": 50.0, "get_item": 25.5, "list": 1.0})
+        self.assertRaises(ValueError, parse_mix, "get_everything=1")
+        self.assertRaises(ValueError, parse_mix, "get_cart=-1")
+        self.assertRaises(ValueError, parse_mix, "get_cart=0")
+
+    def test_every_operation(self):
+        """Test every operation in the mix builds a request"""
+        operations = Operations([(1, 100), (2, 200)], random.Random(1))
+        for name in DEFAULT_MIX:
+            method, path, _ = getattr(operations, name)()
+            self.assertIn(method, ("GET", "POST", "PUT", "PATCH", "DELETE"))
+            self.assertTrue(path.startswith("/"))
+
+    def test_percentile(self):
+        """Test the nearest rank percentiles"""
+        ordered = list(range(1, 101))
+        self.assertEqual(percentile(ordered, 50), 50)
+        self.assertEqual(percentile(ordered, 95), 95)
+        self.assertEqual(percentile(ordered, 99), 99)
+        self.assertEqual(percentile([7], 99), 7)
+        self.assertIsNone(percentile([], 50))
+
+    def test_report(self):
+        """Test the results of many threads are added up"""
+        first, second = Recorder(), Recorder()
+        first.record("get_cart", 0.010, 200)
+        first.record("get_cart", 0.030, 404)
+        second.record("get_cart", 0.020, 200)
+        second.record("create_item", 0.050, 500)
+        second.record("create_item", 0.040, "error")
+        total, operations = report([first, second], 2.0)
+        self.assertEqual(total["requests"], 5)
+        self.assertEqual(total["errors"], 2)
+        self.assertEqual(total["throughput_rps"], 2.5)
+        self.assertEqual(total["statuses"], {"200": 2, "404": 1, "500": 1, "error": 1})
+        self.assertEqual(operations["get_cart"]["latency_ms"]["p50"], 20.0)
+        self.assertEqual(operations["get_cart"]["latency_ms"]["max"], 30.0)
+        self.assertEqual(operations["create_item"]["errors"], 2)
@@ -0,0 +1,49 @@
+"""
+Test cases for the Prometheus metrics
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from prometheus_client import CollectorRegistry, multiprocess
+from service.metrics import statement_verb
+
+WORKER_SCRIPT = """
+from service.metrics import REQUEST_COUNT
+REQUEST_COUNT.labels("ShopcartResource", "GET", 200).inc(3)
+"""
+
+
+######################################################################
+#  M E T R I C S   T E S T   C A S E S
+######################################################################
+class TestMetrics(unittest.TestCase):
+    """ Test Cases for the metrics helpers """
+
+    def test_statement_verb(self):
+        """Test SQL statements are grouped by verb"""
+        self.assertEqual(statement_verb("SELECT 1"), "select")
+        self.assertEqual(statement_verb("\n  update shopcart SET x = 1"), "update")
+        self.assertEqual(statement_verb("INSERT INTO shopcart VALUES (1)"), "insert")
+        self.assertEqual(statement_verb("DELETE FROM shopcart"), "delete")
+        self.assertEqual(statement_verb("BEGIN"), "other")
+        self.assertEqual(statement_verb(""), "other")
+
+    def test_workers_are_added_up(self):
+        """Test the metrics of many worker processes are added up"""
+        with tempfile.TemporaryDirectory() as metrics_dir:
+            env = dict(os.environ, PROMETHEUS_MULTIPROC_DIR=metrics_dir)
+            for _ in range(2):
+                subprocess.run([sys.executable, "-c", WORKER_SCRIPT], env=env, check=True)
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry, path=metrics_dir)
+            value = registry.get_sample_value(
+                "shopcart_http_requests_total",
+                {"resource": "ShopcartResource", "method": "GET", "status": "200"},
+            )
+        self.assertEqual(value, 6)
@@ -0,0 +1,66 @@
+"""
+Test cases for the micro-benchmark baseline gate
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import unittest
+from benchmarks.micro import ITEMS_PER_CART, compare, key, rows
+
+BASELINE = {
+    "1000": {
+        "calibration_seconds": 0.01,
+        "python": "3.8.10",
+        "seconds_per_op": {"find": 0.001, "serialize": 0.000004},
+    }
+}
+
+
+######################################################################
+#  M I C R O   B E N C H M A R K   T E S T   C A S E S
+######################################################################
+class TestMicroBenchmarks(unittest.TestCase):
+    """ Test Cases for the micro-benchmark helpers """
+
+    def test_rows(self):
+        """Test every cart and product gets the same number of items"""
+        generated = list(rows(1000))
+        keys = {(row["shopcart_id"], row["product_id"]) for row in generated}
+        self.assertEqual(len(keys), 1000)
+        carts, products = {}, {}
+        for shopcart_id, product_id in keys:
+            carts[shopcart_id] = carts.get(shopcart_id, 0) + 1
+            products[product_id] = products.get(product_id, 0) + 1
+        self.assertEqual(set(carts.values()), {ITEMS_PER_CART})
+        self.assertEqual(set(products.values()), {ITEMS_PER_CART})
+        self.assertEqual(key(999, 1000), (generated[999]["shopcart_id"], generated[999]["product_id"]))
+
+    def test_within_threshold(self):
+        """Test a case as fast as its baseline passes"""
+        results = {"1000": {"find": 0.0011, "serialize": 0.000004}}
+        lines, failed = compare(results, 0.01, BASELINE, 0.25)
+        self.assertFalse(failed)
+        self.assertEqual(len(lines), 2)
+
+    def test_regression(self):
+        """Test a case slower than the threshold fails"""
+        results = {"1000": {"find": 0.0013, "serialize": 0.000004}}
+        lines, failed = compare(results, 0.01, BASELINE, 0.25)
+        self.assertTrue(failed)
+        self.assertIn("REGRESSION", lines[0])
+
+    def test_slower_machine(self):
+        """Test a machine slower on the calibration is not a regression"""
+        results = {"1000": {"find": 0.002, "serialize": 0.000008}}
+        _, failed = compare(results, 0.02, BASELINE, 0.25)
+        self.assertFalse(failed)
+
+    def test_no_baseline(self):
+        """Test a case without a baseline never fails"""
+        results = {"100000": {"find": 1.0}}
+        lines, failed = compare(results, 0.01, BASELINE, 0.25)
+        self.assertFalse(failed)
+        self.assertIn("no baseline", lines[0])
+        _, failed = compare(results, 0.01, None, 0.25)
+        self.assertFalse(failed)
@@ -13,8 +13,10 @@ import os
 import logging
 import unittest
 from werkzeug.exceptions import NotFound
-from service.models import Shopcart, DataValidationError, db, DatabaseConnectionError
+from flask_migrate import upgrade, downgrade
+from service.models import Shopcart, DataValidationError, db, DatabaseConnectionError, RevisionMismatchError, NegativeQuantityError
 from service import app
+from service.cache import MemoryCache, NullCache
 from datetime import datetime
 
 DATABASE_URI = os.getenv(
@@ -36,11 +38,14 @@ class TestShopcartModel(unittest.TestCase):
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
         app.logger.setLevel(logging.CRITICAL)
         Shopcart.init_db(app)
+        cls.context = app.app_context()
+        cls.context.push()
 
     @classmethod
     def tearDownClass(cls):
         """ This runs once after the entire test suite """
         db.session.close()
+        cls.context.pop()
 
     def setUp(self):
         """ This runs before each test """
@@ -176,6 +181,17 @@ class TestShopcartModel(unittest.TestCase):
         shopcart = Shopcart()
         self.assertRaises(DataValidationError, shopcart.deserialize, data)
 
+    def test_deserialize_time_strings(self):
+        """Test deserialization of ISO 8601 and HTTP date strings"""
+        data = {"shopcart_id": 1, "product_id": 999, "quantity": 1, "price": 0.05, "checkout": 0}
+        expected = datetime(2021, 6, 1, 12, 30, 15)
+        for time_added in ("2021-06-01T12:30:15", "2021-06-01T12:30:15Z",
+                           "2021-06-01T12:30:15+00:00", "Tue, 01 Jun 2021 12:30:15 GMT"):
+            shopcart = Shopcart().deserialize(dict(data, time_added=time_added))
+            self.assertEqual(shopcart.time_added, expected)
+        data["time_added"] = "yesterday"
+        self.assertRaises(DataValidationError, Shopcart().deserialize, data)
+
     def test_find_a_Shopcart_item(self):
         """Find a Shopcart item by shopcart_id and product_id"""
         # make Shopcart item #1
@@ -262,4 +278,289 @@ class TestShopcartModel(unittest.TestCase):
         self.assertEqual(items[2].product_id, shopcart_3.product_id)
         self.assertEqual(items[0].price, shopcart_1.price)
         self.assertEqual(items[1].price, shopcart_2.price)
-        self.assertEqual(items[2].price, shopcart_3.price)
\ No newline at end of file
+        self.assertEqual(items[2].price, shopcart_3.price)
+    def test_find_page(self):
+        """Test Find a page of items ordered by key"""
+        time_freeze = datetime.utcnow()
+        for shopcart_id, product_id in [(1235, 100), (1234, 102), (1234, 100), (1234, 101)]:
+            Shopcart(shopcart_id=shopcart_id, product_id=product_id, quantity=1, price=5.99, time_added=time_freeze, checkout=0).create()
+
+        items, last_key = Shopcart.find_page(2)
+        self.assertEqual([(i.shopcart_id, i.product_id) for i in items], [(1234, 100), (1234, 101)])
+        self.assertEqual(last_key, (1234, 101))
+        items, last_key = Shopcart.find_page(2, after=last_key)
+        self.assertEqual([(i.shopcart_id, i.product_id) for i in items], [(1234, 102), (1235, 100)])
+        self.assertIsNone(last_key)
+
+        # filters are applied before paging
+        items, last_key = Shopcart.find_page(10, shopcart_id=1234)
+        self.assertEqual(len(items), 3)
+        self.assertIsNone(last_key)
+        items, last_key = Shopcart.find_page(1, product_id=100)
+        self.assertEqual((items[0].shopcart_id, items[0].product_id), (1234, 100))
+        self.assertEqual(last_key, (1234, 100))
+        items, last_key = Shopcart.find_page(1, after=last_key, product_id=100)
+        self.assertEqual((items[0].shopcart_id, items[0].product_id), (1235, 100))
+        self.assertIsNone(last_key)
+
+    def test_find_rows(self):
+        """Test the read-only rows have the columns of the items"""
+        time_freeze = datetime.utcnow()
+        for shopcart_id, product_id in [(1235, 100), (1234, 101), (1234, 100)]:
+            Shopcart(shopcart_id=shopcart_id, product_id=product_id, quantity=2, price=5.99, time_added=time_freeze, checkout=0).create()
+        db.session.expunge_all()
+
+        rows = Shopcart.find_rows_by_shopcart_id(1234)
+        self.assertEqual(sorted(row.product_id for row in rows), [100, 101])
+        self.assertEqual([row.serialize() for row in sorted(rows)],
+                         [Shopcart.find(1234, 100).serialize(), Shopcart.find(1234, 101).serialize()])
+        db.session.expunge_all()
+        self.assertEqual(sorted(row.shopcart_id for row in Shopcart.find_rows_by_product_id(100)), [1234, 1235])
+        self.assertEqual(len(Shopcart.all_rows()), 3)
+        row = Shopcart.find_row(1235, 100)
+        self.assertEqual((row.quantity, row.price, row.time_added), (2, 5.99, time_freeze))
+        self.assertIsNone(Shopcart.find_row(1235, 101))
+        self.assertEqual(Shopcart.find_rows_by_shopcart_id(1), [])
+        # no ORM instances were loaded
+        self.assertEqual(len(db.session.identity_map), 0)
+        self.assertFalse(hasattr(row, "__dict__"))
+
+    def test_find_rows_cache(self):
+        """Test the rows share the cache of the ORM finders"""
+        # filled right after the write that makes the item
+        app.extensions["cache"] = MemoryCache(tombstone_ttl=0)
+        self.addCleanup(app.extensions.__setitem__, "cache", NullCache())
+        time_freeze = datetime.utcnow()
+        Shopcart(shopcart_id=1234, product_id=100, quantity=1, price=5.99, time_added=time_freeze, checkout=0).create()
+        self.assertEqual(Shopcart.find_row(1234, 100).quantity, 1)
+        self.assertEqual(len(Shopcart.find_by_shopcart_id(1234)), 1)
+        db.session.execute("UPDATE shopcart SET quantity = 7")
+        db.session.commit()
+        db.session.expunge_all()
+        self.assertEqual(Shopcart.find(1234, 100).quantity, 1)
+        row = Shopcart.find_rows_by_shopcart_id(1234)[0]
+        self.assertEqual((row.quantity, row.time_added), (1, time_freeze))
+        self.assertEqual(app.extensions["cache"].stats()["hits"], 2)
+        Shopcart.find(1234, 100).update()
+        self.assertEqual(Shopcart.find_row(1234, 100).quantity, 7)
+
+    def test_checkout_cart(self):
+        """Test checkout all items in a Shopcart at once"""
+        time_freeze = datetime.utcnow()
+        Shopcart(shopcart_id=1234, product_id=101, quantity=1, price=5.99, time_added=time_freeze, checkout=0).create()
+        Shopcart(shopcart_id=1234, product_id=100, quantity=2, price=6.00, time_added=time_freeze, checkout=0).create()
+        Shopcart(shopcart_id=1235, product_id=100, quantity=1, price=9.99, time_added=time_freeze, checkout=0).create()
+
+        items = Shopcart.checkout_cart(1234)
+        self.assertEqual([item.product_id for item in items], [100, 101])
+        self.assertEqual([item.checkout for item in items], [1, 1])
+        self.assertEqual(items[0].quantity, 2)
+        self.assertEqual(items[0].serialize()["time_added"], time_freeze.isoformat())
+        # only the one cart was checked out
+        self.assertEqual(Shopcart.find(1234, 100).checkout, 1)
+        self.assertEqual(Shopcart.find(1235, 100).checkout, 0)
+        self.assertEqual(Shopcart.checkout_cart(4321), [])
+
+    def test_delete_cart(self):
+        """Test delete all items in a Shopcart at once"""
+        time_freeze = datetime.utcnow()
+        Shopcart(shopcart_id=1234, product_id=100, quantity=1, price=5.99, time_added=time_freeze, checkout=0).create()
+        Shopcart(shopcart_id=1234, product_id=101, quantity=1, price=6.00, time_added=time_freeze, checkout=0).create()
+        Shopcart(shopcart_id=1235, product_id=100, quantity=1, price=9.99, time_added=time_freeze, checkout=0).create()
+
+        self.assertEqual(Shopcart.delete_cart(1234), 2)
+        self.assertEqual(Shopcart.find_by_shopcart_id(1234), [])
+        self.assertEqual(len(Shopcart.find_by_shopcart_id(1235)), 1)
+        self.assertEqual(Shopcart.delete_cart(1234), 0)
+
+    def test_upsert_an_item(self):
+        """Test create an item or leave an existing item unchanged"""
+        time_freeze = datetime.utcnow()
+        shopcart = Shopcart(shopcart_id=1234, product_id=5678, quantity=1, price=5.99, time_added=time_freeze, checkout=0)
+        self.assertTrue(shopcart.upsert())
+        self.assertEqual(len(Shopcart.all()), 1)
+        again = Shopcart(shopcart_id=1234, product_id=5678, quantity=3, price=5.99, time_added=time_freeze, checkout=0)
+        self.assertFalse(again.upsert())
+        self.assertEqual(Shopcart.find(1234, 5678).quantity, 1)
+
+    def test_upsert_merge_quantity(self):
+        """Test upsert adds the quantity to an existing item"""
+        time_freeze = datetime.utcnow()
+        shopcart = Shopcart(shopcart_id=1234, product_id=5678, quantity=1, price=5.99, time_added=time_freeze, checkout=0)
+        self.assertTrue(shopcart.upsert(merge_quantity=True))
+        again = Shopcart(shopcart_id=1234, product_id=5678, quantity=3, price=5.99, time_added=time_freeze, checkout=0)
+        self.assertFalse(again.upsert(merge_quantity=True))
+        self.assertEqual(again.quantity, 4)
+        self.assertEqual(again.time_added, time_freeze)
+        self.assertEqual(Shopcart.find(1234, 5678).quantity, 4)
+
+    def test_adjust_quantity(self):
+        """Test change the quantity of an item in place"""
+        time_freeze = datetime.utcnow()
+        Shopcart(shopcart_id=1234, product_id=5678, quantity=2, price=5.99, time_added=time_freeze, checkout=0).create()
+        item = Shopcart.adjust_quantity(1234, 5678, 3)
+        self.assertEqual(item.quantity, 5)
+        self.assertEqual(item.price, 5.99)
+        item = Shopcart.adjust_quantity(1234, 5678, -5)
+        self.assertEqual(item.quantity, 0)
+        self.assertEqual(Shopcart.find(1234, 5678).quantity, 0)
+        self.assertRaises(NegativeQuantityError, Shopcart.adjust_quantity, 1234, 5678, -1)
+        self.assertEqual(Shopcart.find(1234, 5678).quantity, 0)
+        item = Shopcart.adjust_quantity(1234, 5678, -1, remove_empty=True)
+        self.assertEqual(item.quantity, -1)
+        self.assertIsNone(Shopcart.find(1234, 5678))
+        self.assertIsNone(Shopcart.adjust_quantity(1234, 5678, 1))
+
+    def test_summarize(self):
+        """Add up the totals of shopcarts"""
+        Shopcart(shopcart_id=1, product_id=1, quantity=2, price=1.25, time_added=datetime.now(), checkout=0).create()
+        Shopcart(shopcart_id=1, product_id=2, quantity=1, price=0.1, time_added=datetime.now(), checkout=1).create()
+        Shopcart(shopcart_id=2, product_id=1, quantity=3, price=2.0, time_added=datetime.now(), checkout=0).create()
+        summaries = Shopcart.summarize([1, 2, 3])
+        self.assertEqual(summaries[1]["item_count"], 2)
+        self.assertEqual(summaries[1]["total_quantity"], 3)
+        self.assertEqual(summaries[1]["total_price"], 2.6)
+        self.assertEqual(summaries[1]["by_checkout"][1], {"item_count": 1, "total_quantity": 1, "total_price": 0.1})
+        self.assertEqual(summaries[2]["total_price"], 6.0)
+        self.assertEqual(summaries[3], {"shopcart_id": 3, "item_count": 0, "total_quantity": 0,
+                                        "total_price": 0.0, "by_checkout": {}})
+
+    def test_migrations(self):
+        """Test the migrations build and remove the schema"""
+        db.drop_all()
+        upgrade()
+        inspector = db.inspect(db.engine)
+        self.assertIn("shopcart", inspector.get_table_names())
+        self.assertIn("shopcart_revision", inspector.get_table_names())
+        self.assertIn("shopcart_archive", inspector.get_table_names())
+        indexes = {index["name"] for index in inspector.get_indexes("shopcart")}
+        self.assertIn("ix_shopcart_product_id_shopcart_id", indexes)
+        self.assertIn("ix_shopcart_checkout_time_added", indexes)
+        # running them again does nothing
+        upgrade()
+        downgrade(revision="base")
+        inspector = db.inspect(db.engine)
+        self.assertNotIn("shopcart", inspector.get_table_names())
+        self.assertNotIn("shopcart_revision", inspector.get_table_names())
+        self.assertNotIn("shopcart_archive", inspector.get_table_names())
+        db.session.execute("DROP TABLE alembic_version")
+        db.session.commit()
+
+    def test_find_read_through_cache(self):
+        """Test finds are served from the cache until a write"""
+        # filled right after the write that makes the item
+        app.extensions["cache"] = MemoryCache(tombstone_ttl=0)
+        self.addCleanup(app.extensions.__setitem__, "cache", NullCache())
+        time_freeze = datetime.utcnow()
+        shopcart = Shopcart(shopcart_id=1234, product_id=100, quantity=1, price=5.99, time_added=time_freeze, checkout=0)
+        shopcart.create()
+        self.assertEqual(Shopcart.find(1234, 100).quantity, 1)
+        self.assertEqual(len(Shopcart.find_by_shopcart_id(1234)), 1)
+        # change the row behind the cache's back, the cached copies are returned
+        db.session.execute("UPDATE shopcart SET quantity = 7")
+        db.session.commit()
+        db.session.expunge_all()
+        item = Shopcart.find(1234, 100)
+        self.assertEqual(item.quantity, 1)
+        self.assertEqual(item.time_added, time_freeze)
+        self.assertEqual(Shopcart.find_by_shopcart_id(1234)[0].quantity, 1)
+        self.assertEqual(app.extensions["cache"].stats()["hits"], 2)
+        # a write reads the item from the database, past the cache
+        self.assertEqual(Shopcart.find_for_update(1234, 100).quantity, 7)
+        self.assertEqual(app.extensions["cache"].stats()["hits"], 2)
+        # the stale cached copy does not overwrite the item the session holds
+        self.assertIs(Shopcart.find(1234, 100), item)
+        self.assertEqual(item.quantity, 7)
+        self.assertEqual(app.extensions["cache"].stats()["hits"], 3)
+        # a cached item can still be updated, which removes it from the cache
+        item.price = 1.00
+        item.update()
+        self.assertEqual(Shopcart.find(1234, 100).quantity, 7)
+        self.assertEqual(Shopcart.find_by_shopcart_id(1234)[0].price, 1.00)
+
+    def test_cache_invalidated_by_writes(self):
+        """Test every write removes the cached cart"""
+        app.extensions["cache"] = MemoryCache()
+        self.addCleanup(app.extensions.__setitem__, "cache", NullCache())
+        time_freeze = datetime.utcnow()
+        # missing items are cached too
+        self.assertIsNone(Shopcart.find(1234, 100))
+        self.assertEqual(Shopcart.find_by_shopcart_id(1234), [])
+        Shopcart(shopcart_id=1234, product_id=100, quantity=1, price=5.99, time_added=time_freeze, checkout=0).create()
+        self.assertIsNotNone(Shopcart.find(1234, 100))
+        self.assertEqual(len(Shopcart.find_by_shopcart_id(1234)), 1)
+
+        Shopcart(shopcart_id=1234, product_id=101, quantity=1, price=5.99, time_added=time_freeze, checkout=0).upsert()
+        self.assertEqual(len(Shopcart.find_by_shopcart_id(1234)), 2)
+        Shopcart.adjust_quantity(1234, 100, 2)
+        self.assertEqual(Shopcart.find(1234, 100).quantity, 3)
+        Shopcart.checkout_cart(1234)
+        self.assertEqual(Shopcart.find(1234, 101).checkout, 1)
+        Shopcart.create_batch(1234, [Shopcart(shopcart_id=1234, product_id=102, quantity=1, price=5.99, time_added=time_freeze, checkout=0)])
+        self.assertEqual(len(Shopcart.find_by_shopcart_id(1234)), 3)
+        Shopcart.find(1234, 102).delete()
+        self.assertIsNone(Shopcart.find(1234, 102))
+        self.assertEqual(Shopcart.delete_cart(1234), 2)
+        self.assertIsNone(Shopcart.find(1234, 100))
+        self.assertEqual(Shopcart.find_by_shopcart_id(1234), [])
+
+    def test_cache_not_filled_after_write(self):
+        """Test a read that loaded a cart before a write cannot cache it after"""
+        cache = app.extensions["cache"] = MemoryCache()
+        self.addCleanup(app.extensions.__setitem__, "cache", NullCache())
+        Shopcart(shopcart_id=1234, product_id=100, quantity=1, price=5.99, time_added=datetime.utcnow(), checkout=0).create()
+        stale = Shopcart.find_row(1234, 100).serialize()
+        Shopcart.adjust_quantity(1234, 100, 1)
+        # the read that started before the write fills the cache last
+        cache.fill("revision:1234", 1)
+        cache.fill("item:1234:100", stale)
+        self.assertEqual(Shopcart.get_revision(1234), 2)
+        self.assertEqual(Shopcart.find_row(1234, 100).quantity, 2)
+        self.assertEqual(cache.stats()["hits"], 0)
+
+    def test_revision(self):
+        """Test every write moves a Shopcart to its next revision"""
+        time_freeze = datetime.utcnow()
+        self.assertEqual(Shopcart.get_revision(1234), 0)
+        shopcart = Shopcart(shopcart_id=1234, product_id=100, quantity=1, price=5.99, time_added=time_freeze, checkout=0)
+        shopcart.create()
+        self.assertEqual(Shopcart.get_revision(1234), 1)
+        Shopcart.adjust_quantity(1234, 100, 1)
+        self.assertEqual(Shopcart.get_revision(1234), 2)
+        # writes that change nothing keep the revision
+        Shopcart(shopcart_id=1234, product_id=100, quantity=1, price=5.99, time_added=time_freeze, checkout=0).upsert()
+        Shopcart.adjust_quantity(1234, 999, 1)
+        Shopcart.checkout_cart(4321)
+        self.assertEqual(Shopcart.get_revision(1234), 2)
+        self.assertEqual(Shopcart.get_revision(4321), 0)
+        Shopcart.checkout_cart(1234)
+        self.assertEqual(Shopcart.get_revision(1234), 3)
+        self.assertEqual(Shopcart.delete_cart(1234), 1)
+        self.assertEqual(Shopcart.get_revision(1234), 4)
+
+    def test_revision_mismatch(self):
+        """Test writes with an expected revision"""
+        time_freeze = datetime.utcnow()
+        Shopcart(shopcart_id=1234, product_id=100, quantity=1, price=5.99, time_added=time_freeze, checkout=0).create()
+        shopcart = Shopcart.find(1234, 100)
+        shopcart.quantity = 5
+        self.assertRaises(RevisionMismatchError, shopcart.update, expected_revision=0)
+        self.assertEqual(Shopcart.find(1234, 100).quantity, 1)
+        shopcart = Shopcart.find(1234, 100)
+        shopcart.quantity = 5
+        shopcart.update(expected_revision=1)
+        self.assertEqual(Shopcart.find(1234, 100).quantity, 5)
+        self.assertEqual(Shopcart.get_revision(1234), 2)
+        self.assertRaises(RevisionMismatchError, Shopcart.find(1234, 100).delete, expected_revision=1)
+        self.assertRaises(RevisionMismatchError, Shopcart.delete_cart, 1234, expected_revision=1)
+        self.assertEqual(len(Shopcart.find_by_shopcart_id(1234)), 1)
+        self.assertEqual(Shopcart.delete_cart(1234, expected_revision=2), 1)
+        self.assertEqual(Shopcart.get_revision(1234), 3)
+        # a Shopcart that was never written is at revision 0
+        self.assertEqual(Shopcart.delete_cart(4321, expected_revision=0), 0)
+        self.assertRaises(RevisionMismatchError, Shopcart.delete_cart, 4322, expected_revision=1)
+        # the second of two first writes finds the revision row of the first
+        Shopcart(shopcart_id=4323, product_id=100, quantity=1, price=5.99, time_added=time_freeze, checkout=0).create()
+        self.assertRaises(RevisionMismatchError, Shopcart.delete_cart, 4323, expected_revision=0)
+        self.assertEqual(Shopcart.get_revision(4323), 1)
+        self.assertEqual(len(Shopcart.find_by_shopcart_id(4323)), 1)
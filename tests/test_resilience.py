@@ -0,0 +1,201 @@
+"""
+Test cases for the database retries and circuit breaker
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import time
+import unittest
+import sqlite3
+import psycopg2
+from sqlalchemy.exc import IntegrityError, OperationalError
+from service import app, status
+from service.resilience import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    DatabaseConnectionError,
+    resilient,
+)
+from tests.base import sample
+
+breaker = app.extensions["breaker"]
+
+
+class PostgresError(psycopg2.OperationalError):
+    """ A DBAPI error with a Postgres error code """
+
+    # the pgcode of psycopg2 is read-only, it is set by the server
+    pgcode = None
+
+    def __init__(self, pgcode=None):
+        super().__init__("pgcode {}".format(pgcode))
+        self.pgcode = pgcode
+
+
+class FakeSession:
+    """ Counts the rollbacks of the failed attempts """
+
+    def __init__(self):
+        self.rollbacks = 0
+
+    def rollback(self):
+        self.rollbacks += 1
+
+
+def failing(errors, result="ok"):
+    """ Returns a function raising each of the errors in turn, then returning result """
+    errors = list(errors)
+
+    def func():
+        if errors:
+            raise errors.pop(0)
+        return result
+
+    return func
+
+
+def connection_error():
+    return OperationalError("SELECT 1", {}, PostgresError())
+
+
+######################################################################
+#  C I R C U I T   B R E A K E R   T E S T   C A S E S
+######################################################################
+class TestCircuitBreaker(unittest.TestCase):
+    """ Test Cases for the CircuitBreaker """
+
+    def test_opens_at_threshold(self):
+        """Test the breaker opens after threshold failures in a row"""
+        circuit = CircuitBreaker(threshold=3, reset_timeout=30)
+        circuit.record_failure()
+        circuit.record_failure()
+        circuit.record_success()
+        circuit.record_failure()
+        circuit.record_failure()
+        self.assertEqual(circuit.state, CLOSED)
+        circuit.before_call()
+        opened = sample("shopcart_db_circuit_transitions_total", {"from_state": CLOSED, "to_state": OPEN})
+        circuit.record_failure()
+        self.assertEqual(circuit.state, OPEN)
+        self.assertEqual(sample("shopcart_db_circuit_transitions_total",
+                                {"from_state": CLOSED, "to_state": OPEN}), opened + 1)
+        self.assertEqual(sample("shopcart_db_circuit_state"), 2)
+        rejected = sample("shopcart_db_circuit_rejections_total")
+        self.assertRaises(DatabaseConnectionError, circuit.before_call)
+        self.assertEqual(sample("shopcart_db_circuit_rejections_total"), rejected + 1)
+        self.assertGreater(circuit.stats()["retry_after"], 29)
+        circuit.reset()
+
+    def test_half_open_probe(self):
+        """Test one probe is let through after the reset timeout"""
+        circuit = CircuitBreaker(threshold=1, reset_timeout=0.01)
+        circuit.record_failure()
+        self.assertRaises(DatabaseConnectionError, circuit.before_call)
+        time.sleep(0.02)
+        circuit.before_call()
+        self.assertEqual(circuit.state, HALF_OPEN)
+        # only the probe goes through
+        self.assertRaises(DatabaseConnectionError, circuit.before_call)
+        circuit.record_failure()
+        self.assertEqual(circuit.state, OPEN)
+        time.sleep(0.02)
+        circuit.before_call()
+        circuit.record_success()
+        self.assertEqual(circuit.state, CLOSED)
+        self.assertEqual(circuit.stats(), {"state": CLOSED, "failures": 0, "retry_after": 0})
+        circuit.before_call()
+
+
+######################################################################
+#  R E T R Y   T E S T   C A S E S
+######################################################################
+class TestResilient(unittest.TestCase):
+    """ Test Cases for the resilient decorator """
+
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        self.addCleanup(self.context.pop)
+        config = {
+            "DB_RETRY_ATTEMPTS": 3,
+            "DB_RETRY_BASE_DELAY": 0.001,
+            "DB_RETRY_MAX_DELAY": 0.002,
+            "DB_RETRY_BUDGET": 1.0,
+        }
+        for key, value in config.items():
+            self.addCleanup(app.config.__setitem__, key, app.config[key])
+            app.config[key] = value
+        breaker.reset()
+        self.addCleanup(breaker.reset)
+        self.addCleanup(breaker.configure, breaker.threshold, breaker.reset_timeout)
+        self.session = FakeSession()
+
+    def call(self, func, method="test", retry=True):
+        return resilient(method, self.session, retry=retry)(func)()
+
+    def test_retries_connection_errors(self):
+        """Test a lost connection is retried until it succeeds"""
+        retries = sample("shopcart_retries_total", {"method": "test_connection"})
+        result = self.call(failing([connection_error(), connection_error()]), "test_connection")
+        self.assertEqual(result, "ok")
+        self.assertEqual(self.session.rollbacks, 2)
+        self.assertEqual(sample("shopcart_retries_total", {"method": "test_connection"}), retries + 2)
+        self.assertEqual(breaker.failures, 0)
+
+    def test_retries_serialization_failures(self):
+        """Test a serialization failure is retried without counting against the breaker"""
+        breaker.configure(1, 30)
+        error = OperationalError("UPDATE", {}, PostgresError("40001"))
+        self.assertEqual(self.call(failing([error])), "ok")
+        self.assertEqual(breaker.state, CLOSED)
+
+    def test_gives_up_after_attempts(self):
+        """Test the last error is raised when the attempts run out"""
+        func = failing([connection_error() for _ in range(3)])
+        self.assertRaises(OperationalError, self.call, func)
+        self.assertEqual(self.session.rollbacks, 3)
+        self.assertRaises(OperationalError, self.call, failing([connection_error()]), retry=False)
+
+    def test_budget(self):
+        """Test no retry is made past the time budget"""
+        app.config["DB_RETRY_BASE_DELAY"] = app.config["DB_RETRY_MAX_DELAY"] = 5.0
+        app.config["DB_RETRY_BUDGET"] = 0.0
+        start = time.monotonic()
+        self.assertRaises(OperationalError, self.call, failing([connection_error()]))
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_other_errors_not_retried(self):
+        """Test errors from a database that answered are raised at once"""
+        error = IntegrityError("INSERT", {}, PostgresError("23505"))
+        self.assertRaises(IntegrityError, self.call, failing([error]))
+        self.assertEqual(self.session.rollbacks, 1)
+        statement_timeout = OperationalError("SELECT", {}, PostgresError("57014"))
+        self.assertRaises(OperationalError, self.call, failing([statement_timeout]))
+        locked = OperationalError("UPDATE", {}, sqlite3.OperationalError("database is locked"))
+        self.assertRaises(OperationalError, self.call, failing([locked]))
+        self.assertRaises(ValueError, self.call, failing([ValueError("bad")]))
+        self.assertEqual(breaker.failures, 0)
+
+    def test_breaker_fails_fast(self):
+        """Test an open breaker stops the retries and the next calls"""
+        breaker.configure(2, 30)
+        func = failing([connection_error() for _ in range(3)])
+        self.assertRaises(DatabaseConnectionError, self.call, func)
+        self.assertEqual(self.session.rollbacks, 2)
+        self.assertEqual(breaker.state, OPEN)
+        self.assertRaises(DatabaseConnectionError, self.call, failing([]))
+
+    def test_unavailable_response(self):
+        """Test the service returns 503 while the breaker is open"""
+        breaker.configure(1, 30)
+        breaker.record_failure()
+        client = app.test_client()
+        resp = client.get("/api/shopcarts/1")
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(resp.get_json()["error"], "Service Unavailable")
+        self.assertEqual(resp.headers["Retry-After"], "30")
+        resp = client.get("/api/stats")
+        self.assertEqual(resp.get_json()["breaker"]["state"], OPEN)
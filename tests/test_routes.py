@@ -6,15 +6,18 @@ Test cases can be run with the following:
   coverage report -m
 """
 import os
+import json
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
 from urllib.parse import quote_plus
+from sqlalchemy import event
 
 import psycopg2
-from service import status  # HTTP Status Codes
-from service.models import DatabaseConnectionError, Shopcart, DataValidationError, db # init_db is in routes for now
-from service.routes import app, init_db
+from service import app, create_app, status  # HTTP Status Codes
+from service.models import DatabaseConnectionError, Shopcart, DataValidationError, db
 from datetime import datetime
 
 DATABASE_URI = os.getenv(
@@ -38,11 +41,14 @@ class TestYourResourceServer(TestCase):
         app.config["SQLALCHEMY_DATABASE_URI"] = DATABASE_URI
         app.logger.setLevel(logging.CRITICAL)
         Shopcart.init_db(app)
+        cls.context = app.app_context()
+        cls.context.push()
 
     @classmethod
     def tearDownClass(cls):
         """Run once after all tests"""
         db.session.close()
+        cls.context.pop()
 
     def setUp(self):
         """Runs before each test"""
@@ -95,6 +101,26 @@ class TestYourResourceServer(TestCase):
         )
         return shopcart
 
+    @contextmanager
+    def assertMaxQueries(self, budget):
+        """ Fails when the block sends more than budget SQL statements """
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, "after_cursor_execute", record)
+        try:
+            yield statements
+        finally:
+            event.remove(db.engine, "after_cursor_execute", record)
+        self.assertLessEqual(
+            len(statements), budget,
+            "{} queries over a budget of {}:\n{}".format(
+                len(statements), budget, "\n".join(statements)
+            ),
+        )
+
 
     def test_index(self):
        """Test the Home Page"""
@@ -450,6 +476,369 @@ class TestYourResourceServer(TestCase):
         for shopcart in result:
             self.assertEqual(shopcart['checkout'], 1)
 
+    def test_list_items_paginated(self):
+        """ Test list items one page at a time """
+        self._create_shopcart_with_item(1234, 100)
+        self._create_shopcart_with_item(1234, 101)
+        self._create_shopcart_with_item(1235, 100)
+        resp = self.app.get(BASE_URL + "?limit=2")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        items = resp.get_json()
+        self.assertEqual([(i["shopcart_id"], i["product_id"]) for i in items], [(1234, 100), (1234, 101)])
+        link = resp.headers.get("Link")
+        self.assertIsNotNone(link)
+        self.assertTrue(link.endswith('; rel="next"'))
+        # follow the next link
+        next_url = link[link.index("<") + 1:link.index(">")]
+        resp = self.app.get(next_url)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        items = resp.get_json()
+        self.assertEqual([(i["shopcart_id"], i["product_id"]) for i in items], [(1235, 100)])
+        self.assertIsNone(resp.headers.get("Link"))
+        # the filters are kept in the next link
+        resp = self.app.get(BASE_URL + "?product_id=100&limit=1")
+        link = resp.headers.get("Link")
+        self.assertIn("product_id=100", link)
+        resp = self.app.get(link[link.index("<") + 1:link.index(">")])
+        self.assertEqual(resp.get_json()[0]["shopcart_id"], 1235)
+
+    def test_list_items_page_size(self):
+        """ Test list items page size limits """
+        self._create_shopcart_with_item(1234, 100)
+        resp = self.app.get(BASE_URL + "?limit=0")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        app.config["MAX_PAGE_SIZE"] = 1
+        self._create_shopcart_with_item(1234, 101)
+        resp = self.app.get(BASE_URL + "?limit=50")
+        app.config["MAX_PAGE_SIZE"] = 1000
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 1)
+        self.assertIn("limit=1", resp.headers.get("Link"))
+
+    def test_list_items_bad_cursor(self):
+        """ Test list items with a cursor that is not valid """
+        resp = self.app.get(BASE_URL + "?cursor=not-a-cursor")
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_export_items(self):
+        """ Test export all items as newline delimited JSON """
+        resp = self.app.get(BASE_URL + "/export")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.data, b"")
+
+        item1 = self._create_shopcart_with_item(1235, 100)
+        item2 = self._create_shopcart_with_item(1234, 101)
+        app.config["EXPORT_BATCH_SIZE"] = 1
+        resp = self.app.get(BASE_URL + "/export")
+        app.config["EXPORT_BATCH_SIZE"] = 1000
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, "application/x-ndjson")
+        lines = resp.data.decode("utf-8").splitlines()
+        self.assertEqual(len(lines), 2)
+        items = [json.loads(line) for line in lines]
+        self.assertEqual(items[0]["shopcart_id"], item2.shopcart_id)
+        self.assertEqual(items[0]["product_id"], item2.product_id)
+        self.assertEqual(items[1]["shopcart_id"], item1.shopcart_id)
+        self.assertEqual(items[1]["quantity"], item1.quantity)
+
+    def test_create_items_batch(self):
+        """ Test create many items in one request """
+        self._create_shopcart_with_item(1234, 100)
+        time_freeze = datetime.now()
+        items = [
+            {"product_id": product_id, "quantity": 2, "price": 1.5, "time_added": time_freeze, "checkout": 0}
+            for product_id in [101, 100, 102, 101]
+        ]
+        resp = self.app.post(BASE_URL + "/1234/items:batch", json=items, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        results = resp.get_json()
+        self.assertEqual([r["product_id"] for r in results], [101, 100, 102, 101])
+        self.assertEqual([r["status"] for r in results], ["created", "conflict", "created", "conflict"])
+        self.assertEqual(results[0]["shopcart_id"], 1234)
+        resp = self.app.get(BASE_URL + "/1234")
+        items = resp.get_json()
+        self.assertEqual([i["product_id"] for i in items], [100, 101, 102])
+        self.assertEqual([i["quantity"] for i in items], [1, 2, 2])
+
+    def test_create_items_batch_bad_data(self):
+        """ Test create many items with bad data """
+        items = [
+            {"product_id": 100, "quantity": 1, "price": 1.5, "time_added": datetime.now(), "checkout": 0},
+            {"product_id": 101, "price": 1.5}
+        ]
+        resp = self.app.post(BASE_URL + "/1234/items:batch", json=items, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        # nothing was saved
+        resp = self.app.get(BASE_URL + "/1234")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.post(BASE_URL + "/1234/items:batch", json={"product_id": 100}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        for name, value in (("quantity", "many"), ("price", "1.5"), ("product_id", None), ("checkout", False)):
+            item = {"product_id": 100, "quantity": 1, "price": 1.5, "time_added": datetime.now(), "checkout": 0}
+            item[name] = value
+            resp = self.app.post(BASE_URL + "/1234/items:batch", json=[item], content_type=CONTENT_TYPE_JSON)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, name)
+            self.assertIn(name, resp.get_json()["message"])
+        resp = self.app.post(BASE_URL + "/1234/items:batch")
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_create_item_merge_quantity(self):
+        """ Test create an item that already exists with merge """
+        shopcart = self._create_shopcart_with_item(1234, 100)
+        data = shopcart.serialize()
+        data["quantity"] = 2
+        resp = self.app.post(BASE_URL + "/1234?merge=true", json=data, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["quantity"], 3)
+        self.assertIsNotNone(resp.headers.get("Location"))
+        # a new item is still created
+        data["product_id"] = 101
+        resp = self.app.post(BASE_URL + "/1234?merge=true", json=data, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(resp.get_json()["quantity"], 2)
+        # without merge the quantity is not changed
+        resp = self.app.post(BASE_URL + "/1234", json=data, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.app.get(BASE_URL + "/1234/items/101")
+        self.assertEqual(resp.get_json()["quantity"], 2)
+
+    def test_adjust_item_quantity(self):
+        """ Test change the quantity of an item with a delta """
+        self._create_shopcart_with_item(1234, 100)
+        url = BASE_URL + "/1234/items/100"
+        resp = self.app.patch(url, json={"delta": 4}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["quantity"], 5)
+        resp = self.app.patch(url, json={"delta": -5, "remove_if_empty": False}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["quantity"], 0)
+        resp = self.app.patch(url, json={"delta": -1, "remove_if_empty": False}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.app.patch(url, json={"delta": -1}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(resp.get_data(), b"")
+        resp = self.app.get(url)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.patch(url, json={"delta": 1}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_adjust_item_quantity_bad_data(self):
+        """ Test change the quantity of an item with bad data """
+        self._create_shopcart_with_item(1234, 100)
+        url = BASE_URL + "/1234/items/100"
+        resp = self.app.patch(url, json={"delta": "1"}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.patch(url, json={"quantity": 1}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.patch(url, json={"delta": 1, "remove_if_empty": "no"}, content_type=CONTENT_TYPE_JSON)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.patch(url)
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_concurrent_requests(self):
+        """ Test requests on many threads each get their own session """
+        self._create_shopcart_with_item(1234, 100)
+
+        def get_shopcart(_):
+            return app.test_client().get(BASE_URL + "/1234").status_code
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            codes = list(executor.map(get_shopcart, range(16)))
+        self.assertEqual(codes, [status.HTTP_200_OK] * 16)
+        # the sessions of the worker threads were removed with their requests
+        self.assertLessEqual(len(db.session.registry.registry), 1)
+
+    def test_get_metrics(self):
+        """ Test read the Prometheus metrics """
+        self._create_shopcart_with_item(1234, 100)
+        self.app.get(BASE_URL + "/1234")
+        resp = self.app.get("/metrics")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.content_type.startswith("text/plain"))
+        text = resp.get_data(as_text=True)
+        self.assertIn(
+            'shopcart_http_requests_total{method="GET",resource="ShopcartResource",status="200"}',
+            text,
+        )
+        self.assertIn(
+            'shopcart_http_request_duration_seconds_bucket{le="0.005",method="POST",resource="ShopcartResource"}',
+            text,
+        )
+        self.assertIn('shopcart_db_queries_total{verb="select"}', text)
+        self.assertIn('shopcart_cache_requests_total{backend="none",result="miss"}', text)
+
+    def test_get_summary(self):
+        """ Test read the totals of a shopcart """
+        for product_id in (100, 101, 102):
+            self._create_shopcart_with_item(1234, product_id)
+        resp = self.app.put(BASE_URL + "/1234/items/102/checkout")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        resp = self.app.get(BASE_URL + "/1234/summary")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data, {"shopcart_id": 1234, "item_count": 3, "total_quantity": 3, "total_price": 0.03})
+        resp = self.app.get(BASE_URL + "/1234/summary?by_checkout=true")
+        data = resp.get_json()
+        self.assertEqual(data["open"], {"item_count": 2, "total_quantity": 2, "total_price": 0.02})
+        self.assertEqual(data["checked_out"], {"item_count": 1, "total_quantity": 1, "total_price": 0.01})
+        resp = self.app.get(BASE_URL + "/4321/summary")
+        self.assertEqual(resp.get_json()["item_count"], 0)
+
+    def test_get_summary_batch(self):
+        """ Test read the totals of many shopcarts """
+        self._create_shopcart_with_item(1234, 100)
+        self._create_shopcart_with_item(1234, 101)
+        self._create_shopcart_with_item(1235, 100)
+        resp = self.app.get(BASE_URL + "/summary?shopcart_ids=1235,9999,1234,1235")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([summary["shopcart_id"] for summary in data], [1235, 9999, 1234])
+        self.assertEqual([summary["item_count"] for summary in data], [1, 0, 2])
+        self.assertNotIn("open", data[0])
+        resp = self.app.get(BASE_URL + "/summary?shopcart_ids=1234&by_checkout=1")
+        self.assertEqual(resp.get_json()[0]["checked_out"]["item_count"], 0)
+
+    def test_get_summary_batch_bad_ids(self):
+        """ Test read the totals of shopcarts with bad ids """
+        for query in ("", "?shopcart_ids=", "?shopcart_ids=1,two"):
+            resp = self.app.get(BASE_URL + "/summary" + query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        ids = ",".join(str(i) for i in range(app.config["MAX_SUMMARY_CARTS"] + 1))
+        resp = self.app.get(BASE_URL + "/summary?shopcart_ids=" + ids)
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_server_timing(self):
+        """ Test the queries of a request are reported in Server-Timing """
+        self._create_shopcart_with_item(1234, 100)
+        resp = self.app.get(BASE_URL + "/1234")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        timing = resp.headers.get("Server-Timing")
+        self.assertRegex(timing, r'^db;desc="[1-9]\d* queries";dur=[\d.]+, app;dur=[\d.]+$')
+
+    def test_query_budgets(self):
+        """ Test the queries of each endpoint do not grow with the cart """
+        for product_id in range(100, 110):
+            self._create_shopcart_with_item(1234, product_id)
+        item = {"shopcart_id": 1234, "product_id": 100, "quantity": 5,
+                "price": 0.01, "time_added": datetime.now().isoformat(), "checkout": 0}
+        item_url = BASE_URL + "/1234/items/100"
+        budgets = [
+            (1, "get", BASE_URL, None),
+            (1, "get", BASE_URL + "?shopcart_id=1234", None),
+            (2, "get", BASE_URL + "/1234", None),
+            (2, "get", item_url, None),
+            (1, "get", BASE_URL + "/1234/summary?by_checkout=true", None),
+            (1, "get", BASE_URL + "/summary?shopcart_ids=1234,1235", None),
+            (4, "post", BASE_URL + "/1234", dict(item, product_id=200)),
+            (5, "put", item_url, item),
+            (3, "patch", item_url, {"delta": 1}),
+            (4, "put", BASE_URL + "/1234/items/101/checkout", None),
+            (3, "put", BASE_URL + "/1234/checkout", None),
+            (3, "delete", item_url, None),
+            (3, "delete", BASE_URL + "/1234", None),
+        ]
+        for budget, method, url, body in budgets:
+            with self.subTest(method=method, url=url):
+                with self.assertMaxQueries(budget):
+                    resp = getattr(self.app, method)(url, json=body)
+                self.assertLess(resp.status_code, 300)
+
+    def test_get_stats(self):
+        """ Test read the service counters """
+        resp = self.app.get("/api/stats")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data["pid"], os.getpid())
+        self.assertEqual(data["cache"]["backend"], "none")
+        self.assertIn("hits", data["cache"])
+        self.assertIn("misses", data["cache"])
+        self.assertIn("evictions", data["cache"])
+        self.assertIn("checkouts", data["pool"])
+        self.assertIn("wait_seconds_max", data["pool"])
+
+    def test_create_app_without_database(self):
+        """ Test an app is made and served without a reachable database """
+        unreachable = create_app({
+            "SQLALCHEMY_DATABASE_URI": "postgresql://postgres@127.0.0.1:1/testdb",
+            "TESTING": True,
+            "DB_RETRY_ATTEMPTS": 1,
+            "DB_BREAKER_THRESHOLD": 1,
+        })
+        client = unreachable.test_client()
+        self.assertEqual(client.get("/").status_code, status.HTTP_200_OK)
+        self.assertEqual(client.get("/api/stats").get_json()["breaker"]["state"], "closed")
+        resp = client.get(BASE_URL + "/1234")
+        self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        # the breaker it opened is its own, the service app is untouched
+        self.assertEqual(client.get("/api/stats").get_json()["breaker"]["state"], "open")
+        self.assertEqual(self.app.get("/api/stats").get_json()["breaker"]["state"], "closed")
+        self.assertEqual(self.app.get(BASE_URL + "/1234").status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_shopcart_not_modified(self):
+        """ Test read a shopcart with If-None-Match """
+        self._create_shopcart_with_item(1234, 100)
+        resp = self.app.get(BASE_URL + "/1234")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        etag = resp.headers.get("ETag")
+        self.assertIsNotNone(etag)
+        resp = self.app.get(BASE_URL + "/1234", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(resp.headers.get("ETag"), etag)
+        self.assertEqual(resp.data, b"")
+        # the item has the same version as its shopcart
+        resp = self.app.get(BASE_URL + "/1234/items/100", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        # any change to the shopcart changes the ETag
+        self._create_shopcart_with_item(1234, 101)
+        resp = self.app.get(BASE_URL + "/1234", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+        self.assertNotEqual(resp.headers.get("ETag"), etag)
+        resp = self.app.get(BASE_URL + "/1234/items/100", headers={"If-None-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["product_id"], 100)
+
+    def test_update_item_if_match(self):
+        """ Test update an item with If-Match """
+        self._create_shopcart_with_item(1234, 100)
+        resp = self.app.get(BASE_URL + "/1234/items/100")
+        etag = resp.headers.get("ETag")
+        new_item = resp.get_json()
+        resp = self.app.put(BASE_URL + "/1234/items/100", json=new_item, content_type=CONTENT_TYPE_JSON, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["quantity"], 2)
+        new_etag = resp.headers.get("ETag")
+        self.assertNotEqual(new_etag, etag)
+        # the old ETag is stale now
+        resp = self.app.put(BASE_URL + "/1234/items/100", json=new_item, content_type=CONTENT_TYPE_JSON, headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.put(BASE_URL + "/1234/items/100", json=new_item, content_type=CONTENT_TYPE_JSON, headers={"If-Match": '"4321-1"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.get(BASE_URL + "/1234/items/100")
+        self.assertEqual(resp.get_json()["quantity"], 2)
+        self.assertEqual(resp.headers.get("ETag"), new_etag)
+
+    def test_delete_if_match(self):
+        """ Test delete a shopcart and an item with If-Match """
+        self._create_shopcart_with_item(1234, 100)
+        self._create_shopcart_with_item(1234, 101)
+        etag = self.app.get(BASE_URL + "/1234").headers.get("ETag")
+        self._create_shopcart_with_item(1234, 102)
+        resp = self.app.delete(BASE_URL + "/1234/items/100", headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.delete(BASE_URL + "/1234", headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(len(self.app.get(BASE_URL + "/1234").get_json()), 3)
+
+        etag = self.app.get(BASE_URL + "/1234").headers.get("ETag")
+        resp = self.app.delete(BASE_URL + "/1234/items/100", headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        etag = self.app.get(BASE_URL + "/1234").headers.get("ETag")
+        resp = self.app.delete(BASE_URL + "/1234", headers={"If-Match": etag})
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        resp = self.app.get(BASE_URL + "/1234")
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
     # @patch('psycopg2.connect')
     # def test_connection_error(self, mock_connect):
     #     """ Test Disconnect """
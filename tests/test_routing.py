@@ -0,0 +1,122 @@
+"""
+Test cases for the read replica routing
+
+The primary is DATABASE_URI and the replica REPLICA_DATABASE_URI, a SQLite
+file by default. The tests write to the two databases separately to tell
+which one a read was served from.
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import os
+import shutil
+import tempfile
+import time
+from service import status
+from service.models import Shopcart, db
+from service.routing import STICKY_COOKIE
+from tests.base import BASE_URL, AppTestCase, sample
+from tests.factories import ShopcartFactory, shopcart_row
+
+WORKDIR = tempfile.mkdtemp(prefix="shopcarts-replica-")
+REPLICA_URI = os.getenv("REPLICA_DATABASE_URI", "sqlite:///" + os.path.join(WORKDIR, "replica.db"))
+# a SQLite file in a directory that does not exist cannot be opened
+UNREACHABLE_URI = "sqlite:///" + os.path.join(WORKDIR, "missing", "replica.db")
+
+
+
+######################################################################
+#  R E A D   R E P L I C A   T E S T   C A S E S
+######################################################################
+class ReplicaTestCase(AppTestCase):
+    """ An app with the replicas in replica_uris, the first one is REPLICA_URI """
+
+    replica_uris = [REPLICA_URI]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.config = {"DB_REPLICA_URIS": cls.replica_uris, "DB_REPLICA_STICKY_SECONDS": 0.5}
+        super().setUpClass()
+        cls.replica = db.get_engine(cls.app, bind="replica_0")
+
+    def engines(self):
+        return super().engines() + [self.replica]
+
+    def replicate(self, *rows):
+        """ Writes rows to the replica only """
+        self.replica.execute(Shopcart.__table__.insert(), list(rows))
+
+
+class TestReadReplicas(ReplicaTestCase):
+    """ Test Cases for the read replica routing """
+
+    def test_get_reads_replica(self):
+        """Test the GET endpoints read from the replica"""
+        ShopcartFactory(shopcart_id=1234, product_id=100, quantity=1).create()
+        self.replicate(
+            shopcart_row(shopcart_id=1234, product_id=100, quantity=7),
+            shopcart_row(shopcart_id=1234, product_id=101, quantity=2),
+        )
+        resp = self.client.get(BASE_URL + "/1234")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(sorted(row["quantity"] for row in resp.get_json()), [2, 7])
+        resp = self.client.get(BASE_URL + "/1234/items/100")
+        self.assertEqual(resp.get_json()["quantity"], 7)
+        resp = self.client.get(BASE_URL, query_string={"product_id": 101})
+        self.assertEqual(len(resp.get_json()), 1)
+        # reads outside a GET request go to the primary
+        self.assertEqual(Shopcart.find(1234, 100).quantity, 1)
+        self.assertEqual(len(Shopcart.find_by_shopcart_id(1234)), 1)
+
+    def test_writes_go_to_primary(self):
+        """Test writes and the reads of write requests use the primary"""
+        self.replicate(shopcart_row(shopcart_id=1234, product_id=100, quantity=7))
+        resp = self.client.post(BASE_URL + "/1234", json=ShopcartFactory(shopcart_id=1234, product_id=100, quantity=1).serialize())
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        resp = self.client.patch(BASE_URL + "/1234/items/100", json={"delta": 2})
+        self.assertEqual(resp.get_json()["quantity"], 3)
+        self.assertEqual(Shopcart.find(1234, 100).quantity, 3)
+        replica_rows = self.replica.execute(Shopcart.__table__.select()).fetchall()
+        self.assertEqual([row.quantity for row in replica_rows], [7])
+
+    def test_read_your_writes(self):
+        """Test a client reads the primary for a while after a write"""
+        self.replicate(shopcart_row(shopcart_id=1234, product_id=100, quantity=7))
+        resp = self.client.post(BASE_URL + "/1234", json=ShopcartFactory(shopcart_id=1234, product_id=100, quantity=1).serialize())
+        self.assertIn(STICKY_COOKIE, resp.headers["Set-Cookie"])
+        resp = self.client.get(BASE_URL + "/1234/items/100")
+        self.assertEqual(resp.get_json()["quantity"], 1)
+        # another client reads the replica
+        resp = self.app.test_client().get(BASE_URL + "/1234/items/100")
+        self.assertEqual(resp.get_json()["quantity"], 7)
+        time.sleep(0.6)
+        resp = self.client.get(BASE_URL + "/1234/items/100")
+        self.assertEqual(resp.get_json()["quantity"], 7)
+
+
+class TestReplicaEjection(ReplicaTestCase):
+    """ Test Cases for a replica that cannot be reached """
+
+    replica_uris = [REPLICA_URI, UNREACHABLE_URI]
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+
+    def test_unreachable_replica_ejected(self):
+        """Test a replica that fails is ejected and the read served elsewhere"""
+        ShopcartFactory(shopcart_id=1234, product_id=100, quantity=7).create()
+        self.replicate(shopcart_row(shopcart_id=1234, product_id=100, quantity=7))
+        labels = {"replica": "replica_1"}
+        ejections = sample("shopcart_db_replica_ejections_total", labels)
+        for _ in range(4):
+            resp = self.client.get(BASE_URL + "/1234/items/100")
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.get_json()["quantity"], 7)
+        self.assertEqual(sample("shopcart_db_replica_ejections_total", labels), ejections + 1)
+        replicas = self.client.get("/api/stats").get_json()["replicas"]
+        self.assertTrue(replicas["replica_0"]["healthy"])
+        self.assertFalse(replicas["replica_1"]["healthy"])
+        self.assertEqual(replicas["replica_1"]["ejections"], 1)
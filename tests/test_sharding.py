@@ -0,0 +1,297 @@
+"""
+Test cases for the sharding of the carts
+
+The first shard is DATABASE_URI and the others the URIs in
+SHARD_DATABASE_URIS, two SQLite files by default. The tests read the
+shards separately to tell where a cart was written.
+
+Test cases can be run with:
+    nosetests
+    coverage report -m
+"""
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import datetime
+from flask_migrate import upgrade
+from service import status
+from service.commands import rebalance
+from service.models import Shopcart, ShopcartArchive, ShopcartRevision, db, move_cart
+from service.sharding import ShardMap, ShardSet
+from tests.base import BASE_URL, AppTestCase
+from tests.factories import ShopcartFactory, shopcart_row
+
+WORKDIR = tempfile.mkdtemp(prefix="shopcarts-shards-")
+SHARD_URIS = [
+    uri.strip() for uri in os.getenv(
+        "SHARD_DATABASE_URIS",
+        ",".join("sqlite:///" + os.path.join(WORKDIR, "shard_{}.db".format(index)) for index in (1, 2)),
+    ).split(",")
+]
+
+
+######################################################################
+#  S H A R D   M A P   T E S T   C A S E S
+######################################################################
+class TestShardMap(unittest.TestCase):
+    """ Test Cases for the consistent hash ring """
+
+    def test_spreads_carts(self):
+        """Test the carts are spread over every shard"""
+        ring = ShardMap(["shard_0", "shard_1", "shard_2"])
+        owners = [ring.shard_for(shopcart_id) for shopcart_id in range(3000)]
+        for name in ring.names:
+            self.assertGreater(owners.count(name), 600)
+        self.assertEqual(owners, [ShardMap(ring.names).shard_for(shopcart_id) for shopcart_id in range(3000)])
+        self.assertEqual(ShardMap(["shard_0"]).shard_for(12), "shard_0")
+
+    def test_added_shard_takes_its_share(self):
+        """Test a new shard only takes carts, about 1/N of them"""
+        before = ShardMap(["shard_0", "shard_1"])
+        after = ShardMap(["shard_0", "shard_1", "shard_2"])
+        moved = 0
+        for shopcart_id in range(3000):
+            if before.shard_for(shopcart_id) != after.shard_for(shopcart_id):
+                self.assertEqual(after.shard_for(shopcart_id), "shard_2")
+                moved += 1
+        self.assertGreater(moved, 600)
+        self.assertLess(moved, 1400)
+
+
+######################################################################
+#  S H A R D E D   M O D E L   T E S T   C A S E S
+######################################################################
+class TestShards(AppTestCase):
+    """ Test Cases for the carts spread over three databases """
+
+    config = {"DB_SHARD_URIS": SHARD_URIS}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.shards = cls.app.extensions["shards"]
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+
+    def engines(self):
+        return [self.shards.engine(name) for name in self.shards.names]
+
+    def stored(self, name):
+        """ Returns the (shopcart_id, product_id) of the items on a shard """
+        rows = self.shards.engine(name).execute(Shopcart.__table__.select()).fetchall()
+        return sorted((row.shopcart_id, row.product_id) for row in rows)
+
+    def revision(self, name, shopcart_id):
+        table = ShopcartRevision.__table__
+        return self.shards.engine(name).execute(
+            db.select([table.c.revision]).where(table.c.shopcart_id == shopcart_id)
+        ).scalar()
+
+    def fill(self, carts=12):
+        """ Adds two items to carts 1 to carts """
+        for shopcart_id in range(1, carts + 1):
+            ShopcartFactory(shopcart_id=shopcart_id, product_id=100, quantity=1).create()
+            Shopcart.create_batch(shopcart_id, [ShopcartFactory(shopcart_id=shopcart_id, product_id=200 + shopcart_id)])
+
+    def test_carts_written_to_their_shard(self):
+        """Test each cart, items and revision, lives on the shard of its shopcart_id"""
+        self.fill()
+        for name in self.shards.names:
+            carts = {shopcart_id for shopcart_id, _ in self.stored(name)}
+            self.assertTrue(carts)
+            for shopcart_id in carts:
+                self.assertEqual(self.shards.shard_for(shopcart_id), name)
+                self.assertEqual(self.revision(name, shopcart_id), 2)
+        self.assertEqual(Shopcart.adjust_quantity(5, 100, 2).quantity, 3)
+        self.assertEqual(len(Shopcart.checkout_cart(6)), 2)
+        self.assertEqual(Shopcart.delete_cart(7), 2)
+        self.assertEqual(Shopcart.get_revision(5), 3)
+        self.assertEqual(Shopcart.find(5, 100).quantity, 3)
+        self.assertEqual(Shopcart.find_rows_by_shopcart_id(6)[0].checkout, 1)
+        self.assertEqual(Shopcart.find_by_shopcart_id(7), [])
+
+    def test_cart_endpoints(self):
+        """Test the endpoints of one cart on a sharded service"""
+        self.fill()
+        resp = self.client.get(BASE_URL + "/9")
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+        resp = self.client.put(BASE_URL + "/9/items/100", json=ShopcartFactory(
+            shopcart_id=9, product_id=100, quantity=4
+        ).serialize(), headers={"If-Match": resp.headers["ETag"]})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        # an update moves the quantity up by one
+        self.assertEqual(self.client.get(BASE_URL + "/9/items/100").get_json()["quantity"], 2)
+        resp = self.client.delete(BASE_URL + "/9/items/100")
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertNotIn((9, 100), self.stored(self.shards.shard_for(9)))
+
+    def test_migrations(self):
+        """Test flask db upgrade migrates every shard"""
+        for name in self.shards.names:
+            db.Model.metadata.drop_all(self.shards.engine(name))
+        upgrade()
+        for name in self.shards.names:
+            engine = self.shards.engine(name)
+            self.assertIn("shopcart_archive", db.inspect(engine).get_table_names(), name)
+            engine.execute("DROP TABLE alembic_version")
+
+    def test_scatter_gather(self):
+        """Test the reads across carts merge every shard in cart order"""
+        self.fill()
+        keys = [(shopcart_id, product_id) for shopcart_id in range(1, 13) for product_id in (100, 200 + shopcart_id)]
+        self.assertEqual([(row.shopcart_id, row.product_id) for row in Shopcart.all()], keys)
+        self.assertEqual([(row.shopcart_id, row.product_id) for row in Shopcart.all_rows()], keys)
+        self.assertEqual([row.shopcart_id for row in Shopcart.find_by_product_id(100)], list(range(1, 13)))
+        self.assertEqual([row.shopcart_id for row in Shopcart.find_rows_by_product_id(205)], [5])
+        self.assertEqual([(row.shopcart_id, row.product_id) for row in Shopcart.export_all(2)], keys)
+        archived = [(row.shopcart_id, row.product_id, row.archive_id) for row in Shopcart.export_all(2, include_archived=True)]
+        self.assertEqual(archived, [key + (0,) for key in keys])
+        summaries = Shopcart.summarize([1, 2, 3, 99])
+        self.assertEqual([summaries[shopcart_id]["item_count"] for shopcart_id in (1, 2, 3, 99)], [2, 2, 2, 0])
+
+    def test_pages_across_shards(self):
+        """Test the list endpoint pages through every shard in order"""
+        self.fill()
+        keys = []
+        url = BASE_URL + "?limit=5"
+        while url:
+            resp = self.client.get(url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            keys.extend((row["shopcart_id"], row["product_id"]) for row in resp.get_json())
+            url = resp.headers.get("Link", "").partition(">")[0].lstrip("<").replace("http://localhost", "")
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(len(keys), 24)
+        resp = self.client.get(BASE_URL + "?limit=5&include_archived=true")
+        self.assertIn("include_archived=true", resp.headers["Link"])
+        resp = self.client.get(BASE_URL + "/export")
+        lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+        self.assertEqual([(row["shopcart_id"], row["product_id"]) for row in lines], keys)
+
+    def misplace(self, carts=30):
+        """ Writes carts 1 to carts on shard_0 as before the shards were added, returns the ones that move """
+        primary = self.shards.engine("shard_0")
+        primary.execute(Shopcart.__table__.insert(), [shopcart_row(shopcart_id=shopcart_id, product_id=100, quantity=1) for shopcart_id in range(1, carts + 1)])
+        primary.execute(ShopcartRevision.__table__.insert(), [
+            {"shopcart_id": shopcart_id, "revision": 1} for shopcart_id in range(1, carts + 1)
+        ])
+        misplaced = [shopcart_id for shopcart_id in range(1, carts + 1) if self.shards.shard_for(shopcart_id) != "shard_0"]
+        self.assertTrue(misplaced)
+        return misplaced
+
+    def start_rebalance(self):
+        """ Routes the carts like the workers restarted with shard_1 and shard_2 added to shard_0 """
+        self.app.config["DB_SHARD_PREVIOUS_COUNT"] = 1
+        self.addCleanup(self.app.config.__setitem__, "DB_SHARD_PREVIOUS_COUNT", 0)
+        self.addCleanup(self.app.extensions.__setitem__, "shards", self.shards)
+        shards = self.app.extensions["shards"] = ShardSet(db, self.app, move_cart)
+        self.assertEqual(shards.previous.names, ["shard_0"])
+        return shards
+
+    def test_rebalance(self):
+        """Test rebalancing moves the carts written before the shards were added"""
+        misplaced = self.misplace()
+        self.shards.engine("shard_0").execute(ShopcartArchive.__table__.insert(), [
+            shopcart_row(shopcart_id=misplaced[0], product_id=101, checkout=1, archived_at=datetime(2021, 6, 2))
+        ])
+        # an item added to a cart on its new shard before the cart moved
+        target = self.shards.shard_for(misplaced[0])
+        self.shards.engine(target).execute(Shopcart.__table__.insert(), [shopcart_row(shopcart_id=misplaced[0], product_id=100, quantity=5)])
+
+        moves, skipped = rebalance(self.shards, batch_size=7, dry_run=True)
+        self.assertEqual(sum(moves.values()), len(misplaced))
+        self.assertEqual(len(self.stored("shard_0")), 30)
+
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=["shards", "rebalance", "--batch-size", "7"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Moved {} carts over 3 shards".format(len(misplaced)), result.output)
+        for name in self.shards.names:
+            for shopcart_id, _ in self.stored(name):
+                self.assertEqual(self.shards.shard_for(shopcart_id), name)
+        self.assertEqual(Shopcart.find(misplaced[0], 100).quantity, 5)
+        self.assertEqual(Shopcart.get_revision(misplaced[0]), 2)
+        self.assertEqual([row.product_id for row in Shopcart.find_archived_rows(misplaced[0])], [101])
+        self.assertEqual(len(Shopcart.all_rows()), 30)
+        moves, skipped = rebalance(self.shards, batch_size=7)
+        self.assertEqual((sum(moves.values()), skipped), (0, []))
+
+    def test_moved_when_used(self):
+        """Test a cart still on its previous shard is moved by the first call about it"""
+        misplaced = self.misplace()
+        self.start_rebalance()
+        cart = misplaced[0]
+        resp = self.client.get(BASE_URL + "/{}".format(cart))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([row["product_id"] for row in resp.get_json()], [100])
+        self.assertNotIn((cart, 100), self.stored("shard_0"))
+        self.assertIn((cart, 100), self.stored(self.shards.shard_for(cart)))
+        self.assertEqual(self.revision(self.shards.shard_for(cart), cart), 2)
+        resp = self.client.get(BASE_URL + "/{}/summary".format(misplaced[1]))
+        self.assertEqual(resp.get_json()["item_count"], 1)
+        # a cart halfway through a move is read once, from its shard
+        halfway = misplaced[2]
+        self.shards.engine(self.shards.shard_for(halfway)).execute(Shopcart.__table__.insert(), [shopcart_row(shopcart_id=halfway, product_id=100, quantity=7)])
+        rows = Shopcart.all_rows()
+        self.assertEqual([(row.shopcart_id, row.product_id) for row in rows], [(shopcart_id, 100) for shopcart_id in range(1, 31)])
+        self.assertEqual(rows[halfway - 1].quantity, 7)
+
+    def test_settle_locks(self):
+        """Test a slow move only holds up the carts of its lock stripe and few carts are remembered"""
+        moving = threading.Event()
+        release = threading.Event()
+
+        def mover(source, target, shopcart_id):
+            if shopcart_id == 1:
+                moving.set()
+                release.wait(5)
+            return False
+
+        self.app.config["DB_SHARD_PREVIOUS_COUNT"] = 1
+        self.addCleanup(self.app.config.__setitem__, "DB_SHARD_PREVIOUS_COUNT", 0)
+        shards = ShardSet(db, self.app, mover)
+        shards.SETTLED_SIZE = 3
+        carts = [shopcart_id for shopcart_id in range(2, 100) if shopcart_id % shards.SETTLE_STRIPES != 1][:4]
+        slow = threading.Thread(target=shards.settle, args=(1,))
+        slow.start()
+        self.assertTrue(moving.wait(5))
+        for shopcart_id in carts:
+            shards.settle(shopcart_id)
+        self.assertFalse(shards.is_settled(1))
+        release.set()
+        slow.join()
+        self.assertEqual(list(shards.settled), carts[2:] + [1])
+
+    def test_rebalance_keeps_newer_cart(self):
+        """Test a cart cleared on its new shard is not filled again by the rebalance"""
+        misplaced = self.misplace()
+        self.start_rebalance()
+        cart = misplaced[0]
+        resp = self.client.delete(BASE_URL + "/{}".format(cart))
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        result = self.app.test_cli_runner().invoke(args=["shards", "rebalance"])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn("Moved {} carts".format(len(misplaced) - 1), result.output)
+        self.assertIn("unset DB_SHARD_PREVIOUS_COUNT", result.output)
+        self.assertEqual(Shopcart.find_rows_by_shopcart_id(cart), [])
+        self.assertEqual(self.client.get(BASE_URL + "/{}".format(cart)).status_code, status.HTTP_404_NOT_FOUND)
+        # a cart written on its new shard before it moved, the old copy is stale
+        stale = misplaced[1]
+        target = self.shards.engine(self.shards.shard_for(stale))
+        target.execute(ShopcartRevision.__table__.update().values(revision=5).where(
+            ShopcartRevision.__table__.c.shopcart_id == stale
+        ))
+        self.shards.engine("shard_0").execute(Shopcart.__table__.insert(), [shopcart_row(shopcart_id=stale, product_id=100)])
+        self.shards.engine("shard_0").execute(ShopcartRevision.__table__.insert(), [{"shopcart_id": stale, "revision": 1}])
+        target.execute(Shopcart.__table__.delete().where(Shopcart.__table__.c.shopcart_id == stale))
+        self.assertTrue(move_cart(self.shards.engine("shard_0"), target, stale))
+        self.assertEqual(self.stored(self.shards.shard_for(stale)).count((stale, 100)), 0)
+        self.assertEqual(self.revision(self.shards.shard_for(stale), stale), 6)
+        self.assertNotIn((stale, 100), self.stored("shard_0"))
+        self.assertFalse(move_cart(self.shards.engine("shard_0"), target, stale))